@@ -7,11 +7,67 @@ from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment
 import numpy as np
-from openpyxl.styles import Font, Border, Side, Alignment, PatternFill
+from openpyxl.styles import Font, Border, Side, Alignment, PatternFill, NamedStyle
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 import datetime
 import tempfile
 from io import BytesIO
 import base64
+import hashlib
+import json
+import threading
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as TiempoAgotado
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import re
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import shutil
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pa_parquet
+except ImportError:  # pyarrow es opcional: CSV cae a pandas
+    pa = None
+    pa_csv = None
+    pa_parquet = None
+
+try:
+    import resource
+except ImportError:  # solo Unix: sin él no se mide la memoria del trabajador
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # solo Unix: en Windows el índice SIF se protege solo entre hilos
+    fcntl = None
+
+try:
+    import duckdb
+except ImportError:  # motor DuckDB opcional para los cruces
+    duckdb = None
+
+try:
+    import polars as pl
+except ImportError:  # motor Polars opcional para CMPC y Celulosa
+    pl = None
+
+logger = logging.getLogger("agentecfs")
+
+# Copy-on-write: filtros y proyecciones comparten datos hasta que se
+# modifican, sin copias defensivas (en pandas 3 ya es el comportamiento fijo)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# Datos persistentes del servidor (índices, cachés), fuera del repositorio
+DIR_DATOS = os.environ.get("AGENTECFS_DATOS", os.path.join(tempfile.gettempdir(), "agentecfs"))
 
 # --- FUNCIÓN AUXILIAR RUTAS ---
 def resolver_ruta(ruta_relativa):
@@ -21,7 +77,579 @@ def resolver_ruta(ruta_relativa):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, ruta_relativa)
 
-def obtener_entregas_excluidas(rutas_historicas):
+def huella_archivo(ruta):
+    """
+    Huella SHA-1 del contenido de un archivo (independiente de su nombre).
+    """
+    h = hashlib.sha1()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def contexto_procesos():
+    """
+    Contexto 'forkserver' con la app precargada. Los hijos nacen de un
+    servidor de un solo hilo que ya importó el módulo, no del proceso de
+    Streamlit: con 'fork' heredarían candados tomados por otros hilos (o el
+    pool de hilos de Polars) y podrían quedar bloqueados. None si no está
+    disponible (Windows) o en el ejecutable empaquetado.
+    """
+    if hasattr(sys, "_MEIPASS") or "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    contexto = multiprocessing.get_context("forkserver")
+    contexto.set_forkserver_preload(["__main__"])
+    return contexto
+
+def crear_pool_procesos(max_workers):
+    """
+    Pool para tareas CPU (parseo de Excel). Usa procesos del forkserver
+    cuando el sistema lo permite; en otro caso (Windows/ejecutable) cae a hilos.
+    """
+    contexto = contexto_procesos()
+    if contexto is not None:
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=contexto)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def inferir_tipos_como_excel(df):
+    """
+    Replica la inferencia de tipos de read_excel sobre una tabla en memoria
+    (columnas de texto completamente numéricas pasan a número), para que un
+    flujo encadenado produzca lo mismo que releyendo el archivo.
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                pass
+    return df
+
+# ==========================================
+#   LECTURA DE TABLAS (EXCEL / CSV / PARQUET)
+# ==========================================
+EXTENSIONES_ENTRADA = ['xlsx', 'xls', 'dbf', 'csv', 'parquet']
+EXTENSIONES_ARROW = ('.arrow', '.feather')
+
+def detectar_formato_csv(ruta):
+    """
+    Detecta codificación y separador de un CSV leyendo solo su inicio.
+    Los extractos chilenos suelen venir en latin-1 y separados por ';'.
+    """
+    with open(ruta, 'rb') as f:
+        muestra = f.read(64 * 1024)
+    try:
+        texto = muestra.decode('utf-8-sig')
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        texto = muestra.decode('latin-1')
+        encoding = 'latin-1'
+    # El separador es el que da el mismo número de campos (>1) en las
+    # primeras líneas; ';' va primero porque los encabezados DBF
+    # ("vollote,C,15") llevan comas dentro del nombre
+    lineas = [l for l in texto.splitlines()[:20] if l.strip()]
+    if len(lineas) > 1 and len(muestra) == 64 * 1024:
+        lineas = lineas[:-1]  # la última puede venir cortada
+    for separador in (';', '\t', '|', ','):
+        largos = {len(fila) for fila in csv.reader(lineas, delimiter=separador)}
+        if len(largos) == 1 and largos.pop() > 1:
+            return encoding, separador
+    return encoding, ','
+
+
+def leer_csv(ruta, columnas=None):
+    """
+    CSV con lector multihilo de pyarrow (o pandas si no está instalado).
+    Con separador distinto de ',' la coma se toma como separador decimal,
+    así '0,35' llega como número sin reemplazos posteriores. `columnas`
+    limita las columnas que se materializan.
+    """
+    encoding, separador = detectar_formato_csv(ruta)
+    decimal = ',' if separador != ',' else '.'
+
+    if pa_csv is not None:
+        tabla = pa_csv.read_csv(
+            ruta,
+            read_options=pa_csv.ReadOptions(encoding=encoding, use_threads=True),
+            parse_options=pa_csv.ParseOptions(delimiter=separador),
+            convert_options=pa_csv.ConvertOptions(decimal_point=decimal, include_columns=columnas or []),
+        )
+        return tabla.to_pandas()
+
+    encoding = 'utf-8-sig' if encoding == 'utf-8' else encoding
+    return pd.read_csv(ruta, sep=separador, decimal=decimal, encoding=encoding, usecols=columnas)
+
+def leer_tabla(ruta, columnas=None, **kwargs_excel):
+    """
+    Lee un archivo de entrada según su extensión: CSV y Parquet evitan el
+    parseo de Excel; el resto va a read_excel con los argumentos dados.
+    """
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension == '.csv':
+        return leer_csv(ruta, columnas)
+    if extension == '.parquet':
+        return pd.read_parquet(ruta, columns=columnas)
+    if extension in EXTENSIONES_ARROW:
+        df = leer_arrow(ruta)
+        return df if columnas is None else df[columnas]
+    if columnas is not None:
+        kwargs_excel['usecols'] = columnas
+    return pd.read_excel(ruta, **kwargs_excel)
+
+# --- Intercambio Arrow IPC (Feather v2) entre procesos ---
+def guardar_arrow(df, ruta_base):
+    """
+    Escribe una tabla como Arrow IPC sin comprimir (se puede mapear en
+    memoria al leerla). Si Arrow no la admite (columnas object con tipos
+    mezclados) o no hay pyarrow, cae a pickle. Devuelve la ruta escrita.
+    """
+    if pa is not None:
+        try:
+            tabla = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            tabla = None
+        if tabla is not None:
+            ruta = ruta_base + '.arrow'
+            with pa.OSFile(ruta, 'wb') as sink, pa.ipc.new_file(sink, tabla.schema) as writer:
+                writer.write_table(tabla)
+            return ruta
+    ruta = ruta_base + '.pkl'
+    df.to_pickle(ruta)
+    return ruta
+
+def leer_arrow(ruta, en_mapa=False):
+    """
+    Lee un archivo Arrow IPC mapeándolo en memoria. Con en_mapa=True las
+    columnas quedan como pd.ArrowDtype sobre el mismo mapa, sin copiarse al
+    heap (las escrituras crean columnas nuevas: los arreglos Arrow son
+    inmutables); en Linux el archivo se puede borrar mientras la tabla
+    viva. Si no, to_pandas copia a los dtypes habituales de pandas.
+    """
+    with pa.memory_map(ruta) as fuente:
+        tabla = pa.ipc.open_file(fuente).read_all()
+    if en_mapa:
+        return tabla.to_pandas(types_mapper=pd.ArrowDtype)
+    return tabla.to_pandas()
+
+def abrir_tabla(valor):
+    """
+    Tabla ya materializada de un flujo encadenado: DataFrame, tabla Arrow o
+    archivo de intercambio (.arrow/.pkl). Para rutas de entrada normales
+    (Excel, CSV...) devuelve None y el flujo las lee como siempre. Las
+    tablas Arrow se entregan sin copia, respaldadas por el mapa (ArrowDtype).
+    """
+    if isinstance(valor, pd.DataFrame):
+        return valor
+    if pa is not None and isinstance(valor, pa.Table):
+        return valor.to_pandas(types_mapper=pd.ArrowDtype)
+    if isinstance(valor, str):
+        extension = os.path.splitext(valor)[1].lower()
+        if extension in EXTENSIONES_ARROW:
+            return leer_arrow(valor, en_mapa=True)
+        if extension == '.pkl':
+            return pd.read_pickle(valor)
+    return None
+
+def leer_guardada(ruta):
+    """
+    Tabla escrita por guardar_arrow (.arrow o .pkl) con los dtypes
+    habituales de pandas: para cachés y estados que el flujo mezcla con
+    tablas recién leídas.
+    """
+    if os.path.splitext(ruta)[1].lower() in EXTENSIONES_ARROW:
+        return leer_arrow(ruta)
+    return pd.read_pickle(ruta)
+
+def _nombres_columnas(tabla):
+    return tabla.column_names if pa is not None and isinstance(tabla, pa.Table) else list(tabla.columns)
+
+def tablas_a_archivos(valor, ruta_base):
+    """
+    Reemplaza DataFrames (sueltos o en {hoja: DataFrame}) por archivos de
+    intercambio bajo `ruta_base`; el resto de valores se deja igual.
+    """
+    if isinstance(valor, pd.DataFrame):
+        return guardar_arrow(valor, ruta_base)
+    if isinstance(valor, dict) and valor and all(isinstance(v, pd.DataFrame) for v in valor.values()):
+        return {hoja: guardar_arrow(df, f"{ruta_base}__{i}") for i, (hoja, df) in enumerate(valor.items())}
+    return valor
+
+def archivos_a_tablas(valor):
+    """Inverso de `tablas_a_archivos`."""
+    if isinstance(valor, dict):
+        return {hoja: archivos_a_tablas(v) for hoja, v in valor.items()}
+    tabla = abrir_tabla(valor)
+    return valor if tabla is None else tabla
+
+# --- Lectura filtrada por llave ---
+# Normalizaciones para prefiltrar: cualquier par de valores que el cruce
+# exacto considera iguales queda igual aquí, así el prefiltro conserva un
+# superconjunto de las filas y la lógica de pandas posterior no cambia.
+def _valor_crudo(valor):
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+def llave_texto(valor):
+    # "12345.0" (astype(str) de una columna float con vacíos) vale lo mismo que 12345
+    return re.sub(r'\.0$', '', str(_valor_crudo(valor)).strip())
+
+def llave_numero(valor):
+    """Número de contenedor sin decimales ni ceros a la izquierda."""
+    return llave_texto(valor).split('.')[0].lstrip('0')
+
+def llave_sello(valor):
+    return llave_texto(valor).replace("-", "").strip()
+
+def _columna_presente(encabezado, alternativas):
+    limpias = {str(c).strip(): c for c in encabezado if c is not None}
+    for alternativa in alternativas:
+        if alternativa in limpias:
+            return limpias[alternativa]
+    return None
+
+def _cumple_filtros(valores, filtros):
+    return any(normalizar(valores[i]) in llaves for i, llaves, normalizar in filtros)
+
+def _leer_xlsx_filtrado(ruta, filtros, columnas):
+    """
+    Recorre la primera hoja en modo read_only conservando solo las filas que
+    cumplen algún filtro y solo las columnas pedidas. Replica la conversión
+    de read_excel sobre las filas conservadas (enteros como int, vacías como
+    NaN, columnas de texto numérico como número).
+    """
+    wb = load_workbook(ruta, read_only=True, data_only=True, keep_links=False)
+    try:
+        filas = wb.worksheets[0].iter_rows(values_only=True)
+        encabezado = list(next(filas, ()))
+        columnas = encabezado if columnas is None else columnas
+        idx_columnas = [encabezado.index(c) for c in columnas]
+        filtros_idx = [(encabezado.index(col), llaves, normalizar) for col, llaves, normalizar in filtros]
+
+        datos = []
+        filas_leidas = 0
+        ancho = len(encabezado)
+        for fila in filas:
+            if not any(v is not None for v in fila):
+                continue
+            # Sin <dimension> en la hoja, read_only entrega filas cortas si
+            # las últimas celdas están vacías
+            if len(fila) < ancho:
+                fila = fila + (None,) * (ancho - len(fila))
+            filas_leidas += 1
+            if _cumple_filtros(fila, filtros_idx):
+                datos.append([
+                    np.nan if fila[i] is None else _valor_crudo(fila[i]) for i in idx_columnas
+                ])
+    finally:
+        wb.close()
+
+    df = pd.DataFrame(datos, columns=columnas)
+    return inferir_tipos_como_excel(df), filas_leidas
+
+def leer_tabla_filtrada(ruta, filtros, columnas=None):
+    """
+    Lee solo las filas cuya llave está en el conjunto objetivo, sin armar
+    antes la tabla completa. `filtros` es una lista de
+    (columnas_alternativas, llaves, normalizar): basta que se cumpla uno.
+    `columnas` (conjunto de nombres aceptados) limita lo que se materializa.
+    Devuelve (df, filas_leidas). Si falta una columna llave, lee completo.
+    """
+    extension = os.path.splitext(ruta)[1].lower()
+    df = None
+    if extension == '.xlsx':
+        wb = load_workbook(ruta, read_only=True, keep_links=False)
+        try:
+            encabezado = list(next(wb.worksheets[0].iter_rows(min_row=1, max_row=1, values_only=True), ()))
+        finally:
+            wb.close()
+    elif extension in ('.csv', '.parquet'):
+        encabezado = next(iter(leer_encabezados(ruta).values()), [])
+    else:
+        # Formatos sin lectura por filas (xls): se filtra después de leer
+        df = leer_tabla(ruta)
+        encabezado = list(df.columns)
+
+    filtros_col = []
+    for alternativas, llaves, normalizar in filtros:
+        col = _columna_presente(encabezado, alternativas)
+        if col is None:
+            df = leer_tabla(ruta) if df is None else df
+            return df, len(df)
+        filtros_col.append((col, {normalizar(v) for v in llaves}, normalizar))
+
+    usar = None
+    if columnas is not None:
+        columnas = set(columnas)
+        usar = [c for c in encabezado if c is not None and str(c).strip() in columnas]
+        usar += [col for col, _, _ in filtros_col if col not in usar]
+
+    if extension == '.xlsx':
+        return _leer_xlsx_filtrado(ruta, filtros_col, usar)
+
+    if df is None:
+        df = leer_tabla(ruta, columnas=usar)
+    elif usar is not None:
+        df = df[usar]
+    return _filtrar_filas(df, filtros_col)
+
+def _filtrar_filas(df, filtros_col):
+    mascara = pd.Series(False, index=df.index)
+    for col, llaves, normalizar in filtros_col:
+        mascara |= mapear_valores_unicos(df[col], normalizar).isin(llaves)
+    return df[mascara], len(df)
+
+def filtrar_tabla(df, filtros, columnas=None):
+    """
+    `leer_tabla_filtrada` sobre una tabla ya en memoria (p. ej. la parte que
+    recibe cada partición): mismos `filtros` y `columnas`, mismo resultado.
+    """
+    filtros_col = []
+    for alternativas, llaves, normalizar in filtros:
+        col = _columna_presente(df.columns, alternativas)
+        if col is None:
+            return df, len(df)
+        filtros_col.append((col, {normalizar(v) for v in llaves}, normalizar))
+    if columnas is not None:
+        columnas = set(columnas)
+        usar = [c for c in df.columns if str(c).strip() in columnas]
+        df = df[usar + [col for col, _, _ in filtros_col if col not in usar]]
+    return _filtrar_filas(df, filtros_col)
+
+# ==========================================
+#   MODO BAJO CONSUMO DE MEMORIA
+# ==========================================
+# Sobre este tamaño total de entradas los flujos sueltan intermedios apenas
+# dejan de usarse y bajan a disco las tablas vivas pero ociosas
+UMBRAL_BAJO_CONSUMO_MB = float(os.environ.get("AGENTECFS_BAJO_CONSUMO_MB", "150"))
+DIR_TEMPORAL = os.path.join(DIR_DATOS, "temporal")
+
+def tamano_entradas(rutas):
+    """Suma en bytes de los archivos de `rutas` (ignora tablas en memoria)."""
+    total = 0
+    for ruta in rutas.values():
+        for r in (ruta if isinstance(ruta, (list, tuple)) else [ruta]):
+            if isinstance(r, str) and os.path.isfile(r):
+                total += os.path.getsize(r)
+    return total
+
+def modo_bajo_consumo(opciones, rutas):
+    """
+    Usa opciones["bajo_consumo"] si viene fijado; si no, lo decide según el
+    tamaño de las entradas y lo deja anotado en `opciones`.
+    """
+    if opciones is not None and opciones.get("bajo_consumo") is not None:
+        return opciones["bajo_consumo"]
+    activo = tamano_entradas(rutas) > UMBRAL_BAJO_CONSUMO_MB * 1024 * 1024
+    if opciones is not None:
+        opciones["bajo_consumo"] = activo
+    return activo
+
+def liberar_memoria(activo):
+    """Tras soltar intermedios con `del`, recolecta ciclos en modo bajo consumo."""
+    if activo:
+        gc.collect()
+
+def bajar_a_disco(activo, df):
+    """
+    Guarda una tabla ociosa en DIR_TEMPORAL y devuelve el archivo abierto, o
+    la misma tabla si el modo está apagado. Se usa pickle y no Parquet porque
+    conserva exactos los tipos (columnas object mixtas de los DBF). El
+    archivo es anónimo (TemporaryFile): el sistema lo borra al cerrarse,
+    también si el flujo falla antes de `subir_de_disco` o el proceso muere.
+    """
+    if not activo:
+        return df
+    os.makedirs(DIR_TEMPORAL, exist_ok=True)
+    archivo = tempfile.TemporaryFile(suffix=".pkl", dir=DIR_TEMPORAL)
+    try:
+        df.to_pickle(archivo)
+    except BaseException:
+        archivo.close()
+        raise
+    return archivo
+
+def subir_de_disco(tabla):
+    """Inverso de `bajar_a_disco`: relee la tabla y cierra (borra) el archivo."""
+    if isinstance(tabla, pd.DataFrame):
+        return tabla
+    with tabla:
+        tabla.seek(0)
+        return pd.read_pickle(tabla)
+
+# ==========================================
+#   CACHÉ COMPARTIDA DE TABLAS DE REFERENCIA
+# ==========================================
+# ZOOPP, Tools e Informe suelen ser los mismos para todos los operadores de
+# un turno: la tabla parseada se guarda una vez por contenido (huella) y
+# parámetros de lectura. Nivel 1: memoria del proceso, LRU con tope; solo
+# se comparte entre sesiones cuando los flujos corren en el proceso de
+# Streamlit. En un trabajador dura lo que dura el trabajo y se vacía al
+# terminar, para que el proceso ocioso no retenga tablas. Nivel 2: Arrow IPC
+# en DIR_DATOS: comparte el parseo entre procesos, pero cada uno copia la
+# tabla a su propia memoria al leerla.
+CACHE_TABLAS_MB = float(os.environ.get("AGENTECFS_CACHE_TABLAS_MB", "512"))
+CACHE_DISCO_MB = float(os.environ.get("AGENTECFS_CACHE_DISCO_MB", "2048"))
+DIR_CACHE_TABLAS = os.path.join(DIR_DATOS, "tablas")
+
+@st.cache_resource
+def _cache_tablas():
+    return {"tablas": OrderedDict(), "bytes": 0, "candado": threading.Lock()}
+
+def clave_lectura(ruta, *parametros):
+    """Clave por contenido del archivo y parámetros de lectura (no por nombre)."""
+    h = hashlib.sha1(huella_archivo(ruta).encode())
+    h.update(json.dumps(parametros, default=str).encode())
+    return h.hexdigest()
+
+def _guardar_cache_memoria(clave, df, meta):
+    tamano = int(df.memory_usage(index=True, deep=True).sum())
+    limite = CACHE_TABLAS_MB * 1024 * 1024
+    if tamano > limite:
+        return
+    cache = _cache_tablas()
+    with cache["candado"]:
+        if clave in cache["tablas"]:
+            return
+        cache["tablas"][clave] = (df, meta, tamano)
+        cache["bytes"] += tamano
+        while cache["bytes"] > limite:
+            _, (_, _, liberado) = cache["tablas"].popitem(last=False)
+            cache["bytes"] -= liberado
+
+def vaciar_cache_memoria():
+    """Suelta el nivel 1 completo (trabajador que queda ocioso)."""
+    cache = _cache_tablas()
+    with cache["candado"]:
+        cache["tablas"].clear()
+        cache["bytes"] = 0
+    gc.collect()
+
+def _ruta_cache_disco(clave):
+    for extension in ('.arrow', '.pkl'):
+        ruta = os.path.join(DIR_CACHE_TABLAS, clave + extension)
+        if os.path.exists(ruta):
+            return ruta
+    return None
+
+def _leer_cache_disco(clave):
+    ruta = _ruta_cache_disco(clave)
+    if ruta is None:
+        return None
+    try:
+        with open(os.path.join(DIR_CACHE_TABLAS, clave + '.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        df = leer_guardada(ruta)
+    except (OSError, ValueError) as e:
+        logger.warning("Caché de tablas ilegible (%s): %s", clave, e)
+        return None
+    os.utime(ruta)  # marca de uso para el LRU en disco
+    return df, meta
+
+def _guardar_cache_disco(clave, df, meta):
+    os.makedirs(DIR_CACHE_TABLAS, exist_ok=True)
+    try:
+        with open(os.path.join(DIR_CACHE_TABLAS, clave + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, default=lambda v: v.item() if hasattr(v, "item") else str(v))
+        temporal = os.path.join(DIR_CACHE_TABLAS, f"{clave}.{os.getpid()}.tmp")
+        escrito = guardar_arrow(df, temporal)
+        os.replace(escrito, os.path.join(DIR_CACHE_TABLAS, clave + os.path.splitext(escrito)[1]))
+    except OSError as e:
+        logger.warning("No se pudo guardar la tabla en caché: %s", e)
+        return
+    _podar_cache_disco()
+
+def _podar_cache_disco():
+    """Borra las tablas usadas hace más tiempo hasta quedar bajo CACHE_DISCO_MB."""
+    datos = []
+    for nombre in os.listdir(DIR_CACHE_TABLAS):
+        if nombre.endswith(('.arrow', '.pkl')):
+            ruta = os.path.join(DIR_CACHE_TABLAS, nombre)
+            try:
+                datos.append((os.path.getmtime(ruta), os.path.getsize(ruta), ruta))
+            except OSError:
+                continue
+    total = sum(tamano for _, tamano, _ in datos)
+    for _, tamano, ruta in sorted(datos):
+        if total <= CACHE_DISCO_MB * 1024 * 1024:
+            break
+        for borrar in (ruta, os.path.splitext(ruta)[0] + '.json'):
+            try:
+                os.remove(borrar)
+            except OSError:
+                pass
+        total -= tamano
+
+def leer_en_cache(clave, lector):
+    """
+    Devuelve (df, meta) desde la caché o los produce con `lector()`. El df
+    entregado es una vista (copia superficial): con copy-on-write, los
+    cambios del flujo no alteran la tabla compartida.
+    """
+    cache = _cache_tablas()
+    with cache["candado"]:
+        if clave in cache["tablas"]:
+            cache["tablas"].move_to_end(clave)
+            df, meta, _ = cache["tablas"][clave]
+            return df.copy(deep=False), dict(meta)
+
+    encontrado = _leer_cache_disco(clave)
+    if encontrado is None:
+        df, meta = lector()
+        if df is None:  # el lector no produjo tabla: nada que guardar
+            return None, meta
+        _guardar_cache_disco(clave, df, meta)
+    else:
+        df, meta = encontrado
+    _guardar_cache_memoria(clave, df, meta)
+    return df.copy(deep=False), dict(meta)
+
+def leer_referencia(ruta, columnas=None, lector=None):
+    """`leer_tabla` (o `lector`) a través de la caché compartida."""
+    lector = lector or leer_tabla
+    clave = clave_lectura(ruta, lector.__name__, columnas)
+    df, _ = leer_en_cache(clave, lambda: (lector(ruta) if columnas is None else lector(ruta, columnas), {}))
+    return df
+
+def leer_referencia_filtrada(ruta, filtros, columnas=None):
+    """`leer_tabla_filtrada` a través de la caché compartida; la clave incluye las llaves."""
+    firma = [
+        (list(alternativas), normalizar.__name__, sorted({normalizar(v) for v in llaves}))
+        for alternativas, llaves, normalizar in filtros
+    ]
+    clave = clave_lectura(ruta, "filtrada", firma, sorted(columnas) if columnas is not None else None)
+
+    def lector():
+        df, filas_leidas = leer_tabla_filtrada(ruta, filtros, columnas)
+        return df, {"filas_leidas": filas_leidas}
+
+    df, meta = leer_en_cache(clave, lector)
+    return df, meta["filas_leidas"]
+
+def registrar_tablas(opciones, tablas):
+    """
+    Publica tablas intermedias (DataFrames o {hoja: DataFrame}) en
+    opciones["tablas"], para que otro flujo las consuma sin releer Excel.
+    """
+    if opciones is None:
+        return
+    opciones.setdefault("tablas", {}).update(tablas)
+
+def avisar(opciones, nivel, texto):
+    """
+    Advertencia o error no fatal de un flujo ("warning" o "error"). Se
+    acumula en opciones["avisos"], que vuelve desde el proceso trabajador
+    (donde st.* no llega a la sesión) y se guarda con la ejecución
+    memorizada; ejecutar_proceso los muestra al terminar. Sin opciones se
+    muestra directo.
+    """
+    if opciones is None:
+        getattr(st, nivel)(texto)
+        return
+    opciones.setdefault("avisos", []).append((nivel, texto))
+
+def obtener_entregas_excluidas(rutas_historicas, opciones=None):
     """
     Lee archivos de remates anteriores para identificar qué Entregas/Contratos 
     ya fueron procesados. Divide las entregas combinadas (ej: 'A / B').
@@ -58,15 +686,15 @@ def obtener_entregas_excluidas(rutas_historicas):
                             
                 st.success(f"{os.path.basename(ruta)}: Procesado correctamente.")
             else:
-                st.warning(f"{os.path.basename(ruta)}: No se encontró columna 'Entrega' o 'Contrato'.")
+                avisar(opciones, "warning", f"{os.path.basename(ruta)}: No se encontró columna 'Entrega' o 'Contrato'.")
                 
         except Exception as e:
-            st.error(f"Error leyendo histórico {os.path.basename(ruta)}: {e}")
+            avisar(opciones, "error", f"Error leyendo histórico {os.path.basename(ruta)}: {e}")
             
     st.info(f"Total entregas únicas a excluir: {len(excluidas)}")
     return excluidas
 
-def obtener_entregas_excluidas_hojas(rutas_historicas):
+def obtener_entregas_excluidas_hojas(rutas_historicas, opciones=None):
     """
     Lee los nombres de las HOJAS de los archivos históricos.
     En Celulosa, cada hoja es una Entrega ya procesada.
@@ -94,316 +722,1204 @@ def obtener_entregas_excluidas_hojas(rutas_historicas):
             wb.close()
                 
         except Exception as e:
-            st.error(f"Error leyendo histórico {os.path.basename(ruta)}: {e}")
+            avisar(opciones, "error", f"Error leyendo histórico {os.path.basename(ruta)}: {e}")
             
     st.info(f"Total entregas (hojas) a excluir: {len(excluidas)}")
     return excluidas
 
 # ==========================================
-#   NUEVA FUNCIÓN AUXILIAR DE FORMATO
+#   TRAZA DE FILAS POR ETAPA (EMBUDO)
 # ==========================================
-def agregar_cabecera_arauco(ws, datos):
+def _llaves_unicas(df, llaves):
+    if not llaves:
+        return None
+    llaves = [llaves] if isinstance(llaves, str) else list(llaves)
+    return not df.duplicated(subset=llaves).any()
+
+def registrar_etapa(opciones, etapa, operacion, entrada, salida, llaves=None, derecha=None, llaves_der=None):
     """
-    Dibuja la cabecera estilo Arauco en la hoja activa (ws).
+    Anota en opciones["traza"] filas de entrada/salida, unicidad de llaves y
+    factor de expansión de una etapa (cruce, filtro o agrupación).
+    """
+    if opciones is None or "traza" not in opciones:
+        return
+    # La entrada puede ser la tabla previa o solo su cantidad de filas
+    filas_entrada = entrada if isinstance(entrada, int) else len(entrada)
+    registro = {
+        "Etapa": etapa,
+        "Operación": operacion,
+        "Filas entrada": filas_entrada,
+        "Filas derecha": len(derecha) if derecha is not None else None,
+        "Filas salida": len(salida),
+        "Factor": round(len(salida) / filas_entrada, 3) if filas_entrada else None,
+        "Llaves únicas (izq)": _llaves_unicas(entrada, llaves) if not isinstance(entrada, int) else None,
+        "Llaves únicas (der)": _llaves_unicas(derecha, llaves_der) if derecha is not None else None,
+    }
+    opciones["traza"].append(registro)
+    logger.info("Etapa %s [%s]: %s -> %s filas (x%s)", etapa, operacion,
+                filas_entrada, registro["Filas salida"], registro["Factor"])
+
+def cruzar(opciones, etapa, izq, der, **kwargs):
     """
-    fuente_negrita = Font(bold=True, name='Calibri', size=11)
-    borde_fino = Side(border_style="thin", color="000000")
-    caja = Border(left=borde_fino, right=borde_fino, top=borde_fino, bottom=borde_fino)
-    alineacion_izq = Alignment(horizontal="left", vertical="center")
-    alineacion_centro = Alignment(horizontal="center", vertical="center")
+    pd.merge con registro en el embudo (factor de expansión y unicidad de
+    llaves de ambos lados). Con opciones["motor"] en "duckdb" o "polars" el
+    cruce se ejecuta en ese motor con el mismo resultado (ver merge_en_orden).
+    """
+    motor = (opciones or {}).get("motor")
+    if motor == "duckdb":
+        resultado = cruzar_duckdb(izq, der, **kwargs)
+    elif motor == "polars":
+        resultado = cruzar_polars(izq, der, **kwargs)
+    else:
+        resultado = merge_en_orden(izq, der, **kwargs)
+    llaves_izq = kwargs.get("left_on", kwargs.get("on"))
+    llaves_der = kwargs.get("right_on", kwargs.get("on"))
+    registrar_etapa(opciones, etapa, f"cruce {kwargs.get('how', 'inner')}", izq, resultado,
+                    llaves=llaves_izq, derecha=der, llaves_der=llaves_der)
+    return resultado
 
-    # Fila 1
-    ws['A1'] = "Nave";          ws['B1'] = datos['nave']
-    ws['D1'] = "Exportador";    ws['E1'] = datos['exportador']
-    
-    # Fila 2
-    ws['A2'] = "Destino";       ws['B2'] = datos['destino']
-    ws['D2'] = "Embarcador";    ws['E2'] = datos['embarcador']
+# ==========================================
+#   MOTOR DE CRUCES (PANDAS / DUCKDB)
+# ==========================================
+def motores_disponibles():
+    return (["pandas"] + (["duckdb"] if duckdb is not None else [])
+            + (["polars"] if pl is not None else []))
+
+def _sql_nombre(nombre):
+    return '"' + str(nombre).replace('"', '""') + '"'
+
+def merge_en_orden(izq, der, **kwargs):
+    """
+    izq.merge(der, **kwargs) con las filas de un cruce inner en un orden
+    fijo: el de la izquierda y, dentro de cada fila, el de la derecha. Es el
+    orden de DuckDB y Polars, y el que pandas da salvo en cruces
+    muchos-a-muchos, donde depende de su implementación; así los
+    drop_duplicates(keep="first") posteriores no dependen del motor.
+    """
+    if kwargs.get("how", "inner") != "inner":
+        return izq.merge(der, **kwargs)
+    resultado = izq.assign(__fila_izq=np.arange(len(izq))).merge(
+        der.assign(__fila_der=np.arange(len(der))), **kwargs)
+    orden = np.lexsort((resultado["__fila_der"].to_numpy(), resultado["__fila_izq"].to_numpy()))
+    resultado = resultado.drop(columns=["__fila_izq", "__fila_der"])
+    if (orden == np.arange(len(orden))).all():
+        return resultado
+    return resultado.iloc[orden].reset_index(drop=True)
+
+def _tipos_como_pandas(resultado, origen):
+    """
+    Da a cada columna de un resultado de DuckDB/Polars el dtype que dejaría
+    pandas: texto con el StringDtype de origen; enteros y booleanos que
+    quedaron con nulos (filas sin pareja de un cruce left) como float64 y
+    object con NaN, y sin nulos con su dtype de origen.
+    """
+    for col in resultado.columns:
+        dtype = origen.get(col)
+        if isinstance(dtype, pd.StringDtype):
+            resultado[col] = resultado[col].astype(dtype)
+        elif isinstance(dtype, np.dtype) and dtype.kind in "iub" and resultado[col].dtype != dtype:
+            serie = resultado[col]
+            if not serie.isna().any():
+                resultado[col] = serie.astype(dtype)
+            elif dtype.kind == "b":
+                resultado[col] = serie.astype(object).where(serie.notna(), np.nan)
+            else:
+                resultado[col] = serie.astype("float64")
+    return resultado
+
+def _como_lista(llaves):
+    if llaves is None:
+        return []
+    return [llaves] if isinstance(llaves, str) else list(llaves)
+
+def cruzar_duckdb(izq, der, how="inner", on=None, left_on=None, right_on=None, suffixes=("_x", "_y")):
+    """
+    Equivalente a merge_en_orden(izq, der, ...) ejecutado como hash join
+    multihilo de DuckDB: mismo orden de filas (el de la izquierda y luego el
+    de la derecha), mismas columnas, sufijos y dtypes, y NaN empareja con NaN
+    como en pandas. Si DuckDB no está o no acepta los tipos, cae a pandas.
+    """
+    if duckdb is None or how not in ("inner", "left"):
+        return merge_en_orden(izq, der, how=how, on=on, left_on=left_on, right_on=right_on, suffixes=suffixes)
+
+    llaves_izq = _como_lista(on if on is not None else left_on)
+    llaves_der = _como_lista(on if on is not None else right_on)
+    # left_on == right_on con el mismo nombre se comporta como `on`
+    llaves_comunes = set(llaves_izq) if llaves_izq == llaves_der else set()
+    solapadas = (set(izq.columns) & set(der.columns)) - llaves_comunes
+
+    # Alias posicionales: DuckDB no distingue mayúsculas ("Reserva" y
+    # "reserva" chocarían); los nombres reales se ponen en pandas
+    columnas = []
+    for col in izq.columns:
+        alias = f"{col}{suffixes[0]}" if col in solapadas else col
+        columnas.append((f"i.{_sql_nombre(col)} AS c{len(columnas)}", alias, izq[col].dtype))
+    for col in der.columns:
+        if col in llaves_comunes:
+            continue
+        alias = f"{col}{suffixes[1]}" if col in solapadas else col
+        columnas.append((f"d.{_sql_nombre(col)} AS c{len(columnas)}", alias, der[col].dtype))
+
+    condicion = " AND ".join(
+        f"i.{_sql_nombre(li)} IS NOT DISTINCT FROM d.{_sql_nombre(ld)}"
+        for li, ld in zip(llaves_izq, llaves_der)
+    )
+    consulta = (
+        f"SELECT {', '.join(c[0] for c in columnas)} "
+        f"FROM izq i {'LEFT JOIN' if how == 'left' else 'JOIN'} der d ON {condicion} "
+        f"ORDER BY i.__fila_izq, d.__fila_der"
+    )
+
+    try:
+        con = duckdb.connect()
+        try:
+            con.register("izq", izq.assign(__fila_izq=np.arange(len(izq))))
+            con.register("der", der.assign(__fila_der=np.arange(len(der))))
+            resultado = con.execute(consulta).df()
+            resultado.columns = [alias for _, alias, _ in columnas]
+        finally:
+            con.close()
+    except Exception as e:
+        logger.warning("DuckDB no pudo ejecutar el cruce (%s); se usa pandas", e)
+        return merge_en_orden(izq, der, how=how, on=on, left_on=left_on, right_on=right_on, suffixes=suffixes)
+
+    # DuckDB devuelve Int64/boolean con <NA>; pandas daría float64/object
+    return _tipos_como_pandas(resultado, {alias: dtype for _, alias, dtype in columnas})
+
+# ==========================================
+#   MOTOR POLARS (CMPC / CELULOSA)
+# ==========================================
+# Los planes se arman en modo lazy y Polars los optimiza y ejecuta en
+# paralelo; la salida vuelve a pandas con las mismas columnas para que los
+# escritores no cambien. Ante tipos que Polars no acepta (columnas con tipos
+# mezclados) se usa el camino pandas.
+def _a_pandas(lf, origen):
+    return _tipos_como_pandas(lf.collect().to_pandas(), origen)
+
+def con_motor(opciones, funcion_polars, funcion_pandas, *args):
+    """Ejecuta la variante Polars si el motor elegido es "polars"."""
+    if pl is not None and (opciones or {}).get("motor") == "polars":
+        try:
+            return funcion_polars(*args)
+        except Exception as e:
+            logger.warning("Polars no pudo ejecutar %s (%s); se usa pandas", funcion_polars.__name__, e)
+    return funcion_pandas(*args)
+
+def cruzar_polars(izq, der, how="inner", on=None, left_on=None, right_on=None, suffixes=("_x", "_y")):
+    """
+    Equivalente a merge_en_orden(izq, der, ...) con un join lazy de Polars:
+    mismo orden de filas, mismas columnas, sufijos y dtypes, y NaN empareja
+    con NaN.
+    """
+    def _merge():
+        return merge_en_orden(izq, der, how=how, on=on, left_on=left_on, right_on=right_on, suffixes=suffixes)
+
+    if pl is None or how not in ("inner", "left"):
+        return _merge()
+
+    llaves_izq = _como_lista(on if on is not None else left_on)
+    llaves_der = _como_lista(on if on is not None else right_on)
+    llaves_comunes = llaves_izq if llaves_izq == llaves_der else []
+    solapadas = (set(izq.columns) & set(der.columns)) - set(llaves_comunes)
+    renombre_izq = {c: f"{c}{suffixes[0]}" for c in solapadas}
+    renombre_der = {c: f"{c}{suffixes[1]}" for c in solapadas}
+
+    def _plan():
+        lf_izq = pl.from_pandas(izq).lazy().rename(renombre_izq)
+        lf_der = pl.from_pandas(der).lazy().rename(renombre_der)
+        if llaves_comunes:
+            lf = lf_izq.join(lf_der, on=llaves_comunes, how=how, nulls_equal=True,
+                             coalesce=True, maintain_order="left_right")
+        else:
+            lf = lf_izq.join(lf_der, how=how, nulls_equal=True, coalesce=False, maintain_order="left_right",
+                             left_on=[renombre_izq.get(c, c) for c in llaves_izq],
+                             right_on=[renombre_der.get(c, c) for c in llaves_der])
+        origen = {renombre_izq.get(c, c): t for c, t in izq.dtypes.items()}
+        origen.update({renombre_der.get(c, c): t for c, t in der.dtypes.items() if c not in llaves_comunes})
+        return _a_pandas(lf, origen)
+
+    return con_motor({"motor": "polars"}, _plan, _merge)
+
+def unir_por_contenedor(opciones, etapa, tools, remate, rsuffix="_rem"):
+    """
+    tools.set_index(CONTENEDORINF).join(remate.set_index(CONTENEDORREM)),
+    el cruce de consolidado de CMPC, en pandas o como join lazy de Polars.
+    """
+    def _pandas(tools, remate):
+        return tools.set_index("CONTENEDORINF").join(remate.set_index("CONTENEDORREM"), how="left", rsuffix=rsuffix)
+
+    def _polars(tools, remate):
+        solapadas = (set(tools.columns) & set(remate.columns)) - {"CONTENEDORINF"}
+        renombre = {c: f"{c}{rsuffix}" for c in solapadas}
+        lf = pl.from_pandas(tools).lazy().join(
+            pl.from_pandas(remate).lazy().rename(renombre),
+            left_on="CONTENEDORINF", right_on="CONTENEDORREM", how="left",
+            nulls_equal=True, coalesce=True, maintain_order="left_right",
+        )
+        origen = dict(tools.dtypes.items())
+        origen.update({renombre.get(c, c): t for c, t in remate.dtypes.items()})
+        return _a_pandas(lf, origen).set_index("CONTENEDORINF")
+
+    resultado = con_motor(opciones, _polars, _pandas, tools, remate)
+    registrar_etapa(opciones, etapa, "cruce left", tools, resultado, llaves="CONTENEDORINF",
+                    derecha=remate, llaves_der="CONTENEDORREM")
+    return resultado
+
+def _primero(col):
+    # "first" de pandas: primer valor no nulo del grupo
+    return pl.col(col).drop_nulls().first()
+
+def agrupar_celulosa_cb(tools_celulosa, entregas_validas):
+    """Paquetes de Tools -> una fila por Contrato/BOX/LOTE (pandas)."""
+    tools_celulosa = tools_celulosa.copy(deep=False)
+    tools_celulosa['Contrato'] = tools_celulosa['Contrato'].astype(str)
+    df = tools_celulosa[
+        tools_celulosa["Contrato"].isin(entregas_validas)
+    ]
+
+    df["Contenedor"] = df["Contenedor"].astype(str).str.strip()
+    df["Expedicion"] = df["Expedicion"].astype(str).str.strip()
     
-    # Fila 3
-    ws['A3'] = "Reserva";       ws['B3'] = datos['reserva']
-    ws['D3'] = "Carga";         ws['E3'] = datos['carga']
+    def normalizar_box(contenedor):
+        partes = contenedor.split('-')
+        if len(partes) == 3:
+            parte_media_normalizada = partes[1].zfill(6)
+            return f"{partes[0]}-{parte_media_normalizada}-{partes[2]}"
+        return contenedor
+
+    df["BOX"] = df["Contenedor"].apply(normalizar_box)
+
+    df["TARA"] = df["Tara"]
+    df["LOTE"] = df["Expedicion"]
+    df["BULTOS"] = df["Cantidad"]
+    df["UNI"] = df["BULTOS"] / 8
+    df["SELLO"] = df["Sello_linea"]
+    df["RESERVA"] = df["Reserva"]
+    df["DUS"] = df["Orden_Embarque"]
+    df["MAX"] = df["Max_Gross"]
+
+    df_agrupado = (
+        df.groupby(["Contrato", "BOX", "LOTE"], as_index=False)
+          .agg({
+              "TARA": "first",
+              "BULTOS": "sum",
+              "SELLO": "first",
+              "RESERVA": "first",
+              "DUS": "first",
+              "MAX": "first"
+          })
+    )
     
-    # Fila 4
-    ws['A4'] = "Contrato";      ws['B4'] = datos['contrato']
-    ws['D4'] = "Tipo/Linea";    ws['E4'] = datos['linea']
+    df_agrupado["UNI"] = df_agrupado["BULTOS"] / 8
+    return df_agrupado
+
+def agrupar_celulosa_cb_polars(tools_celulosa, entregas_validas):
+    """Mismo resultado que agrupar_celulosa_cb, como plan lazy de Polars."""
+    contenedor = pl.col("Contenedor").cast(pl.String).str.strip_chars()
+    partes = contenedor.str.split("-")
+    box = (
+        pl.when(partes.list.len() == 3)
+        .then(pl.concat_str([partes.list.get(0), partes.list.get(1).str.zfill(6), partes.list.get(2)], separator="-"))
+        .otherwise(contenedor)
+    )
+    lf = (
+        pl.from_pandas(tools_celulosa).lazy()
+        .with_columns(pl.col("Contrato").cast(pl.String))
+        .filter(pl.col("Contrato").is_in([str(e) for e in entregas_validas]))
+        .with_columns(BOX=box, LOTE=pl.col("Expedicion").cast(pl.String).str.strip_chars())
+        # groupby de pandas descarta llaves nulas; group_by de Polars no
+        .filter(pl.col("Contrato").is_not_null() & pl.col("BOX").is_not_null() & pl.col("LOTE").is_not_null())
+        .group_by(["Contrato", "BOX", "LOTE"])
+        .agg(
+            _primero("Tara").alias("TARA"),
+            pl.col("Cantidad").sum().alias("BULTOS"),
+            _primero("Sello_linea").alias("SELLO"),
+            _primero("Reserva").alias("RESERVA"),
+            _primero("Orden_Embarque").alias("DUS"),
+            _primero("Max_Gross").alias("MAX"),
+        )
+        .sort(["Contrato", "BOX", "LOTE"])
+        .with_columns(UNI=pl.col("BULTOS") / 8)
+    )
+    return lf.collect().to_pandas()
+
+def agrupar_celulosa_dp(informe, entregas_validas):
+    """Paquetes del Informe -> una fila por BOX/LOTE (pandas)."""
+    informe = informe.copy(deep=False)
+    informe["contrato"] = informe["contrato"].astype(str).str.strip()
+    informe = informe[informe["contrato"].isin(entregas_validas)]
+
+    informe['nro_cnt'] = informe['nro_cnt'].astype(str).str.strip()
+    informe['sigla_cnt'] = informe['sigla_cnt'].astype(str).str.strip()
+    informe['dv_cnt'] = informe['dv_cnt'].astype(str).str.strip()
+
+    def construir_contenedor_2(row):
+        sigla = row['sigla_cnt']
+        numero = row['nro_cnt'].zfill(6)
+        dv = row['dv_cnt']
+        return f"{sigla}-{numero}-{dv}"
+
+    informe['CONTENEDOR_2'] = informe.apply(construir_contenedor_2, axis=1)
+
+    df = informe.rename(columns={
+        "CONTENEDOR_2": "BOX",
+        "tara_cnt": "TARA",
+        "marca": "LOTE",
+        "sello": "SELLO",
+        "orden_embarque": "RESERVA",
+        "reserva": "DUS",
+        "maxgross": "MAX"
+    })
+
+    df = df[df["SELLO"].notna() & (df["SELLO"].astype(str).str.strip() != "")]
+
+    agrupado = df.groupby(["BOX", "LOTE"]).agg({
+        "TARA": "first",
+        "SELLO": "first",
+        "RESERVA": "first",
+        "DUS": "first",
+        "contrato": "first",
+        "MAX":"first",
+        "BOX": "count"
+    }).rename(columns={"BOX": "UNI"})
+
+    agrupado["BULTOS"] = agrupado["UNI"] * 8
+
+    return agrupado.reset_index()[[
+        "BOX", "TARA", "BULTOS", "UNI", "LOTE",
+        "SELLO", "RESERVA", "DUS", "MAX", "contrato"
+    ]]
+
+def agrupar_celulosa_dp_polars(informe, entregas_validas):
+    """Mismo resultado que agrupar_celulosa_dp, como plan lazy de Polars."""
+    texto = lambda col: pl.col(col).cast(pl.String).str.strip_chars()
+    lf = (
+        pl.from_pandas(informe).lazy()
+        .with_columns(contrato=texto("contrato"))
+        .filter(pl.col("contrato").is_in([str(e) for e in entregas_validas]))
+        .with_columns(BOX=pl.concat_str([texto("sigla_cnt"), texto("nro_cnt").str.zfill(6), texto("dv_cnt")], separator="-"))
+        .rename({"tara_cnt": "TARA", "marca": "LOTE", "sello": "SELLO",
+                 "orden_embarque": "RESERVA", "reserva": "DUS", "maxgross": "MAX"})
+        .filter(pl.col("SELLO").is_not_null() & (pl.col("SELLO").cast(pl.String).str.strip_chars() != ""))
+        .filter(pl.col("LOTE").is_not_null())
+        .group_by(["BOX", "LOTE"])
+        .agg(
+            _primero("TARA").alias("TARA"),
+            _primero("SELLO").alias("SELLO"),
+            _primero("RESERVA").alias("RESERVA"),
+            _primero("DUS").alias("DUS"),
+            _primero("contrato").alias("contrato"),
+            _primero("MAX").alias("MAX"),
+            pl.len().alias("UNI"),
+        )
+        .sort(["BOX", "LOTE"])
+        .with_columns(BULTOS=pl.col("UNI") * 8)
+        .select(["BOX", "TARA", "BULTOS", "UNI", "LOTE", "SELLO", "RESERVA", "DUS", "MAX", "contrato"])
+    )
+    return lf.collect().to_pandas()
 
-    ws.merge_cells('B4:C4')
+def mostrar_embudo(traza):
+    """
+    Muestra el embudo de filas de la última corrida; las etapas que
+    multiplican filas quedan destacadas.
+    """
+    if not traza:
+        return
+    embudo = pd.DataFrame(traza)
+    expansiones = embudo[embudo["Factor"].fillna(0) > 1]
+    with st.expander("🔎 Embudo de filas por etapa", expanded=not expansiones.empty):
+        if not expansiones.empty:
+            st.warning("Etapas que multiplican filas: " + ", ".join(expansiones["Etapa"]))
+        st.dataframe(embudo, use_container_width=True, hide_index=True)
 
-    for row in range(1, 5):
-        celda_tit1 = ws.cell(row=row, column=1)
-        celda_tit2 = ws.cell(row=row, column=4)
-        
-        celda_tit1.font = fuente_negrita
-        celda_tit2.font = fuente_negrita
-        
-        celda_val1 = ws.cell(row=row, column=2)
-        celda_val2 = ws.cell(row=row, column=5)
-        
-        for col in range(1, 6):
-            celda = ws.cell(row=row, column=col)
-            celda.border = caja
-            celda.alignment = alineacion_izq
+# ==========================================
+#   TABLAS DE REGLAS (NAVIERAS, PLANTAS, PESOS)
+# ==========================================
+# Línea naviera según el texto de NAV: gana la primera coincidencia; si
+# ninguna aplica se usa el NAV normalizado.
+LINEAS_NAVIERAS = [
+    ("MSC", "MSC"),
+    ("ONEY", "ONE"),
+    ("HLL", "HAPAG LLOYD"),
+    ("MAERSK", "MAERSK"),
+    ("ML", "MAERSK"),
+]
+
+# Volumen por fardo según planta CMPC (subcadenas de PLANTA, primera coincidencia)
+FACTORES_VOLUMEN_PLANTA = [
+    (("STA", "FÉ"), 0.254),
+    (("LAJA",), 0.2502),
+    (("PACIFICO",), 0.2618),
+]
+
+# Pesos fijos del consolidado CMPC Celulosa
+PESOS_CELULOSA_CMPC = {
+    "neto_por_fardo": 0.25175,
+    "bruto_por_fardo": 0.25413,
+    "carga_total": 24396,
+}
 
-    ws['B4'].alignment = alineacion_centro
+def mapear_valores_unicos(serie, funcion):
+    """
+    Evalúa `funcion` una vez por valor distinto y lo difunde a toda la
+    serie con un map vectorizado.
+    """
+    return serie.map({valor: funcion(valor) for valor in pd.unique(serie)})
+
+def linea_naviera(nav):
+    nav = str(nav).upper().strip()
+    for patron, linea in LINEAS_NAVIERAS:
+        if patron in nav:
+            return linea
+    return nav
+
+def factor_volumen_planta(planta):
+    planta = str(planta).upper().strip()
+    for patrones, factor in FACTORES_VOLUMEN_PLANTA:
+        if any(p in planta for p in patrones):
+            return factor
+    return np.nan
 
 # ==========================================
-#      LÓGICA DE MADERA (CORREGIDA)
+#   PLANTILLAS DE INFORME (ESTILOS CON NOMBRE)
 # ==========================================
-def procesar_madera(rutas):
+# Los objetos de estilo se construyen una sola vez al cargar el módulo; cada
+# libro solo registra los estilos con nombre que su plantilla necesita.
+_BORDE_FINO = Side(border_style="thin", color="000000")
+_CAJA = Border(left=_BORDE_FINO, right=_BORDE_FINO, top=_BORDE_FINO, bottom=_BORDE_FINO)
+_IZQUIERDA = Alignment(horizontal="left", vertical="center")
+_CENTRO = Alignment(horizontal="center", vertical="center")
+
+ESTILOS_INFORME = {
+    "arauco_titulo": dict(font=Font(bold=True, name='Calibri', size=11), border=_CAJA, alignment=_IZQUIERDA),
+    "arauco_valor": dict(border=_CAJA, alignment=_IZQUIERDA),
+    "arauco_valor_centro": dict(border=_CAJA, alignment=_CENTRO),
+    "box_combinado": dict(alignment=Alignment(vertical="center")),
+    "remate_titulo": dict(font=Font(bold=True), alignment=Alignment(horizontal="left")),
+    "remate_texto": dict(alignment=Alignment(horizontal="left")),
+    "remate_centro": dict(alignment=_CENTRO),
+    "remate_sobrepeso": dict(alignment=_CENTRO, fill=PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")),
+}
+
+# Cada fila es una lista de (texto, estilo). "{campo}" se reemplaza por el
+# valor tal cual (conserva números); cualquier otro texto usa str.format.
+PLANTILLAS_INFORME = {
+    "cabecera_arauco": {
+        "filas": [
+            [("Nave", "arauco_titulo"), ("{nave}", "arauco_valor"), (None, "arauco_valor"), ("Exportador", "arauco_titulo"), ("{exportador}", "arauco_valor")],
+            [("Destino", "arauco_titulo"), ("{destino}", "arauco_valor"), (None, "arauco_valor"), ("Embarcador", "arauco_titulo"), ("{embarcador}", "arauco_valor")],
+            [("Reserva", "arauco_titulo"), ("{reserva}", "arauco_valor"), (None, "arauco_valor"), ("Carga", "arauco_titulo"), ("{carga}", "arauco_valor")],
+            [("Contrato", "arauco_titulo"), ("{contrato}", "arauco_valor_centro"), (None, "arauco_valor"), ("Tipo/Linea", "arauco_titulo"), ("{linea}", "arauco_valor")],
+            [],
+        ],
+        "combinar": ["B4:C4"],
+        "estilos": ["arauco_titulo", "arauco_valor", "arauco_valor_centro", "box_combinado"],
+    },
+    "cabecera_remate_madera": {
+        "filas": [
+            [("INFORME  DE CONTENEDORES CONSOLIDADOS PARA EMBARQUE", "remate_titulo")],
+            [],
+            [("SAN VICENTE TERMINAL INTERNACIONAL", "remate_titulo")],
+            [("FECHA: {fecha}", "remate_texto")],
+            [("NAVE: {nave}", "remate_titulo")],
+            [],
+        ],
+        "combinar": [],
+        "estilos": ["remate_titulo", "remate_texto", "remate_centro", "remate_sobrepeso"],
+    },
+}
+
+def registrar_estilos(wb, nombres):
+    """Registra en el libro los estilos con nombre indicados (una vez por libro)."""
+    for nombre in nombres:
+        if nombre not in wb.named_styles:
+            wb.add_named_style(NamedStyle(name=nombre, **ESTILOS_INFORME[nombre]))
+
+def _celda(ws, valor, estilo=None):
+    celda = WriteOnlyCell(ws, value=valor)
+    if estilo:
+        celda.style = estilo
+    return celda
+
+def _rellenar(texto, datos):
+    if texto is None:
+        return None
+    if texto.startswith("{") and texto.endswith("}") and texto[1:-1] in datos:
+        return datos[texto[1:-1]]
+    return texto.format(**datos)
+
+def renderizar_plantilla(ws, nombre_plantilla, datos):
     """
-    1. Separa entregas compuestas (ej: "A / B" -> fila A, fila B).
-    2. Agrupa por Producto para respetar pesos/volúmenes.
-    3. Genera cabecera personalizada en Remate.
+    Escribe la plantilla en una hoja write_only recién creada: solo se
+    rellenan los campos; formato y combinaciones vienen de la plantilla.
     """
-    st.info("Iniciando procesamiento de Madera...")
-    
-    def separar_entregas_multiples(df, col_entrega):
-        if col_entrega not in df.columns:
-            return df
-        
-        df[col_entrega] = df[col_entrega].astype(str)
-        df[col_entrega] = df[col_entrega].str.split('/')
-        df = df.explode(col_entrega)
-        df[col_entrega] = df[col_entrega].str.strip().str.replace(r'\.0$', '', regex=True)
-        return df
+    plantilla = PLANTILLAS_INFORME[nombre_plantilla]
+    for fila in plantilla["filas"]:
+        ws.append([_celda(ws, _rellenar(texto, datos), estilo) for texto, estilo in fila])
+    for rango in plantilla["combinar"]:
+        ws.merged_cells.add(rango)
+
+def nuevo_libro_plantilla(nombre_plantilla):
+    """Libro write_only con los estilos de la plantilla ya registrados."""
+    wb = Workbook(write_only=True)
+    registrar_estilos(wb, PLANTILLAS_INFORME[nombre_plantilla]["estilos"])
+    return wb
+
+def _valor_excel(valor):
+    # NaN/NaT se escriben como celda vacía, igual que to_excel
+    return None if pd.isna(valor) else valor
+
+def escribir_hoja_arauco(wb, nombre_hoja, datos, data, columna_merge="BOX"):
+    """
+    Escribe en una sola pasada (libro write_only) la cabecera Arauco, la
+    tabla desde la fila 6 y las celdas BOX combinadas por tramos iguales.
+    """
+    ws = wb.create_sheet(title=nombre_hoja)
+    renderizar_plantilla(ws, "cabecera_arauco", datos)
+    ws.append(list(data.columns))
+
+    # Tramos consecutivos de igual BOX: solo la primera fila lleva el valor
+    idx_box = data.columns.get_loc(columna_merge)
+    letra_box = get_column_letter(idx_box + 1)
+    box = data[columna_merge]
+    tramo = (box != box.shift()).cumsum()
+    largo_tramo = tramo.map(tramo.value_counts())
+    inicio_tramo = (tramo != tramo.shift()).tolist()
+
+    fila_excel = 7
+    for valores, es_inicio, largo in zip(data.itertuples(index=False, name=None), inicio_tramo, largo_tramo):
+        fila = [_valor_excel(v) for v in valores]
+        if es_inicio and largo > 1:
+            fila[idx_box] = _celda(ws, fila[idx_box], "box_combinado")
+            ws.merged_cells.add(f"{letra_box}{fila_excel}:{letra_box}{fila_excel + largo - 1}")
+        elif not es_inicio:
+            fila[idx_box] = None
+        ws.append(fila)
+        fila_excel += 1
 
+# ==========================================
+#   ESCRITURA POR BLOQUES (LÍMITE DE FILAS EXCEL)
+# ==========================================
+MAX_FILAS_EXCEL = 1_048_576
+TAMANO_BLOQUE_ESCRITURA = 50_000
+
+def _celda_tabla(ws, valor):
+    valor = _valor_excel(valor)
+    # Mismo formato de fecha que usa to_excel
+    if isinstance(valor, datetime.datetime):
+        celda = WriteOnlyCell(ws, value=valor)
+        celda.number_format = "YYYY-MM-DD HH:MM:SS"
+        return celda
+    if isinstance(valor, datetime.date):
+        celda = WriteOnlyCell(ws, value=valor)
+        celda.number_format = "YYYY-MM-DD"
+        return celda
+    return valor
+
+def escribir_tablas_excel(hojas, max_filas=MAX_FILAS_EXCEL, tamano_bloque=TAMANO_BLOQUE_ESCRITURA):
+    """
+    Escribe {nombre_hoja: DataFrame} en un libro write_only recorriendo las
+    filas por bloques. Si una tabla no cabe en una hoja, continúa en
+    "<hoja>_2", "<hoja>_3"... repitiendo el encabezado; los IDs (ID Cabecera,
+    ID Posicion) se escriben tal cual, por lo que siguen siendo correlativos.
+    """
+    wb = Workbook(write_only=True)
+    filas_por_hoja = max_filas - 1
+
+    for nombre, df in hojas.items():
+        encabezado = [str(col) for col in df.columns]
+        ws = None
+        parte = 0
+        filas_en_hoja = filas_por_hoja
+
+        for inicio in range(0, max(len(df), 1), tamano_bloque):
+            bloque = df.iloc[inicio:inicio + tamano_bloque]
+            for valores in bloque.itertuples(index=False, name=None):
+                if filas_en_hoja >= filas_por_hoja:
+                    parte += 1
+                    ws = wb.create_sheet(title=nombre if parte == 1 else f"{nombre}_{parte}")
+                    ws.append(encabezado)
+                    filas_en_hoja = 0
+                ws.append([_celda_tabla(ws, v) for v in valores])
+                filas_en_hoja += 1
+
+        if ws is None:
+            # Tabla vacía: se deja la hoja con solo el encabezado
+            ws = wb.create_sheet(title=nombre)
+            ws.append(encabezado)
+
+        if parte > 1:
+            logger.info("Tabla %s dividida en %d hojas por límite de filas de Excel", nombre, parte)
+
+    output = BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+def leer_hoja_picking(ruta, nombre):
+    """Lee una hoja del Picking ya unida con sus hojas de continuación."""
+    wb = load_workbook(ruta, read_only=True)
     try:
-        # 1. Cargar PROGRAMA
-        programa = pd.read_excel(rutas['programa'])
-        programa = separar_entregas_multiples(programa, "Entrega")
-        
-        if 'historico' in rutas and rutas['historico']:
-            excluidas = obtener_entregas_excluidas(rutas['historico'])
-            if excluidas:
-                st.info(f"Filtrando {len(excluidas)} entregas históricas...")
-                programa['Entrega_Str'] = programa['Entrega'].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
-                programa = programa[~programa['Entrega_Str'].isin(excluidas)].copy()
-                programa = programa.drop(columns=['Entrega_Str'])
-                if programa.empty:
-                    return False, "Todas las entregas del programa ya fueron procesadas en los históricos adjuntos.", []
+        hojas = [h for h in wb.sheetnames if h == nombre or h.startswith(f"{nombre}_")]
+    finally:
+        wb.close()
+    return hojas_con_continuacion(pd.read_excel(ruta, sheet_name=hojas), nombre)
+
+def leer_picking_cabecera(ruta):
+    return leer_hoja_picking(ruta, "Cabecera")
+
+def leer_picking_posicion(ruta):
+    return leer_hoja_picking(ruta, "Posicion")
+
+def hojas_con_continuacion(hojas, nombre):
+    """Une una hoja con sus hojas de continuación ("<hoja>_2", ...) si existen."""
+    partes = [hojas[nombre]]
+    n = 2
+    while f"{nombre}_{n}" in hojas:
+        partes.append(hojas[f"{nombre}_{n}"])
+        n += 1
+    return partes[0] if len(partes) == 1 else pd.concat(partes, ignore_index=True)
 
-        # 2. Cargar SALDOS
-        if 'saldos' in rutas and rutas['saldos']:
-            try:
-                saldos = pd.read_excel(rutas['saldos'])
-                saldos = separar_entregas_multiples(saldos, "Entrega")
-                st.success("Archivo Saldos cargado y normalizado.")
-            except Exception as e:
-                st.warning(f"Error leyendo Saldos: {e}. Continuando sin él.")
-                saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
-        else:
-            saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
+# ==========================================
+#   EXPORTACIÓN PLANA (CSV / PARQUET)
+# ==========================================
+FORMATOS_EXPORTACION = {"CSV": ".csv", "Parquet": ".parquet"}
 
-        # 3. Cargar DESPACHO
-        despacho = pd.read_excel(rutas['despacho'])
-        
-        # 4. Cargar DETALLE
-        detalle = pd.read_excel(rutas['detalle'])
-        
-        # 5. Cargar INFORME
-        consolidado = pd.read_excel(rutas['informe'])
-        
-        # 6. Cargar ZOOPP
-        ruta_zoopp = rutas['zoopp']
-        if ruta_zoopp.lower().endswith('.dbf'):
-            st.info("Detectado archivo DBF. Cargando con dbfread...")
-            try:
-                table = DBF(ruta_zoopp, encoding='latin-1', char_decode_errors='ignore')
-                zoopp = pd.DataFrame(iter(table))
-                zoopp.columns = [c.lower() for c in zoopp.columns]
-                mapeo_dbf = {
-                    "loteof": "loteof,C,10", "vollote": "vollote,C,15",
-                    "posped": "posped,N,6,0", "desmat": "desmat,C,40"
-                }
-                zoopp = zoopp.rename(columns=mapeo_dbf)
-            except Exception as e:
-                st.error(f"Error leyendo DBF: {e}")
-                raise e
+MIME_POR_EXTENSION = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+    ".parquet": "application/vnd.apache.parquet",
+}
+
+def mime_archivo(nombre):
+    return MIME_POR_EXTENSION.get(os.path.splitext(nombre)[1].lower(), "application/octet-stream")
+
+def _tabla_a_parquet(df, output):
+    try:
+        df.to_parquet(output, index=False)
+    except (TypeError, ValueError):
+        # Columnas con tipos mezclados (ej. Entrega numérica y texto): como texto
+        output.seek(0)
+        output.truncate()
+        mixtas = [c for c in df.columns if pd.api.types.is_object_dtype(df[c])]
+        df.astype({c: "string" for c in mixtas}).to_parquet(output, index=False)
+
+def exportar_tablas(tablas, formatos):
+    """
+    Escribe cada tabla lógica registrada (opciones["tablas"]) como CSV y/o
+    Parquet directamente desde el DataFrame, sin pasar por openpyxl. Las
+    tablas con hojas ({hoja: DataFrame}) generan un archivo por hoja.
+    CSV sale con ';' y coma decimal, igual que los extractos que se leen.
+    """
+    archivos = []
+    if not tablas or not formatos:
+        return archivos
+
+    planas = {}
+    for nombre, tabla in tablas.items():
+        if isinstance(tabla, dict):
+            for hoja, df in tabla.items():
+                planas[f"{nombre}_{hoja}"] = df
         else:
-            zoopp = pd.read_excel(rutas['zoopp'])
-
-        # --- RENOMBRAR COLUMNAS DESPACHO ---
-        mapa_columnas_despacho = {
-            "cor_ano": "COR_ANO,N,16,0", "cor_mov": "COR_MOV,N,16,0", "sigla": "SIGLA,C,4",
-            "numero": "NUMERO,N,16,0", "dv": "DV,C,1", "cliente": "CLIENTE,C,20",
-            "cod_puerto_destino": "COD_PUERTO,C,3", "puerto_destino": "PUERTO_DES,C,40",
-            "cod_puerto_descarga": "COD_PUERTO1,C,3", "puerto_descarga": "PUERTO_DES1,C,40",
-            "operacion": "OPERACION,N,16,0", "nave": "NAVE,C,40", "nro_reserva": "NRO_RESERV,C,15",
-            "orden_embarque": "ORDEN_EMBA,C,255", "contrato": "CONTRATO,C,50", "deposito": "DEPOSITO,C,15",
-            "fecha_despacho": "FECHA_DESP,D", "turno": "TURNO,N,16,0", "despachador": "DESPACHADO,C,100",
-            "status": "STATUS,C,1", "sello": "SELLO,C,15", "peso": "PESO,N,16,0", "fechaanula": "FECHAANULA,D",
-            "material": "MATERIAL,C,2", "des_fotos": "DES_FOTOS,C,25", "producto": "PRODUCTO,C,100",
-            "isocode": "ISOCODE,C,4", "linea_cnt": "LINEA_CNT,C,15", "cant_paquetes": "CANT_PAQUE,N,16,0",
-            "ite_volumen_d": "ITE_VOLUME,N,16,0", "terminal": "TERMINAL,C,100"
-        }
-        despacho = despacho.rename(columns=mapa_columnas_despacho)
+            planas[nombre] = tabla
+
+    for formato in formatos:
+        extension = FORMATOS_EXPORTACION[formato]
+        for nombre, df in planas.items():
+            output = BytesIO()
+            if extension == ".csv":
+                output.write(df.to_csv(index=False, sep=";", decimal=",").encode("utf-8-sig"))
+            else:
+                _tabla_a_parquet(df, output)
+            output.seek(0)
+            archivos.append((f"{nombre}{extension}", output))
+    return archivos
 
-        despacho = separar_entregas_multiples(despacho, "CONTRATO,C,50")
+def escribir_remate_madera(remate, datos, contenedores_con_sobrepeso):
+    """
+    Remate de Madera en una sola pasada: cabecera de plantilla, tabla desde la
+    fila 7 centrada, columnas 1-3 combinadas por Entrega y contenedores con
+    sobrepeso en rojo.
+    """
+    wb = nuevo_libro_plantilla("cabecera_remate_madera")
+    ws = wb.create_sheet(title="Sheet1")
+    renderizar_plantilla(ws, "cabecera_remate_madera", datos)
+    ws.append([_celda(ws, col, "remate_centro") for col in remate.columns])
+
+    columnas_a_fusionar = [0, 1, 2]
+    idx_contenedor = remate.columns.get_loc("Contenedor")
+    entrega = remate.iloc[:, 0]
+    tramo = (entrega != entrega.shift()).cumsum()
+    largo_tramo = tramo.map(tramo.value_counts())
+    inicio_tramo = (tramo != tramo.shift()).tolist()
+
+    fila_excel = 8
+    for valores, es_inicio, largo in zip(remate.itertuples(index=False, name=None), inicio_tramo, largo_tramo):
+        fila = []
+        for i, valor in enumerate(valores):
+            valor = _valor_excel(valor)
+            if i in columnas_a_fusionar and not es_inicio:
+                valor = None
+            estilo = "remate_centro"
+            if i == idx_contenedor and str(valor).strip() in contenedores_con_sobrepeso:
+                estilo = "remate_sobrepeso"
+            fila.append(_celda(ws, valor, estilo))
+        if es_inicio and largo > 1:
+            for col in columnas_a_fusionar:
+                letra = get_column_letter(col + 1)
+                ws.merged_cells.add(f"{letra}{fila_excel}:{letra}{fila_excel + largo - 1}")
+        ws.append(fila)
+        fila_excel += 1
+
+    return wb
 
-        # --- FILTRADO Y LÓGICA ---
-        saldos['Box Saldo'] = pd.to_numeric(saldos['Box Saldo'], errors='coerce')
-        
-        entregas_con_saldo = saldos.loc[saldos["Box Saldo"] != 0, "Entrega"].unique()
-        prog_filtrado = programa[
-            (~programa["Entrega"].isin(entregas_con_saldo)) & 
-            (programa["PRODINFO"].isin(["M.ASER.VERDE", "M.ASER. SECA", "M&B/SHOP","CLEARS","MDF MOLDURAS","MOLDURAS","BLANKS","SHOP","MOULDING&BETTER","M.PALL.SECA","M.PALL.VERDE","BASAS","AGLOMERADOS","MDF PANEL","PLYWOOD","TRUPAN","TABLERO","OSB","CHAPAS"]))
-        ].copy()
+# ==========================================
+#      LÓGICA DE MADERA (CORREGIDA)
+# ==========================================
+# ==========================================
+#   MADERA: CRUCE INFORME / PROGRAMA / ZOOPP
+# ==========================================
+def cruzar_resultado_madera(opciones, consolidado_filtrado, prog_filtrado, zoopp):
+    """
+    Cruza los paquetes del Informe con Zoopp (clase) y con el Programa, deja
+    los lotes con volumen válido y uno por Entrega/contenedor, y agrega VGM.
+    `zoopp` llega normalizado y único por lote.
+    """
+    consolidado_filtrado['CODIGO_BAR,C,50'] = (
+        consolidado_filtrado['CODIGO_BAR,C,50']
+        .astype(str)
+        .str.strip()
+    )
 
-        columnas_prog = ["Entrega", "Nave", "PRODINFO", "RESERVA", "DESTINO"]
-        prog_filtrado = prog_filtrado[columnas_prog]
-        
-        try:
-            nave_header = prog_filtrado["Nave"].dropna().iloc[0]
-        except:
-            nave_header = "SIN NAVE"
-
-        # Construir Contenedor Despacho
-        despacho['SIGLA,C,4'] = despacho['SIGLA,C,4'].astype(str).str.strip()
-        despacho['NUMERO,N,16,0'] = despacho['NUMERO,N,16,0'].astype(str).str.strip()
-        despacho['DV,C,1'] = despacho['DV,C,1'].astype(str).str.strip()
-
-        def construir_contenedor(row):
-            sigla = row['SIGLA,C,4']
-            numero = row['NUMERO,N,16,0'].zfill(6)
-            dv = row['DV,C,1']
-            return f"{sigla}-{numero}-{dv}"
-
-        def construir_NDESPACHO(row):
-            cor1 = row['COR_ANO,N,16,0']
-            cor2 = row['COR_MOV,N,16,0']
-            return f"{cor1}-{cor2}"
-
-        despacho['NDESPACHO'] = despacho.apply(construir_NDESPACHO, axis=1)
-        despacho['CONTENEDOR'] = despacho.apply(construir_contenedor, axis=1)
-
-        # Merge Programa - Despacho
-        prog_filtrado = prog_filtrado.merge(
-            despacho[["CONTENEDOR", "SELLO,C,15", "NDESPACHO", "CONTRATO,C,50", "PESO,N,16,0","NUMERO,N,16,0"]].rename(columns={"CONTRATO,C,50": "Entrega"}),
-            on="Entrega", how="inner"
-        )
+    consolidado_filtrado = cruzar(
+        opciones, "Informe x Zoopp (clase)", consolidado_filtrado,
+        zoopp[['loteof,C,10', 'clase_merc']],
+        left_on='CODIGO_BAR,C,50',
+        right_on='loteof,C,10',
+        how='left'
+    )
 
-        # Procesar Detalle
-        mapa_detalle = {
-            "ano": "ANO,N,16,0", "numero": "NUMERO,N,16,0", "fecha_consolidacion": "FECHA_CONS,D",
-            "turno": "TURNO,N,16,0", "linea": "LINEA,C,15", "operacion": "OPERACION,N,16,0",
-            "nave": "NAVE,C,47", "cliente": "CLIENTE,C,20", "embarcador": "EMBARCADOR,C,20",
-            "reserva": "RESERVA,C,30", "pedido": "PEDIDO,C,50", "producto": "PRODUCTO,C,100",
-            "agrupacion": "AGRUPACION,C,50", "fotos": "FOTOS,C,25", "pto_descarga": "PTO_DESCAR,C,40",
-            "pto_final": "PTO_FINAL,C,40", "isocode": "ISOCODE,C,4", "medida": "MEDIDA,N,16,0",
-            "sigla_cnt": "SIGLA_CNT,C,4", "contenedor": "CONTENEDOR,C,9", "tara": "TARA,N,16,0",
-            "neto": "NETO,N,16,0", "fardos": "FARDOS,N,16,0", "unidades": "UNIDADES,N,16,0",
-            "volumen": "VOLUMEN,N,17,4", "sello_linea": "SELLO_LINE,C,20", "sello_inspector": "SELLO_INSP,C,20",
-            "dus": "DUS,C,255", "inf_gate": "INF_GATE,C,50", "embarcado": "EMBARCADO,C,1",
-            "origen_carga": "ORIGEN_CAR,C,100", "deposito_origen": "DEPOSITO_O,C,20",
-            "deposito_destino": "DEPOSITO_D,C,20", "fecha_packing": "FECHA_PACK,D",
-            "cancelado": "CANCELADO,C,1", "observacion": "OBSERVACIO,C,255", "ind_aforo": "IND_AFORO,C,1",
-            "restriccion_peso": "RESTRICCIO,N,16,0", "cod_nro_cnt": "COD_NRO_CN,N,16,0",
-            "cod_dv_cnt": "COD_DV_CNT,C,1", "nro_despacho": "NRO_DESPAC,C,15", "peso_vgm": "PESO_VGM,N,17,2"
-        }
-        detalle = detalle.rename(columns=mapa_detalle)
-        detalle['SELLO_LINE,C,20'] = detalle['SELLO_LINE,C,20'].astype(str).str.strip()
-        detalle = detalle.drop_duplicates(subset=['SELLO_LINE,C,20'])
+    consolidado_filtrado.drop(columns=['loteof,C,10'], inplace=True)
 
-        prog_filtrado = prog_filtrado.merge(
-            detalle[['SELLO_LINE,C,20', 'SELLO_INSP,C,20', 'DUS,C,255', 'RESTRICCIO,N,16,0','FECHA_CONS,D']],
-            left_on='SELLO,C,15', right_on='SELLO_LINE,C,20', how='left'
-        )
-        prog_filtrado.drop(columns=['SELLO_LINE,C,20'], inplace=True)
-
-        # Procesar Informe (Consolidado)
-        mapa_consolidado = {
-            "operacion": "OPERACION,N,16,0", "nave": "NAVE,C,40", "linea": "LINEA,C,15",
-            "cliente": "CLIENTE,C,20", "proveedor": "PROVEEDOR,C,20", "cod_pto_destino": "COD_PTO_DE,C,3",
-            "pto_destino": "PTO_DESTIN,C,40", "contrato": "CONTRATO,C,50", "sigla_cnt": "SIGLA_CNT,C,4",
-            "nro_cnt": "NRO_CNT,N,16,0", "dv_cnt": "DV_CNT,C,1", "tara_cnt": "TARA_CNT,N,16,0",
-            "orden_embarque": "ORDEN_EMBA,C,255", "sello": "SELLO,C,15", "orden_pedido": "ORDEN_PEDI,C,12",
-            "codigo_barra": "CODIGO_BAR,C,50", "nro_paquete": "NRO_PAQUET,C,50", "material": "MATERIAL,C,50",
-            "marca": "MARCA,C,20", "volumen": "VOLUMEN,N,17,4", "unid_volumen": "UNID_VOLUM,C,4",
-            "espesor": "ESPESOR,N,17,4", "unid_espesor": "UNID_ESPES,C,4", "ancho": "ANCHO,N,17,4",
-            "unid_ancho": "UNID_ANCHO,C,4", "largo": "LARGO,N,17,4", "unid_largo": "UNID_LARGO,C,4",
-            "cant_piezas": "CANT_PIEZA,N,16,0", "peso": "PESO,N,17,4", "terminal": "TERMINAL,C,100",
-            "bodega": "BODEGA,C,15", "fila": "FILA,C,4", "columna": "COLUMNA,C,4", "reserva": "RESERVA,C,30",
-            "Cantidad_Pqts": "CANTIDAD_P,N,16,0","maxgross":"MAXGROSS"
-        }
-        consolidado = consolidado.rename(columns=mapa_consolidado)
-        if "MAXGROSS" not in consolidado.columns:
-            consolidado["MAXGROSS"] = 999999
-        consolidado['NRO_CNT,N,16,0'] = consolidado['NRO_CNT,N,16,0'].astype(str).str.strip()
-        consolidado['SIGLA_CNT,C,4'] = consolidado['SIGLA_CNT,C,4'].astype(str).str.strip()
-        consolidado['DV_CNT,C,1'] = consolidado['DV_CNT,C,1'].astype(str).str.strip()
-
-        def construir_contenedor_2(row):
-            sigla = row['SIGLA_CNT,C,4']
-            numero = row['NRO_CNT,N,16,0'].zfill(6)
-            dv = row['DV_CNT,C,1']
-            return f"{sigla}-{numero}-{dv}"
-
-        consolidado['CONTENEDOR_2'] = consolidado.apply(construir_contenedor_2, axis=1)
-        consolidado_filtrado = consolidado[
-            consolidado["CONTENEDOR_2"].isin(prog_filtrado["CONTENEDOR"])
-        ].copy()
-
-        columnas_consolidado = [
-            "CONTENEDOR_2", "TARA_CNT,N,16,0", "MATERIAL,C,50",
-            "CODIGO_BAR,C,50", "ORDEN_PEDI,C,12",
-            "PESO,N,17,4", "CONTRATO,C,50","MAXGROSS"
-        ]
-        consolidado_filtrado = consolidado_filtrado[columnas_consolidado]
-        zoopp['loteof,C,10'] = zoopp['loteof,C,10'].astype(str).str.strip()
-        zoopp['clase_merc'] = zoopp['clase_merc'].astype(str).str.strip()
-        zoopp = zoopp.drop_duplicates(subset=['loteof,C,10'])
-        consolidado_filtrado['CODIGO_BAR,C,50'] = (
-            consolidado_filtrado['CODIGO_BAR,C,50']
-            .astype(str)
-            .str.strip()
-        )
+    prog_filtrado['PRODINFO'] = prog_filtrado['PRODINFO'].astype(str).str.strip()
 
-        consolidado_filtrado = consolidado_filtrado.merge(
-            zoopp[['loteof,C,10', 'clase_merc']],
-            left_on='CODIGO_BAR,C,50',
-            right_on='loteof,C,10',
-            how='left'
-        )
+    resultado_final = cruzar(
+        opciones, "Informe x Programa", consolidado_filtrado,
+        prog_filtrado,
+        left_on=['CONTENEDOR_2', 'clase_merc'],
+        right_on=['CONTENEDOR', 'PRODINFO'],
+        how='left'
+    )
+    del consolidado_filtrado
+
+    resultado_final['CODIGO_BAR,C,50'] = resultado_final['CODIGO_BAR,C,50'].astype(str).str.strip()
+    resultado_filtrado_zoopp = resultado_final[resultado_final["CODIGO_BAR,C,50"].isin(zoopp["loteof,C,10"])]
+    registrar_etapa(opciones, "Resultado: lotes en Zoopp", "filtro", resultado_final, resultado_filtrado_zoopp)
+    resultado_filtrado_zoopp = cruzar(
+        opciones, "Resultado x Zoopp", resultado_filtrado_zoopp,
+        zoopp[['loteof,C,10', 'posped,N,6,0', 'desmat,C,40','vollote,C,15','clase_merc']],
+        left_on='CODIGO_BAR,C,50', right_on='loteof,C,10', how='left'
+    )
+    del resultado_final
 
-        consolidado_filtrado.drop(columns=['loteof,C,10'], inplace=True)
+    resultado_filtrado_zoopp["PESO,N,16,0"] = pd.to_numeric(resultado_filtrado_zoopp["PESO,N,16,0"], errors='coerce')
+    resultado_filtrado_zoopp["TARA_CNT,N,16,0"] = pd.to_numeric(resultado_filtrado_zoopp["TARA_CNT,N,16,0"], errors='coerce')
+    resultado_filtrado_zoopp["VGM"] = (resultado_filtrado_zoopp["PESO,N,16,0"].fillna(0) + resultado_filtrado_zoopp["TARA_CNT,N,16,0"].fillna(0))
+    resultado_filtrado_zoopp.drop(columns=["PESO,N,16,0"], inplace=True)
 
-        prog_filtrado['PRODINFO'] = prog_filtrado['PRODINFO'].astype(str).str.strip()
+    resultado_filtrado_zoopp["vollote,C,15"] = (
+        resultado_filtrado_zoopp["vollote,C,15"].astype(str).str.replace(",", ".", regex=False)
+    )
+    resultado_filtrado_zoopp["vollote,C,15"] = pd.to_numeric(resultado_filtrado_zoopp["vollote,C,15"], errors='coerce')
+    filas_previas = len(resultado_filtrado_zoopp)
+    resultado_filtrado_zoopp = resultado_filtrado_zoopp.dropna(subset=["vollote,C,15"])
+    registrar_etapa(opciones, "Resultado: volumen válido", "filtro", filas_previas, resultado_filtrado_zoopp)
+
+    filas_previas = len(resultado_filtrado_zoopp)
+    resultado_filtrado_zoopp = resultado_filtrado_zoopp.drop_duplicates(
+        subset=["loteof,C,10", "Entrega", "CONTENEDOR_2"],
+        keep="first"
+    )
+    registrar_etapa(opciones, "Resultado: lote único por entrega", "deduplicar", filas_previas, resultado_filtrado_zoopp)
+    return resultado_filtrado_zoopp
+
+# --- Modo incremental ---
+# Entregas que comparten contenedores forman un grupo (componente conexo
+# Entrega-Contenedor): todo cruce y agrupación posterior ocurre dentro de un
+# grupo, así que un grupo cuyas filas de Programa (ya con Despacho/Detalle)
+# e Informe no cambiaron da exactamente las mismas filas que la vez anterior.
+DIR_INCREMENTAL = os.path.join(DIR_DATOS, "incremental")
+
+def grupos_entrega_contenedor(entregas, contenedores):
+    """Devuelve {contenedor: grupo} uniendo Entregas que comparten contenedor."""
+    padre = {}
+
+    def raiz(nodo):
+        while padre.setdefault(nodo, nodo) != nodo:
+            padre[nodo] = padre[padre[nodo]]
+            nodo = padre[nodo]
+        return nodo
+
+    for entrega, contenedor in set(zip(entregas, contenedores)):
+        padre[raiz(("E", entrega))] = raiz(("C", contenedor))
+    return {nodo[1]: str(raiz(nodo)) for nodo in list(padre) if nodo[0] == "C"}
+
+def _firmas_por_grupo(df, grupos):
+    """Huella por grupo de las filas de `df`, en su orden."""
+    filas = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    indices = pd.Series(grupos.to_numpy()).groupby(grupos.to_numpy(), sort=False).indices
+    return {grupo: hashlib.sha1(filas[posiciones].tobytes()).hexdigest() for grupo, posiciones in indices.items()}
+
+def _ruta_estado_incremental(nave):
+    return os.path.join(DIR_INCREMENTAL, "madera_" + hashlib.sha1(str(nave).encode()).hexdigest()[:16])
+
+def cruzar_resultado_madera_incremental(opciones, consolidado_filtrado, prog_filtrado, zoopp, nave):
+    """
+    `cruzar_resultado_madera` recalculando solo los grupos de Entregas cuyas
+    entradas cambiaron desde la corrida anterior de la misma nave; el resto
+    se toma del estado guardado. La traza de los cruces cubre solo lo
+    recalculado.
+    """
+    grupo_de = grupos_entrega_contenedor(prog_filtrado["Entrega"], prog_filtrado["CONTENEDOR"])
+    grupos_prog = prog_filtrado["CONTENEDOR"].map(grupo_de)
+    grupos_informe = consolidado_filtrado["CONTENEDOR_2"].map(grupo_de)
+
+    base = json.dumps([
+        version_motor(opciones.get("motor", "pandas")), _huella_entrada(zoopp),
+        [str(c) for c in prog_filtrado.columns], [str(c) for c in consolidado_filtrado.columns],
+    ])
+    firmas_prog = _firmas_por_grupo(prog_filtrado, grupos_prog)
+    firmas_informe = _firmas_por_grupo(consolidado_filtrado, grupos_informe)
+    firma = {
+        grupo: hashlib.sha1((base + huella + firmas_informe.get(grupo, "")).encode()).hexdigest()
+        for grupo, huella in firmas_prog.items()
+    }
+
+    ruta_base = _ruta_estado_incremental(nave)
+    previo = None
+    for extension in ('.arrow', '.pkl'):
+        if os.path.exists(ruta_base + extension):
+            try:
+                previo = leer_guardada(ruta_base + extension)
+            except (OSError, ValueError) as e:
+                logger.warning("Estado incremental ilegible: %s", e)
+            break
+
+    reutilizado = None
+    if previo is not None:
+        reutilizado = previo[previo["__firma"].isin(set(firma.values()))]
+    vigentes = set() if reutilizado is None else set(reutilizado["__firma"])
+    pendientes = {grupo for grupo, f in firma.items() if f not in vigentes}
+
+    nuevo = cruzar_resultado_madera(
+        opciones,
+        consolidado_filtrado[grupos_informe.isin(pendientes)],
+        prog_filtrado[grupos_prog.isin(pendientes)],
+        zoopp,
+    )
+    nuevo["__firma"] = nuevo["CONTENEDOR_2"].map(grupo_de).map(firma)
+    if reutilizado is None or reutilizado.empty:
+        resultado = nuevo
+    elif nuevo.empty:
+        resultado = reutilizado
+    else:
+        resultado = pd.concat([reutilizado, nuevo], ignore_index=True)
+    st.info(f"Modo incremental: {len(pendientes)} de {len(firma)} grupos de entregas recalculados.")
 
-        resultado_final = consolidado_filtrado.merge(
-            prog_filtrado,
-            left_on=['CONTENEDOR_2', 'clase_merc'],
-            right_on=['CONTENEDOR', 'PRODINFO'],
-            how='left'
-        )
+    try:
+        os.makedirs(DIR_INCREMENTAL, exist_ok=True)
+        escrito = guardar_arrow(resultado, f"{ruta_base}.{os.getpid()}.tmp")
+        destino = ruta_base + os.path.splitext(escrito)[1]
+        os.replace(escrito, destino)
+        for extension in ('.arrow', '.pkl'):
+            if ruta_base + extension != destino and os.path.exists(ruta_base + extension):
+                os.remove(ruta_base + extension)
+    except OSError as e:
+        logger.warning("No se pudo guardar el estado incremental: %s", e)
+
+    return resultado.drop(columns="__firma")
+
+def leer_zoopp_dbf(ruta):
+    """ZOOPP en DBF, con columnas renombradas al formato de la exportación Excel."""
+    table = DBF(ruta, encoding='latin-1', char_decode_errors='ignore')
+    zoopp = pd.DataFrame(iter(table))
+    zoopp.columns = [c.lower() for c in zoopp.columns]
+    mapeo_dbf = {
+        "loteof": "loteof,C,10", "vollote": "vollote,C,15",
+        "posped": "posped,N,6,0", "desmat": "desmat,C,40"
+    }
+    return zoopp.rename(columns=mapeo_dbf)
+
+def cruce_madera(rutas, opciones, ahorro):
+    """
+    Lectura y cruce de Madera hasta las filas por lote/Entrega/contenedor
+    de las que salen Remate y Picking. Devuelve (filas, {"nave": ...}) o
+    (None, {"mensaje": ...}) si no queda nada por procesar.
+    """
+    def separar_entregas_multiples(df, col_entrega):
+        if col_entrega not in df.columns:
+            return df
+        
+        df[col_entrega] = df[col_entrega].astype(str)
+        df[col_entrega] = df[col_entrega].str.split('/')
+        df = df.explode(col_entrega)
+        df[col_entrega] = df[col_entrega].str.strip().str.replace(r'\.0$', '', regex=True)
+        return df
 
-        # Procesar ZOOPP
-        zoopp['loteof,C,10'] = zoopp['loteof,C,10'].astype(str).str.strip()
-        zoopp['vollote,C,15'] = zoopp['vollote,C,15'].astype(str).str.strip()
-        resultado_final['CODIGO_BAR,C,50'] = resultado_final['CODIGO_BAR,C,50'].astype(str).str.strip()
-        zoopp = zoopp.drop_duplicates(subset=['loteof,C,10'])
+    # 1. Cargar PROGRAMA (en lote multinave llega ya particionado en memoria)
+    programa = abrir_tabla(rutas['programa'])
+    programa = leer_referencia(rutas['programa']) if programa is None else programa.copy(deep=False)
+    filas_leidas = len(programa)
+    programa = separar_entregas_multiples(programa, "Entrega")
+    registrar_etapa(opciones, "Programa: separar entregas", "explode", filas_leidas, programa)
+    
+    if 'historico' in rutas and rutas['historico']:
+        excluidas = obtener_entregas_excluidas(rutas['historico'], opciones)
+        if excluidas:
+            st.info(f"Filtrando {len(excluidas)} entregas históricas...")
+            programa['Entrega_Str'] = programa['Entrega'].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+            filas_previas = len(programa)
+            programa = programa[~programa['Entrega_Str'].isin(excluidas)]
+            registrar_etapa(opciones, "Programa: excluir históricos", "filtro", filas_previas, programa)
+            programa = programa.drop(columns=['Entrega_Str'])
+            if programa.empty:
+                return None, {"mensaje": "Todas las entregas del programa ya fueron procesadas en los históricos adjuntos."}
+
+    # 2. Cargar SALDOS
+    if 'saldos' in rutas and rutas['saldos']:
+        try:
+            saldos = leer_referencia(rutas['saldos'])
+            saldos = separar_entregas_multiples(saldos, "Entrega")
+            st.success("Archivo Saldos cargado y normalizado.")
+        except Exception as e:
+            avisar(opciones, "warning", f"Error leyendo Saldos: {e}. Continuando sin él.")
+            saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
+    else:
+        saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
 
-        resultado_filtrado_zoopp = resultado_final[resultado_final["CODIGO_BAR,C,50"].isin(zoopp["loteof,C,10"])].copy()
-        resultado_filtrado_zoopp = resultado_filtrado_zoopp.merge(
-            zoopp[['loteof,C,10', 'posped,N,6,0', 'desmat,C,40','vollote,C,15','clase_merc']],
-            left_on='CODIGO_BAR,C,50', right_on='loteof,C,10', how='left'
+    # 3. Cargar DESPACHO
+    despacho = leer_referencia(rutas['despacho'])
+    
+    # 4. Cargar DETALLE
+    detalle = leer_referencia(rutas['detalle'])
+    
+    # 5. INFORME: se lee más abajo, solo con los contenedores del programa
+    
+    # 6. Cargar ZOOPP
+    ruta_zoopp = rutas['zoopp']
+    if ruta_zoopp.lower().endswith('.dbf'):
+        st.info("Detectado archivo DBF. Cargando con dbfread...")
+        try:
+            zoopp = leer_referencia(ruta_zoopp, lector=leer_zoopp_dbf)
+        except Exception as e:
+            st.error(f"Error leyendo DBF: {e}")
+            raise e
+    else:
+        zoopp = leer_referencia(rutas['zoopp'])
+    # Solo se usan estas columnas; mientras se recorre el Informe queda en disco
+    zoopp = bajar_a_disco(ahorro, zoopp[['loteof,C,10', 'clase_merc', 'posped,N,6,0', 'desmat,C,40', 'vollote,C,15']])
+
+    # --- RENOMBRAR COLUMNAS DESPACHO ---
+    mapa_columnas_despacho = {
+        "cor_ano": "COR_ANO,N,16,0", "cor_mov": "COR_MOV,N,16,0", "sigla": "SIGLA,C,4",
+        "numero": "NUMERO,N,16,0", "dv": "DV,C,1", "cliente": "CLIENTE,C,20",
+        "cod_puerto_destino": "COD_PUERTO,C,3", "puerto_destino": "PUERTO_DES,C,40",
+        "cod_puerto_descarga": "COD_PUERTO1,C,3", "puerto_descarga": "PUERTO_DES1,C,40",
+        "operacion": "OPERACION,N,16,0", "nave": "NAVE,C,40", "nro_reserva": "NRO_RESERV,C,15",
+        "orden_embarque": "ORDEN_EMBA,C,255", "contrato": "CONTRATO,C,50", "deposito": "DEPOSITO,C,15",
+        "fecha_despacho": "FECHA_DESP,D", "turno": "TURNO,N,16,0", "despachador": "DESPACHADO,C,100",
+        "status": "STATUS,C,1", "sello": "SELLO,C,15", "peso": "PESO,N,16,0", "fechaanula": "FECHAANULA,D",
+        "material": "MATERIAL,C,2", "des_fotos": "DES_FOTOS,C,25", "producto": "PRODUCTO,C,100",
+        "isocode": "ISOCODE,C,4", "linea_cnt": "LINEA_CNT,C,15", "cant_paquetes": "CANT_PAQUE,N,16,0",
+        "ite_volumen_d": "ITE_VOLUME,N,16,0", "terminal": "TERMINAL,C,100"
+    }
+    despacho = despacho.rename(columns=mapa_columnas_despacho)
+
+    despacho = separar_entregas_multiples(despacho, "CONTRATO,C,50")
+
+    # --- FILTRADO Y LÓGICA ---
+    saldos['Box Saldo'] = pd.to_numeric(saldos['Box Saldo'], errors='coerce')
+    
+    entregas_con_saldo = saldos.loc[saldos["Box Saldo"] != 0, "Entrega"].unique()
+    prog_filtrado = programa[
+        (~programa["Entrega"].isin(entregas_con_saldo)) & 
+        (programa["PRODINFO"].isin(["M.ASER.VERDE", "M.ASER. SECA", "M&B/SHOP","CLEARS","MDF MOLDURAS","MOLDURAS","BLANKS","SHOP","MOULDING&BETTER","M.PALL.SECA","M.PALL.VERDE","BASAS","AGLOMERADOS","MDF PANEL","PLYWOOD","TRUPAN","TABLERO","OSB","CHAPAS"]))
+    ]
+    registrar_etapa(opciones, "Programa: saldo y PRODINFO", "filtro", programa, prog_filtrado)
+
+    columnas_prog = ["Entrega", "Nave", "PRODINFO", "RESERVA", "DESTINO"]
+    prog_filtrado = prog_filtrado[columnas_prog]
+    del programa, saldos
+    
+    try:
+        nave_header = prog_filtrado["Nave"].dropna().iloc[0]
+    except:
+        nave_header = "SIN NAVE"
+
+    # Construir Contenedor Despacho
+    despacho['SIGLA,C,4'] = despacho['SIGLA,C,4'].astype(str).str.strip()
+    despacho['NUMERO,N,16,0'] = despacho['NUMERO,N,16,0'].astype(str).str.strip()
+    despacho['DV,C,1'] = despacho['DV,C,1'].astype(str).str.strip()
+
+    def construir_contenedor(row):
+        sigla = row['SIGLA,C,4']
+        numero = row['NUMERO,N,16,0'].zfill(6)
+        dv = row['DV,C,1']
+        return f"{sigla}-{numero}-{dv}"
+
+    def construir_NDESPACHO(row):
+        cor1 = row['COR_ANO,N,16,0']
+        cor2 = row['COR_MOV,N,16,0']
+        return f"{cor1}-{cor2}"
+
+    despacho['NDESPACHO'] = despacho.apply(construir_NDESPACHO, axis=1)
+    despacho['CONTENEDOR'] = despacho.apply(construir_contenedor, axis=1)
+
+    # Merge Programa - Despacho
+    prog_filtrado = cruzar(
+        opciones, "Programa x Despacho", prog_filtrado,
+        despacho[["CONTENEDOR", "SELLO,C,15", "NDESPACHO", "CONTRATO,C,50", "PESO,N,16,0","NUMERO,N,16,0"]].rename(columns={"CONTRATO,C,50": "Entrega"}),
+        on="Entrega", how="inner"
+    )
+    del despacho
+
+    # Procesar Detalle
+    mapa_detalle = {
+        "ano": "ANO,N,16,0", "numero": "NUMERO,N,16,0", "fecha_consolidacion": "FECHA_CONS,D",
+        "turno": "TURNO,N,16,0", "linea": "LINEA,C,15", "operacion": "OPERACION,N,16,0",
+        "nave": "NAVE,C,47", "cliente": "CLIENTE,C,20", "embarcador": "EMBARCADOR,C,20",
+        "reserva": "RESERVA,C,30", "pedido": "PEDIDO,C,50", "producto": "PRODUCTO,C,100",
+        "agrupacion": "AGRUPACION,C,50", "fotos": "FOTOS,C,25", "pto_descarga": "PTO_DESCAR,C,40",
+        "pto_final": "PTO_FINAL,C,40", "isocode": "ISOCODE,C,4", "medida": "MEDIDA,N,16,0",
+        "sigla_cnt": "SIGLA_CNT,C,4", "contenedor": "CONTENEDOR,C,9", "tara": "TARA,N,16,0",
+        "neto": "NETO,N,16,0", "fardos": "FARDOS,N,16,0", "unidades": "UNIDADES,N,16,0",
+        "volumen": "VOLUMEN,N,17,4", "sello_linea": "SELLO_LINE,C,20", "sello_inspector": "SELLO_INSP,C,20",
+        "dus": "DUS,C,255", "inf_gate": "INF_GATE,C,50", "embarcado": "EMBARCADO,C,1",
+        "origen_carga": "ORIGEN_CAR,C,100", "deposito_origen": "DEPOSITO_O,C,20",
+        "deposito_destino": "DEPOSITO_D,C,20", "fecha_packing": "FECHA_PACK,D",
+        "cancelado": "CANCELADO,C,1", "observacion": "OBSERVACIO,C,255", "ind_aforo": "IND_AFORO,C,1",
+        "restriccion_peso": "RESTRICCIO,N,16,0", "cod_nro_cnt": "COD_NRO_CN,N,16,0",
+        "cod_dv_cnt": "COD_DV_CNT,C,1", "nro_despacho": "NRO_DESPAC,C,15", "peso_vgm": "PESO_VGM,N,17,2"
+    }
+    detalle = detalle.rename(columns=mapa_detalle)
+    detalle['SELLO_LINE,C,20'] = detalle['SELLO_LINE,C,20'].astype(str).str.strip()
+    filas_detalle = len(detalle)
+    detalle = detalle.drop_duplicates(subset=['SELLO_LINE,C,20'])
+    registrar_etapa(opciones, "Detalle: único por sello", "deduplicar", filas_detalle, detalle)
+
+    prog_filtrado = cruzar(
+        opciones, "Programa x Detalle", prog_filtrado,
+        detalle[['SELLO_LINE,C,20', 'SELLO_INSP,C,20', 'DUS,C,255', 'RESTRICCIO,N,16,0','FECHA_CONS,D']],
+        left_on='SELLO,C,15', right_on='SELLO_LINE,C,20', how='left'
+    )
+    prog_filtrado.drop(columns=['SELLO_LINE,C,20'], inplace=True)
+    del detalle
+    liberar_memoria(ahorro)
+
+    # Procesar Informe (Consolidado)
+    mapa_consolidado = {
+        "operacion": "OPERACION,N,16,0", "nave": "NAVE,C,40", "linea": "LINEA,C,15",
+        "cliente": "CLIENTE,C,20", "proveedor": "PROVEEDOR,C,20", "cod_pto_destino": "COD_PTO_DE,C,3",
+        "pto_destino": "PTO_DESTIN,C,40", "contrato": "CONTRATO,C,50", "sigla_cnt": "SIGLA_CNT,C,4",
+        "nro_cnt": "NRO_CNT,N,16,0", "dv_cnt": "DV_CNT,C,1", "tara_cnt": "TARA_CNT,N,16,0",
+        "orden_embarque": "ORDEN_EMBA,C,255", "sello": "SELLO,C,15", "orden_pedido": "ORDEN_PEDI,C,12",
+        "codigo_barra": "CODIGO_BAR,C,50", "nro_paquete": "NRO_PAQUET,C,50", "material": "MATERIAL,C,50",
+        "marca": "MARCA,C,20", "volumen": "VOLUMEN,N,17,4", "unid_volumen": "UNID_VOLUM,C,4",
+        "espesor": "ESPESOR,N,17,4", "unid_espesor": "UNID_ESPES,C,4", "ancho": "ANCHO,N,17,4",
+        "unid_ancho": "UNID_ANCHO,C,4", "largo": "LARGO,N,17,4", "unid_largo": "UNID_LARGO,C,4",
+        "cant_piezas": "CANT_PIEZA,N,16,0", "peso": "PESO,N,17,4", "terminal": "TERMINAL,C,100",
+        "bodega": "BODEGA,C,15", "fila": "FILA,C,4", "columna": "COLUMNA,C,4", "reserva": "RESERVA,C,30",
+        "Cantidad_Pqts": "CANTIDAD_P,N,16,0","maxgross":"MAXGROSS"
+    }
+    columnas_consolidado = [
+        "CONTENEDOR_2", "TARA_CNT,N,16,0", "MATERIAL,C,50",
+        "CODIGO_BAR,C,50", "ORDEN_PEDI,C,12",
+        "PESO,N,17,4", "CONTRATO,C,50","MAXGROSS"
+    ]
+
+    # El Informe (una fila por paquete) se recorre conservando solo filas
+    # cuyo número de contenedor está en el programa y solo las columnas
+    # usadas; el filtro exacto por CONTENEDOR_2 se mantiene abajo
+    nombres_originales = {v: k for k, v in mapa_consolidado.items()}
+    necesarias = ["SIGLA_CNT,C,4", "NRO_CNT,N,16,0", "DV_CNT,C,1"] + columnas_consolidado[1:]
+    numeros_programa = prog_filtrado["CONTENEDOR"].str.split("-").str[1].dropna().unique()
+    filtro_informe = [(("nro_cnt", "NRO_CNT,N,16,0"), numeros_programa, llave_numero)]
+    columnas_informe = set(necesarias) | {nombres_originales[c] for c in necesarias if c in nombres_originales}
+    # En Madera por partición llega ya leído y recortado a la parte
+    informe = abrir_tabla(rutas['informe'])
+    if informe is None:
+        consolidado, filas_informe = leer_referencia_filtrada(rutas['informe'], filtro_informe, columnas_informe)
+    else:
+        consolidado, filas_informe = filtrar_tabla(informe, filtro_informe, columnas_informe)
+        del informe
+
+    consolidado = consolidado.rename(columns=mapa_consolidado)
+    if "MAXGROSS" not in consolidado.columns:
+        consolidado["MAXGROSS"] = 999999
+    consolidado['NRO_CNT,N,16,0'] = consolidado['NRO_CNT,N,16,0'].astype(str).str.strip()
+    consolidado['SIGLA_CNT,C,4'] = consolidado['SIGLA_CNT,C,4'].astype(str).str.strip()
+    consolidado['DV_CNT,C,1'] = consolidado['DV_CNT,C,1'].astype(str).str.strip()
+
+    def construir_contenedor_2(row):
+        sigla = row['SIGLA_CNT,C,4']
+        numero = row['NRO_CNT,N,16,0'].zfill(6)
+        dv = row['DV_CNT,C,1']
+        return f"{sigla}-{numero}-{dv}"
+
+    consolidado['CONTENEDOR_2'] = consolidado.apply(construir_contenedor_2, axis=1)
+    consolidado_filtrado = consolidado[
+        consolidado["CONTENEDOR_2"].isin(prog_filtrado["CONTENEDOR"])
+    ]
+    registrar_etapa(opciones, "Informe: contenedores del programa", "filtro", filas_informe, consolidado_filtrado)
+
+    consolidado_filtrado = consolidado_filtrado[columnas_consolidado]
+    del consolidado
+    liberar_memoria(ahorro)
+    zoopp = subir_de_disco(zoopp)
+    zoopp['loteof,C,10'] = zoopp['loteof,C,10'].astype(str).str.strip()
+    zoopp['clase_merc'] = zoopp['clase_merc'].astype(str).str.strip()
+    zoopp['vollote,C,15'] = zoopp['vollote,C,15'].astype(str).str.strip()
+    filas_zoopp = len(zoopp)
+    zoopp = zoopp.drop_duplicates(subset=['loteof,C,10'])
+    registrar_etapa(opciones, "Zoopp: único por lote", "deduplicar", filas_zoopp, zoopp)
+
+    if opciones is not None and opciones.get("incremental"):
+        resultado_filtrado_zoopp = cruzar_resultado_madera_incremental(
+            opciones, consolidado_filtrado, prog_filtrado, zoopp, nave_header
         )
+    else:
+        resultado_filtrado_zoopp = cruzar_resultado_madera(opciones, consolidado_filtrado, prog_filtrado, zoopp)
+    del consolidado_filtrado, prog_filtrado, zoopp
+    liberar_memoria(ahorro)
 
-        resultado_filtrado_zoopp["PESO,N,16,0"] = pd.to_numeric(resultado_filtrado_zoopp["PESO,N,16,0"], errors='coerce')
-        resultado_filtrado_zoopp["TARA_CNT,N,16,0"] = pd.to_numeric(resultado_filtrado_zoopp["TARA_CNT,N,16,0"], errors='coerce')
-        resultado_filtrado_zoopp["VGM"] = (resultado_filtrado_zoopp["PESO,N,16,0"].fillna(0) + resultado_filtrado_zoopp["TARA_CNT,N,16,0"].fillna(0))
-        resultado_filtrado_zoopp.drop(columns=["PESO,N,16,0"], inplace=True)
+    return resultado_filtrado_zoopp, {"nave": nave_header}
 
-        resultado_filtrado_zoopp["vollote,C,15"] = (
-            resultado_filtrado_zoopp["vollote,C,15"].astype(str).str.replace(",", ".", regex=False)
-        )
-        resultado_filtrado_zoopp["vollote,C,15"] = pd.to_numeric(resultado_filtrado_zoopp["vollote,C,15"], errors='coerce')
-        resultado_filtrado_zoopp = resultado_filtrado_zoopp.dropna(subset=["vollote,C,15"])
-        
-        resultado_filtrado_zoopp = resultado_filtrado_zoopp.drop_duplicates(
-            subset=["loteof,C,10", "Entrega", "CONTENEDOR_2"], 
-            keep="first"
+def procesar_madera(rutas, opciones=None):
+    """
+    1. Separa entregas compuestas (ej: "A / B" -> fila A, fila B).
+    2. Agrupa por Producto para respetar pesos/volúmenes.
+    3. Genera cabecera personalizada en Remate.
+    Si se entrega `opciones`, deja el Remate SAG y el Picking como tablas en
+    memoria para encadenar directamente con SAG. Con entradas grandes corre
+    en modo bajo consumo (ver `modo_bajo_consumo`).
+    """
+    if opciones is not None and opciones.get("particion"):
+        return procesar_madera_por_particion(rutas, opciones)
+
+    st.info("Iniciando procesamiento de Madera...")
+    ahorro = modo_bajo_consumo(opciones, rutas)
+    if ahorro:
+        st.info("Entradas grandes: modo bajo consumo de memoria activado.")
+
+    try:
+        # Lectura y cruce como punto de control: si falla una etapa posterior,
+        # la siguiente corrida con los mismos archivos retoma desde aquí
+        resultado_filtrado_zoopp, meta = etapa_guardada(
+            opciones, "Madera: cruce", rutas, lambda: cruce_madera(rutas, opciones, ahorro)
         )
+        if resultado_filtrado_zoopp is None:
+            return False, meta["mensaje"], []
+        nave_header = meta["nave"]
 
         # =========================================================================
         # --- GENERAR REMATE 
@@ -421,6 +1937,7 @@ def procesar_madera(rutas):
             }).reset_index()
         )
         
+        registrar_etapa(opciones, "Remate: por contenedor/entrega/producto", "agrupación", resultado_filtrado_zoopp, remate)
         remate["PESO_BRUTO_TOTAL"] = remate["PESO,N,17,4"] + remate["TARA_CNT,N,16,0"]
         contenedores_con_sobrepeso = set(
             remate[remate["PESO_BRUTO_TOTAL"] >= remate["MAXGROSS"]]["CONTENEDOR"].unique()
@@ -445,60 +1962,7 @@ def procesar_madera(rutas):
         ]]
         remate = remate.sort_values(by=["Entrega", "Contenedor"])
         
-        # Crear archivo en memoria
-        output = BytesIO()
-        remate.to_excel(output, index=False, startrow=6, engine='openpyxl')
-        
-        wb = load_workbook(output)
-        ws = wb.active
-        
-        fecha_hoy = datetime.datetime.now().strftime("%d/%m/%Y")
-        
-        ws['A1'] = "INFORME  DE CONTENEDORES CONSOLIDADOS PARA EMBARQUE"
-        ws['A3'] = "SAN VICENTE TERMINAL INTERNACIONAL"
-        ws['A4'] = f"FECHA: {fecha_hoy}"
-        ws['A5'] = f"NAVE: {nave_header}"
-        
-        bold_font = Font(bold=True)
-        ws['A1'].font = bold_font
-        ws['A3'].font = bold_font
-        ws['A5'].font = bold_font
-        ws['A1'].alignment = Alignment(horizontal="left")
-        ws['A3'].alignment = Alignment(horizontal="left")
-        ws['A4'].alignment = Alignment(horizontal="left")
-        ws['A5'].alignment = Alignment(horizontal="left")
-
-        columnas_a_fusionar = [1, 2, 3]  
-        start_row = 8 
-        
-        if ws.max_row >= start_row:
-            current_value = ws.cell(row=start_row, column=1).value
-            merge_start = start_row
-
-            for row in range(start_row + 1, ws.max_row + 1):
-                value = ws.cell(row=row, column=1).value
-                if value != current_value:
-                    if merge_start != row - 1:
-                        for col in columnas_a_fusionar:
-                            ws.merge_cells(start_row=merge_start, start_column=col, end_row=row - 1, end_column=col)
-                    current_value = value
-                    merge_start = row
-            if merge_start != ws.max_row:
-                for col in columnas_a_fusionar:
-                    ws.merge_cells(start_row=merge_start, start_column=col, end_row=ws.max_row, end_column=col)
-
-        rojo_fill = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
-        alignment_center = Alignment(horizontal="center", vertical="center")
-        
-        for row in ws.iter_rows(min_row=7):
-            celda_contenedor = row[4]
-            valor_contenedor = str(celda_contenedor.value).strip()
-            
-            if valor_contenedor in contenedores_con_sobrepeso:
-                celda_contenedor.fill = rojo_fill
-                
-            for cell in row:
-                cell.alignment = alignment_center
+        wb = escribir_remate_madera(remate, {"fecha": fecha_reporte(opciones), "nave": nave_header}, contenedores_con_sobrepeso)
         
         remate_output = BytesIO()
         wb.save(remate_output)
@@ -518,6 +1982,8 @@ def procesar_madera(rutas):
             }).reset_index()
         )
 
+        registrar_etapa(opciones, "Remate SAG: por contenedor/entrega", "agrupación", resultado_filtrado_zoopp, remate_sag)
+
         remate_sag = remate_sag.rename(columns={
             "CONTENEDOR": "Contenedor",
             "Entrega": "Entrega",
@@ -560,6 +2026,8 @@ def procesar_madera(rutas):
             }).reset_index()
         )
 
+        registrar_etapa(opciones, "Picking: cabeceras", "agrupación", resultado_filtrado_zoopp, picking_cabecera)
+
         picking_cabecera = picking_cabecera.rename(columns={
             "SELLO,C,15": "Sello", "RESERVA": "Reserva", "DUS,C,255": "DUS",
             "PESO,N,17,4": "Peso Bruto (kg)", "TARA_CNT,N,16,0": "Tara (kg)", "FECHA_CONS,D": "Fecha Contable","Entrega":"Entrega"
@@ -590,7 +2058,8 @@ def procesar_madera(rutas):
         picking_cabecera = picking_cabecera[cols_pick]
 
         # Tabla POSICION (Original)
-        posicion = resultado_filtrado_zoopp.merge(
+        posicion = cruzar(
+            opciones, "Picking: posiciones x cabecera", resultado_filtrado_zoopp,
             picking_cabecera[['ID Cabecera', 'ID Contenedor', 'Entrega']],
             left_on=['CONTENEDOR', 'Entrega'],
             right_on=['ID Contenedor', 'Entrega'],
@@ -605,11 +2074,7 @@ def procesar_madera(rutas):
         posicion = posicion[['ID Cabecera', 'ID Posicion', 'Lote', 'Cantidad', 'Unidad', 'Peso']]
         posicion = posicion.sort_values(by=["ID Cabecera", "ID Posicion"]).reset_index(drop=True)
 
-        picking_output = BytesIO()
-        with pd.ExcelWriter(picking_output, engine="openpyxl") as writer:
-            picking_cabecera.to_excel(writer, sheet_name="Cabecera", index=False)
-            posicion.to_excel(writer, sheet_name="Posicion", index=False)
-        picking_output.seek(0)
+        picking_output = escribir_tablas_excel({"Cabecera": picking_cabecera, "Posicion": posicion})
 
         # =========================================================================
         # --- GENERAR PICKING NUEVO ---
@@ -673,7 +2138,8 @@ def procesar_madera(rutas):
         picking_cabecera_nuevo = picking_cabecera_nuevo[cols_pick_nuevo]
 
         # Tabla POSICION (Nuevo)
-        posicion_nuevo = resultado_filtrado_zoopp.merge(
+        posicion_nuevo = cruzar(
+            opciones, "Picking Nuevo: posiciones x cabecera", resultado_filtrado_zoopp,
             picking_cabecera_nuevo[['ID Cabecera', 'ID Contenedor', 'Entrega']],
             left_on=['CONTENEDOR', 'Entrega'],
             right_on=['ID Contenedor', 'Entrega'],
@@ -692,11 +2158,14 @@ def procesar_madera(rutas):
         posicion_nuevo = posicion_nuevo[['ID Cabecera', 'ID Posicion', 'Lote', 'Cantidad', 'Unidad', 'Peso', 'BOX']]
         posicion_nuevo = posicion_nuevo.sort_values(by=["ID Cabecera", "ID Posicion"]).reset_index(drop=True)
 
-        picking_nuevo_output = BytesIO()
-        with pd.ExcelWriter(picking_nuevo_output, engine="openpyxl") as writer:
-            picking_cabecera_nuevo.to_excel(writer, sheet_name="Cabecera", index=False)
-            posicion_nuevo.to_excel(writer, sheet_name="Posicion", index=False)
-        picking_nuevo_output.seek(0)
+        picking_nuevo_output = escribir_tablas_excel({"Cabecera": picking_cabecera_nuevo, "Posicion": posicion_nuevo})
+
+        registrar_tablas(opciones, {
+            "RemateMadera": remate,
+            "RemateMaderaSAG": remate_sag,
+            "Picking": {"Cabecera": picking_cabecera, "Posicion": posicion},
+            "Picking_Nuevo": {"Cabecera": picking_cabecera_nuevo, "Posicion": posicion_nuevo},
+        })
 
         # RETORNAMOS LOS 4 ARCHIVOS EN EL ARREGLO FINAL
         return True, "Proceso completado exitosamente", [
@@ -712,18 +2181,147 @@ def procesar_madera(rutas):
         traceback.print_exc()
         return False, str(e), []
 
+# ==========================================
+#   LOTE MULTINAVE (MADERA)
+# ==========================================
+# Un Programa con varias naves (o reservas) se parte y cada parte corre
+# procesar_madera en su propio proceso. Despacho, Detalle, Saldos y Zoopp
+# se parsean una vez antes de repartir (caché compartida) y cada parte
+# entrega su propio juego de archivos.
+PARTICIONES_MADERA = {"Nave": "Nave", "Reserva": "RESERVA"}
+
+def nombre_particion(valor):
+    """Valor de Nave/Reserva apto para nombre de archivo."""
+    texto = re.sub(r'[^0-9A-Za-z]+', '_', str(valor).strip()).strip('_')
+    return texto or "SIN_NOMBRE"
+
+def _procesar_particion(rutas, opciones):
+    exito, mensaje, archivos = procesar_madera(rutas, opciones)
+    return exito, mensaje, archivos, opciones
+
+def repartir_informe(rutas, partes):
+    """
+    Lee el Informe una sola vez, filtrado por los contenedores que Despacho
+    asigna a las Entregas de todas las partes, y devuelve {parte: filas de
+    sus contenedores}. Cada parte recibe un superconjunto de lo que su cruce
+    usa. Si Despacho no trae contrato y número, devuelve {} y cada parte
+    lee el Informe por su cuenta.
+    """
+    despacho = leer_referencia(rutas['despacho']).rename(
+        columns={"contrato": "CONTRATO,C,50", "numero": "NUMERO,N,16,0"}
+    )
+    if not {"CONTRATO,C,50", "NUMERO,N,16,0"} <= set(despacho.columns):
+        return {}
+    # Entrega -> números de contenedor, con las mismas llaves del prefiltro
+    despacho = despacho[["CONTRATO,C,50", "NUMERO,N,16,0"]].copy()
+    despacho["CONTRATO,C,50"] = despacho["CONTRATO,C,50"].astype(str).str.split('/')
+    despacho = despacho.explode("CONTRATO,C,50")
+    entregas_despacho = mapear_valores_unicos(despacho["CONTRATO,C,50"], llave_texto)
+    numeros_despacho = mapear_valores_unicos(despacho["NUMERO,N,16,0"], llave_numero)
+
+    numeros_partes = {}
+    for nombre, parte in partes.items():
+        entregas = {
+            llave_texto(entrega)
+            for valor in parte["Entrega"].astype(str) for entrega in valor.split('/')
+        } if "Entrega" in parte.columns else set()
+        numeros_partes[nombre] = set(numeros_despacho[entregas_despacho.isin(entregas)])
+
+    alternativas = ("nro_cnt", "NRO_CNT,N,16,0")
+    todos = set().union(*numeros_partes.values())
+    informe, _ = leer_referencia_filtrada(rutas['informe'], [(alternativas, todos, llave_numero)])
+    return {
+        nombre: filtrar_tabla(informe, [(alternativas, numeros, llave_numero)])[0]
+        for nombre, numeros in numeros_partes.items()
+    }
+
+def procesar_madera_por_particion(rutas, opciones):
+    """
+    Corre Madera por cada valor de la columna de partición del Programa
+    (opciones["particion"]: "Nave" o "Reserva") en paralelo. Los archivos y
+    tablas de cada parte llevan el nombre de la parte como prefijo.
+    """
+    columna = PARTICIONES_MADERA[opciones["particion"]]
+    st.info(f"Iniciando Madera por {opciones['particion'].lower()}...")
+    try:
+        programa = leer_referencia(rutas['programa'])
+        if columna not in programa.columns:
+            return False, f"El Programa no tiene la columna '{columna}' para separar.", []
+        # Se agrupa por el valor original; el nombre saneado es solo para los
+        # archivos y se desambigua si dos valores distintos sanean igual
+        partes = {}
+        usados = set()
+        for valor, parte in programa.groupby(columna, dropna=False, sort=False):
+            nombre = nombre_particion(valor) if pd.notna(valor) else f"SIN_{columna.upper()}"
+            base, n = nombre, 1
+            while nombre in usados:
+                n += 1
+                nombre = f"{base}_{n}"
+            usados.add(nombre)
+            partes[nombre] = parte
+
+        # Entradas comunes parseadas una vez: quedan en la caché en disco, que
+        # los procesos hijos leen sin volver a parsear Excel
+        for slot in ('despacho', 'detalle', 'saldos'):
+            if rutas.get(slot):
+                leer_referencia(rutas[slot])
+        if rutas['zoopp'].lower().endswith('.dbf'):
+            leer_referencia(rutas['zoopp'], lector=leer_zoopp_dbf)
+        else:
+            leer_referencia(rutas['zoopp'])
+        informes = repartir_informe(rutas, partes)
+        # Se decide con los archivos completos: las partes reciben Programa
+        # e Informe ya en memoria, que tamano_entradas no cuenta
+        modo_bajo_consumo(opciones, rutas)
+
+        claves_opciones = ("motor", "incremental", "fecha_reporte", "bajo_consumo")
+        tareas = {}
+        with crear_pool_procesos(min(len(partes), os.cpu_count() or 1)) as pool:
+            for nombre, parte in partes.items():
+                opciones_parte = {k: opciones[k] for k in claves_opciones if k in opciones}
+                opciones_parte["traza"] = []
+                rutas_parte = dict(rutas, programa=parte)
+                if nombre in informes:
+                    rutas_parte["informe"] = informes[nombre]
+                tareas[nombre] = pool.submit(_procesar_particion, rutas_parte, opciones_parte)
+            resultados = {nombre: tarea.result() for nombre, tarea in tareas.items()}
+    except Exception as e:
+        st.error(f"Error en procesamiento: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False, str(e), []
+
+    archivos = []
+    errores = []
+    for nombre, (exito, mensaje, archivos_parte, opciones_parte) in resultados.items():
+        for nivel, texto in opciones_parte.get("avisos", []):
+            avisar(opciones, nivel, f"[{nombre}] {texto}")
+        if not exito:
+            errores.append(f"{nombre}: {mensaje}")
+            continue
+        archivos += [(f"{nombre}_{archivo}", contenido) for archivo, contenido in archivos_parte]
+        registrar_tablas(opciones, {f"{nombre}_{t}": tabla for t, tabla in (opciones_parte.get("tablas") or {}).items()})
+        if "traza" in opciones:
+            opciones["traza"] += [dict(r, Etapa=f"[{nombre}] {r['Etapa']}") for r in opciones_parte.get("traza", [])]
+
+    if not archivos:
+        return False, "Ninguna parte se pudo procesar:\n- " + "\n- ".join(errores), []
+    mensaje = f"Proceso completado para {len(resultados) - len(errores)} de {len(resultados)} partes ({opciones['particion'].lower()})."
+    if errores:
+        mensaje += " Sin procesar:\n- " + "\n- ".join(errores)
+    return True, mensaje, archivos
+
 # ==========================================
 #      LÓGICA DE Celulosa BKP EKP UKP
 # ==========================================
-def procesar_celulosa_cb(rutas):
+def procesar_celulosa_cb(rutas, opciones=None):
     st.info("Iniciando procesamiento de Celulosa BKP EKP UKP...")
     try:
-        programa = pd.read_excel(rutas['programa'])
-        tools_celulosa = pd.read_excel(rutas['tools'])
+        programa = leer_tabla(rutas['programa'])
 
         if 'saldos' in rutas and rutas['saldos']:
             try:
-                saldos = pd.read_excel(rutas['saldos'])
+                saldos = leer_tabla(rutas['saldos'])
                 st.success("Saldos cargado.")
             except:
                 saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
@@ -735,10 +2333,10 @@ def procesar_celulosa_cb(rutas):
         saldos['Box Saldo'] = pd.to_numeric(saldos['Box Saldo'], errors='coerce')
         
         if 'historico' in rutas and rutas['historico']:
-            excluidas = obtener_entregas_excluidas_hojas(rutas['historico'])
+            excluidas = obtener_entregas_excluidas_hojas(rutas['historico'], opciones)
             if excluidas:
                 st.info(f"Filtrando contra {len(excluidas)} entregas históricas (Pestañas)...")
-                programa = programa[~programa['Entrega'].isin(excluidas)].copy()
+                programa = programa[~programa['Entrega'].isin(excluidas)]
                 
                 if programa.empty:
                     return False, "Todas las entregas del programa ya existen como hojas en los históricos adjuntos.", []
@@ -748,118 +2346,45 @@ def procesar_celulosa_cb(rutas):
         prog_filtrado = programa[
             (~programa["Entrega"].isin(entregas_con_saldo)) & 
             (programa["PRODINFO"].isin(["CEL BKP", "CEL UKP", "CEL EKP"]))
-        ].copy()
-
-        def obtener_linea(nav):
-            nav = str(nav).upper().strip()
-            if "MSC" in nav: return "MSC"
-            if "ONEY" in nav: return "ONE"
-            if "HLL" in nav: return "HAPAG LLOYD"
-            if "MAERSK" in nav or "ML" in nav: return "MAERSK"
-            return nav
+        ]
 
-        prog_filtrado['NAV_CLEAN'] = prog_filtrado['NAV'].apply(obtener_linea)
+        prog_filtrado['NAV_CLEAN'] = mapear_valores_unicos(prog_filtrado['NAV'], linea_naviera)
         
         metadata_dict = prog_filtrado.set_index('Entrega')[
             ['Nave', 'DESTINO', 'RESERVA', 'PRODINFO', 'NAV_CLEAN']
         ].to_dict('index')
 
-        tools_celulosa['Contrato'] = tools_celulosa['Contrato'].astype(str)
+        # Tools se lee solo con los contratos del programa filtrado
         entregas_validas = prog_filtrado["Entrega"].unique()
-        tools_filtrado = tools_celulosa[
-            tools_celulosa["Contrato"].isin(entregas_validas)
-        ]
+        tools_celulosa, _ = leer_referencia_filtrada(rutas['tools'], [(("Contrato",), entregas_validas, llave_texto)])
+        df_agrupado = con_motor(opciones, agrupar_celulosa_cb_polars, agrupar_celulosa_cb, tools_celulosa, entregas_validas)
 
-        df = tools_filtrado.copy()
-        df["Contenedor"] = df["Contenedor"].astype(str).str.strip()
-        df["Expedicion"] = df["Expedicion"].astype(str).str.strip()
-        
-        def normalizar_box(contenedor):
-            partes = contenedor.split('-')
-            if len(partes) == 3:
-                parte_media_normalizada = partes[1].zfill(6)
-                return f"{partes[0]}-{parte_media_normalizada}-{partes[2]}"
-            return contenedor
-
-        df["BOX"] = df["Contenedor"].apply(normalizar_box)
-
-        df["TARA"] = df["Tara"]
-        df["LOTE"] = df["Expedicion"]
-        df["BULTOS"] = df["Cantidad"]
-        df["UNI"] = df["BULTOS"] / 8
-        df["SELLO"] = df["Sello_linea"]
-        df["RESERVA"] = df["Reserva"]
-        df["DUS"] = df["Orden_Embarque"]
-        df["MAX"] = df["Max_Gross"]
-
-        df_agrupado = (
-            df.groupby(["Contrato", "BOX", "LOTE"], as_index=False)
-              .agg({
-                  "TARA": "first",
-                  "BULTOS": "sum",
-                  "SELLO": "first",
-                  "RESERVA": "first",
-                  "DUS": "first",
-                  "MAX": "first"
-              })
-        )
-        
-        df_agrupado["UNI"] = df_agrupado["BULTOS"] / 8
         columnas_finales = ["BOX", "TARA", "BULTOS", "UNI", "LOTE", "SELLO", "RESERVA", "DUS", "MAX"]
         
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            for contrato, data in df_agrupado.groupby("Contrato"):
-                data_limpia = data[columnas_finales]
-                
-                data_limpia.to_excel(writer, sheet_name=str(contrato), index=False, startrow=5)
-                
-                ws = writer.sheets[str(contrato)]
-                meta = metadata_dict.get(str(contrato), {})
-                
-                datos_cabecera = {
-                    'nave': meta.get('Nave', ''),
-                    'destino': meta.get('DESTINO', ''),
-                    'reserva': meta.get('RESERVA', ''),
-                    'contrato': str(contrato),
-                    'exportador': "ARAUCO",
-                    'embarcador': "CELULOSA ARAUCO",
-                    'carga': meta.get('PRODINFO', ''),
-                    'linea': meta.get('NAV_CLEAN', '')
-                }
-                agregar_cabecera_arauco(ws, datos_cabecera)
-
-        wb = load_workbook(output)
+        wb = nuevo_libro_plantilla("cabecera_arauco")
 
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
+        for contrato, data in df_agrupado.groupby("Contrato"):
+            data_limpia = data[columnas_finales]
+            meta = metadata_dict.get(str(contrato), {})
             
-            header_row_idx = 6
-            idx_box = 1
-            for cell in ws[header_row_idx]:
-                if cell.value == "BOX":
-                    idx_box = cell.col_idx
-                    break
-            
-            max_row = ws.max_row
-            start = header_row_idx + 1
-            
-            while start <= max_row:
-                valor = ws.cell(row=start, column=idx_box).value
-                end = start
-                while end + 1 <= max_row and ws.cell(row=end + 1, column=idx_box).value == valor:
-                    end += 1
-                
-                if end > start:
-                    ws.merge_cells(start_row=start, start_column=idx_box, end_row=end, end_column=idx_box)
-                    ws.cell(row=start, column=idx_box).alignment = Alignment(vertical="center")
-                
-                start = end + 1
+            datos_cabecera = {
+                'nave': meta.get('Nave', ''),
+                'destino': meta.get('DESTINO', ''),
+                'reserva': meta.get('RESERVA', ''),
+                'contrato': str(contrato),
+                'exportador': "ARAUCO",
+                'embarcador': "CELULOSA ARAUCO",
+                'carga': meta.get('PRODINFO', ''),
+                'linea': meta.get('NAV_CLEAN', '')
+            }
+            escribir_hoja_arauco(wb, str(contrato), datos_cabecera, data_limpia)
 
         final_output = BytesIO()
         wb.save(final_output)
         final_output.seek(0)
 
+        registrar_tablas(opciones, {"CelulosaBKPEKPUKP": df_agrupado[["Contrato"] + columnas_finales]})
+
         return True, "Archivo generado correctamente", [("CelulosaBKPEKPUKP.xlsx", final_output)]
 
     except Exception as e:
@@ -871,15 +2396,15 @@ def procesar_celulosa_cb(rutas):
 # ==========================================
 #      LÓGICA DE CELULOSA DP
 # ==========================================
-def procesar_celulosa_sb(rutas):
+def procesar_celulosa_sb(rutas, opciones=None):
     st.info("Iniciando procesamiento de Celulosa DP...")
     try:
-        programa = pd.read_excel(rutas['programa'])
-        informe = pd.read_excel(rutas['informe'])
+        programa = leer_tabla(rutas['programa'])
+        informe = leer_referencia(rutas['informe'])
 
         if 'saldos' in rutas and rutas['saldos']:
             try:
-                saldos = pd.read_excel(rutas['saldos'])
+                saldos = leer_tabla(rutas['saldos'])
             except:
                 saldos = pd.DataFrame(columns=["Entrega", "Box Saldo"])
         else:
@@ -890,10 +2415,10 @@ def procesar_celulosa_sb(rutas):
         saldos['Box Saldo'] = pd.to_numeric(saldos['Box Saldo'], errors='coerce')
         
         if 'historico' in rutas and rutas['historico']:
-            excluidas = obtener_entregas_excluidas_hojas(rutas['historico'])
+            excluidas = obtener_entregas_excluidas_hojas(rutas['historico'], opciones)
             if excluidas:
                 st.info(f"Filtrando contra {len(excluidas)} entregas históricas (Pestañas)...")
-                programa = programa[~programa['Entrega'].isin(excluidas)].copy()
+                programa = programa[~programa['Entrega'].isin(excluidas)]
                 
                 if programa.empty:
                     return False, "Todas las entregas del programa ya existen como hojas en los históricos adjuntos.", []
@@ -903,17 +2428,9 @@ def procesar_celulosa_sb(rutas):
         prog_filtrado = programa[
             (~programa["Entrega"].isin(entregas_con_saldo)) & 
             (programa["PRODINFO"].isin(["CEL DP"]))
-        ].copy()
+        ]
         
-        def obtener_linea(nav):
-            nav = str(nav).upper().strip()
-            if "MSC" in nav: return "MSC"
-            if "ONEY" in nav: return "ONE"
-            if "HLL" in nav: return "HAPAG LLOYD"
-            if "MAERSK" in nav or "ML" in nav: return "MAERSK"
-            return nav
-
-        prog_filtrado['NAV_CLEAN'] = prog_filtrado['NAV'].apply(obtener_linea)
+        prog_filtrado['NAV_CLEAN'] = mapear_valores_unicos(prog_filtrado['NAV'], linea_naviera)
         
         metadata_dict = prog_filtrado.set_index('Entrega')[
             ['Nave', 'DESTINO', 'RESERVA', 'PRODINFO', 'NAV_CLEAN']
@@ -921,108 +2438,36 @@ def procesar_celulosa_sb(rutas):
 
         entregas_validas = prog_filtrado["Entrega"].unique()
         
-        if "contrato" in informe.columns:
-            informe["contrato"] = informe["contrato"].astype(str).str.strip()
-            informe = informe[informe["contrato"].isin(entregas_validas)]
-        else:
+        if "contrato" not in informe.columns:
             return False, "El archivo Informe no tiene la columna 'contrato'.", []
 
-        informe['nro_cnt'] = informe['nro_cnt'].astype(str).str.strip()
-        informe['sigla_cnt'] = informe['sigla_cnt'].astype(str).str.strip()
-        informe['dv_cnt'] = informe['dv_cnt'].astype(str).str.strip()
-
-        def construir_contenedor_2(row):
-            sigla = row['sigla_cnt']
-            numero = row['nro_cnt'].zfill(6)
-            dv = row['dv_cnt']
-            return f"{sigla}-{numero}-{dv}"
-
-        informe['CONTENEDOR_2'] = informe.apply(construir_contenedor_2, axis=1)
-
-        df = informe.rename(columns={
-            "CONTENEDOR_2": "BOX",
-            "tara_cnt": "TARA",
-            "marca": "LOTE",
-            "sello": "SELLO",
-            "orden_embarque": "RESERVA",
-            "reserva": "DUS",
-            "maxgross": "MAX"
-        })
-
-        df = df[df["SELLO"].notna() & (df["SELLO"].astype(str).str.strip() != "")]
-
-        agrupado = df.groupby(["BOX", "LOTE"]).agg({
-            "TARA": "first",
-            "SELLO": "first",
-            "RESERVA": "first",
-            "DUS": "first",
-            "contrato": "first",
-            "MAX":"first",
-            "BOX": "count"
-        }).rename(columns={"BOX": "UNI"})
-
-        agrupado["BULTOS"] = agrupado["UNI"] * 8
-
-        agrupado = agrupado.reset_index()[[
-            "BOX", "TARA", "BULTOS", "UNI", "LOTE",
-            "SELLO", "RESERVA", "DUS", "MAX", "contrato"
-        ]]
-
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            for contrato, data in agrupado.groupby("contrato"):
-                hoja = str(contrato)
-                data_limpia = data.drop(columns=["contrato"], inplace=False)
-                
-                data_limpia.to_excel(writer, sheet_name=hoja, index=False, startrow=5)
+        agrupado = con_motor(opciones, agrupar_celulosa_dp_polars, agrupar_celulosa_dp, informe, entregas_validas)
 
-                ws = writer.sheets[hoja]
-                meta = metadata_dict.get(hoja, {})
-                
-                datos_cabecera = {
-                    'nave': meta.get('Nave', ''),
-                    'destino': meta.get('DESTINO', ''),
-                    'reserva': meta.get('RESERVA', ''),
-                    'contrato': hoja,
-                    'exportador': "ARAUCO",
-                    'embarcador': "CELULOSA ARAUCO",
-                    'carga': meta.get('PRODINFO', ''),
-                    'linea': meta.get('NAV_CLEAN', '')
-                }
-                
-                agregar_cabecera_arauco(ws, datos_cabecera)
-        
-        wb = load_workbook(output)
+        wb = nuevo_libro_plantilla("cabecera_arauco")
 
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            
-            header_row_idx = 6
-            idx_box = 1
-            for cell in ws[header_row_idx]:
-                if cell.value == "BOX":
-                    idx_box = cell.col_idx
-                    break
-            
-            max_row = ws.max_row
-            start = header_row_idx + 1
+        for contrato, data in agrupado.groupby("contrato"):
+            hoja = str(contrato)
+            data_limpia = data.drop(columns=["contrato"], inplace=False)
+            meta = metadata_dict.get(hoja, {})
             
-            while start <= max_row:
-                valor = ws.cell(row=start, column=idx_box).value
-                end = start
-                while end + 1 <= max_row and ws.cell(row=end + 1, column=idx_box).value == valor:
-                    end += 1
-                
-                if end > start:
-                    ws.merge_cells(start_row=start, start_column=idx_box, end_row=end, end_column=idx_box)
-                    ws.cell(row=start, column=idx_box).alignment = Alignment(vertical="center")
-                
-                start = end + 1
+            datos_cabecera = {
+                'nave': meta.get('Nave', ''),
+                'destino': meta.get('DESTINO', ''),
+                'reserva': meta.get('RESERVA', ''),
+                'contrato': hoja,
+                'exportador': "ARAUCO",
+                'embarcador': "CELULOSA ARAUCO",
+                'carga': meta.get('PRODINFO', ''),
+                'linea': meta.get('NAV_CLEAN', '')
+            }
+            escribir_hoja_arauco(wb, hoja, datos_cabecera, data_limpia)
 
         final_output = BytesIO()
         wb.save(final_output)
         final_output.seek(0)
 
+        registrar_tablas(opciones, {"RemateCelulosaDP": agrupado})
+
         return True, "Archivo generado correctamente", [("RemateCelulosaDP.xlsx", final_output)]
 
     except Exception as e:
@@ -1031,76 +2476,260 @@ def procesar_celulosa_sb(rutas):
         traceback.print_exc()
         return False, str(e), []
 
+# ==========================================
+#      ÍNDICE SIF INCREMENTAL
+# ==========================================
+DIR_INDICE_SIF = os.path.join(DIR_DATOS, "sif")
+# Índice y partes por archivo en un solo pickle, reemplazado de una vez
+RUTA_INDICE_SIF = os.path.join(DIR_INDICE_SIF, "indice_sif.pkl")
+
+@st.cache_resource
+def _candado_indice_sif():
+    # Compartido entre sesiones del mismo proceso
+    return threading.Lock()
+
+@contextmanager
+def candado_indice_sif():
+    """
+    Exclusión sobre el índice SIF entre hilos y entre procesos (trabajadores,
+    otras instancias de la app): flock sobre un archivo candado junto al
+    índice. Sin fcntl (Windows) solo se excluyen los hilos.
+    """
+    os.makedirs(DIR_INDICE_SIF, exist_ok=True)
+    with _candado_indice_sif():
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(DIR_INDICE_SIF, "indice.lock"), "a") as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+def _cargar_estado_sif():
+    """
+    Estado del índice: {"indice": tabla reducida, "partes": {clave: parte}}.
+    Cada parte guarda el nombre, la fecha de ingesta, las huellas que cubre
+    y su propia tabla reducida, para poder quitarla después. Un índice del
+    formato anterior (indice.pkl + ingeridos.json) se adopta como una sola
+    parte. Llamar con el candado tomado.
+    """
+    if os.path.exists(RUTA_INDICE_SIF):
+        return pd.read_pickle(RUTA_INDICE_SIF)
+
+    estado = {"indice": pd.DataFrame(columns=["Codigo_Barra", "SIF_num", "SIF"]), "partes": {}}
+    ruta_anterior = os.path.join(DIR_INDICE_SIF, "indice.pkl")
+    ruta_ingeridos = os.path.join(DIR_INDICE_SIF, "ingeridos.json")
+    if os.path.exists(ruta_anterior) and os.path.exists(ruta_ingeridos):
+        try:
+            indice = pd.read_pickle(ruta_anterior)
+            with open(ruta_ingeridos, encoding="utf-8") as f:
+                huellas = set(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning("No se pudo adoptar el índice SIF anterior: %s", e)
+        else:
+            estado["indice"] = indice
+            estado["partes"]["anterior"] = {
+                "nombre": f"Índice anterior ({len(huellas)} archivos)",
+                "fecha": None, "huellas": huellas, "tabla": indice,
+            }
+    return estado
+
+def _guardar_estado_sif(estado):
+    # Un solo os.replace: índice y partes ingeridas cambian juntos o no cambian
+    tmp = RUTA_INDICE_SIF + ".tmp"
+    pd.to_pickle(estado, tmp)
+    os.replace(tmp, RUTA_INDICE_SIF)
+    for anterior in ("indice.pkl", "ingeridos.json"):
+        ruta = os.path.join(DIR_INDICE_SIF, anterior)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+def _huellas_ingeridas(estado):
+    return set().union(*(parte["huellas"] for parte in estado["partes"].values()))
+
+def _leer_archivo_sif(ruta):
+    """
+    Lee la hoja 'detalle' de un SIF y devuelve (ruta, tabla, error).
+    Se ejecuta en un proceso aparte.
+    """
+    try:
+        df = pd.read_excel(ruta, sheet_name="detalle")
+    except Exception as e:
+        return ruta, None, f"Error cargando {ruta}: {e}"
+    for col in ("Codigo_Barra", "SIF"):
+        if col not in df.columns:
+            return ruta, None, f"{os.path.basename(ruta)}: el archivo SIF no tiene la columna '{col}'."
+    return ruta, df[["Codigo_Barra", "SIF"]], None
+
+def reducir_sif_maximo(df):
+    """
+    Deja una fila por Codigo_Barra con el SIF numérico mayor (reducción
+    agrupada, sin ordenar todo el conjunto). Ante empates o SIF no numéricos
+    se conserva la primera aparición.
+    """
+    df = df.reset_index(drop=True)
+    df["Codigo_Barra"] = df["Codigo_Barra"].astype(str).str.strip()
+    if "SIF_num" not in df.columns:
+        df["SIF_num"] = pd.to_numeric(df["SIF"], errors='coerce').fillna(-np.inf)
+        df["SIF"] = (
+            df["SIF"]
+            .astype(str)
+            .str.strip()
+            .str.replace(r'\.0$', '', regex=True)
+        )
+    idx = df.groupby("Codigo_Barra", sort=False)["SIF_num"].idxmax()
+    return df.loc[idx, ["Codigo_Barra", "SIF_num", "SIF"]].reset_index(drop=True)
+
+def actualizar_indice_sif(rutas_sif):
+    """
+    Incorpora al índice persistente (Codigo_Barra -> SIF mayor) solo los
+    archivos SIF cuya huella no se haya ingerido antes; los nuevos se leen
+    en paralelo fuera del candado y se agregan releyendo el índice, por si
+    otra corrida lo actualizó entretanto. Devuelve (indice, cantidad_validos,
+    errores).
+    """
+    huellas = {ruta: huella_archivo(ruta) for ruta in rutas_sif}
+
+    with candado_indice_sif():
+        ingeridos = _huellas_ingeridas(_cargar_estado_sif())
+
+    # El mismo archivo cargado dos veces en esta corrida se lee una sola vez
+    por_huella = {}
+    for ruta in rutas_sif:
+        if huellas[ruta] not in ingeridos:
+            por_huella.setdefault(huellas[ruta], ruta)
+    nuevos = list(por_huella.values())
+
+    errores = []
+    leidos = {}
+    if nuevos:
+        if len(nuevos) == 1:
+            resultados = [_leer_archivo_sif(nuevos[0])]
+        else:
+            with crear_pool_procesos(min(len(nuevos), os.cpu_count() or 1)) as pool:
+                resultados = list(pool.map(_leer_archivo_sif, nuevos))
+
+        for ruta, df, error in resultados:
+            if error:
+                errores.append(error)
+                continue
+            leidos[huellas[ruta]] = (os.path.basename(ruta), reducir_sif_maximo(df))
+
+    with candado_indice_sif():
+        estado = _cargar_estado_sif()
+        ingeridos = _huellas_ingeridas(estado)
+        agregados = []
+        for huella, (nombre, tabla) in leidos.items():
+            if huella in ingeridos:
+                continue
+            # Los temporales de carga llevan un prefijo aleatorio antes del nombre original
+            nombre = re.sub(r'^tmp[^_]*_', '', nombre)
+            estado["partes"][huella] = {
+                "nombre": nombre, "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+                "huellas": {huella}, "tabla": tabla,
+            }
+            ingeridos.add(huella)
+            agregados.append(tabla)
+
+        if agregados:
+            partes = ([estado["indice"]] if len(estado["indice"]) else []) + agregados
+            estado["indice"] = reducir_sif_maximo(pd.concat(partes, ignore_index=True))
+            _guardar_estado_sif(estado)
+
+    validos = sum(1 for ruta in rutas_sif if huellas[ruta] in ingeridos)
+    return estado["indice"], validos, errores
+
+def partes_indice_sif():
+    """Archivos ingeridos en el índice SIF: lista de (clave, nombre, fecha, filas)."""
+    with candado_indice_sif():
+        estado = _cargar_estado_sif()
+    return [(clave, parte["nombre"], parte["fecha"], len(parte["tabla"]))
+            for clave, parte in estado["partes"].items()]
+
+def quitar_del_indice_sif(claves):
+    """
+    Quita partes del índice SIF (p. ej. un SIF equivocado) y recalcula el
+    índice con las que quedan, en su orden de ingesta. Sus huellas dejan de
+    estar ingeridas, así que el archivo se vuelve a leer si se carga otra
+    vez. Devuelve la cantidad de partes quitadas.
+    """
+    with candado_indice_sif():
+        estado = _cargar_estado_sif()
+        quitadas = [clave for clave in claves if clave in estado["partes"]]
+        if not quitadas:
+            return 0
+        for clave in quitadas:
+            del estado["partes"][clave]
+        tablas = [parte["tabla"] for parte in estado["partes"].values() if len(parte["tabla"])]
+        estado["indice"] = (
+            reducir_sif_maximo(pd.concat(tablas, ignore_index=True)) if tablas
+            else pd.DataFrame(columns=["Codigo_Barra", "SIF_num", "SIF"])
+        )
+        _guardar_estado_sif(estado)
+    return len(quitadas)
+
+def revision_indice_sif():
+    """Marca de la versión en disco del índice SIF (cambia con cada escritura)."""
+    try:
+        info = os.stat(RUTA_INDICE_SIF)
+    except OSError:
+        return None
+    return f"{info.st_mtime_ns}-{info.st_size}"
+
 # ==========================================
 #      LÓGICA DE SAG 
 # ==========================================
-def procesar_sag(rutas):
+def procesar_sag(rutas, opciones=None):
     st.info("Iniciando procesamiento de SAG...")
     try:
-        path_remate = rutas['remate']
-        remate = pd.read_excel(path_remate)
+        # Remate y Picking pueden venir como tablas en memoria (encadenado con Madera)
+        remate = abrir_tabla(rutas['remate'])
+        if remate is not None:
+            remate = inferir_tipos_como_excel(remate)
+        else:
+            remate = leer_referencia(rutas['remate'])
         
         rutas_sif = rutas['sag']
         
         if isinstance(rutas_sif, str):
             rutas_sif = [rutas_sif]
             
-        lista_sifs = []
         st.info(f"Cargando {len(rutas_sif)} archivos SIF...")
-        
-        for ruta in rutas_sif:
-            try:
-                df_temp = pd.read_excel(ruta, sheet_name="detalle")
-                lista_sifs.append(df_temp)
-            except Exception as e:
-                st.error(f"Error cargando {ruta}: {e}")
-        
-        if not lista_sifs:
+        SAG, sif_validos, errores_sif = actualizar_indice_sif(rutas_sif)
+
+        for error in errores_sif:
+            avisar(opciones, "error", error)
+
+        if not sif_validos:
             return False, "No se pudo cargar ningún archivo SIF válido.", []
-            
-        SAG = pd.concat(lista_sifs, ignore_index=True)
         
         path_picking = rutas['picking']
-        
-        if not os.path.exists(path_picking):
-             return False, f"No se encontró el archivo Picking: {path_picking}", []
 
-        picking_pos = pd.read_excel(path_picking, sheet_name="Posicion")
-        picking_cab = pd.read_excel(path_picking, sheet_name="Cabecera")
-
-        # Normalizar columnas claves
-        if "Codigo_Barra" in SAG.columns:
-            SAG["Codigo_Barra"] = SAG["Codigo_Barra"].astype(str).str.strip()
+        if isinstance(path_picking, dict):
+            hojas_picking = {hoja: inferir_tipos_como_excel(archivos_a_tablas(df)) for hoja, df in path_picking.items()}
         else:
-            return False, "Los archivos SIF no tienen la columna 'Codigo_Barra'."
-            
+            if not os.path.exists(path_picking):
+                return False, f"No se encontró el archivo Picking: {path_picking}", []
+            # Cada hoja (con sus continuaciones) queda guardada por contenido:
+            # al corregir un SIF y reintentar no se vuelve a leer el Picking
+            hojas_picking = {
+                "Cabecera": leer_referencia(path_picking, lector=leer_picking_cabecera),
+                "Posicion": leer_referencia(path_picking, lector=leer_picking_posicion),
+            }
+
+        picking_pos = hojas_con_continuacion(hojas_picking, "Posicion").copy(deep=False)
+        picking_cab = hojas_con_continuacion(hojas_picking, "Cabecera").copy(deep=False)
+
         picking_pos["Lote"] = picking_pos["Lote"].astype(str).str.strip()
-        
-        if "SIF" in SAG.columns:
-            # 1. Crear una columna numérica temporal para ordenar correctamente
-            SAG['SIF_num'] = pd.to_numeric(SAG['SIF'], errors='coerce')
-            
-            # 2. Ordenar por Codigo_Barra y SIF_num (descendente para que el mayor quede arriba)
-            SAG = SAG.sort_values(by=['Codigo_Barra', 'SIF_num'], ascending=[True, False])
-            
-            # 3. Eliminar duplicados de lote, conservando el primero (que ahora es el SIF mayor)
-            SAG = SAG.drop_duplicates(subset=['Codigo_Barra'], keep='first')
-            
-            # 4. Normalizar SIF a texto (tu lógica original)
-            SAG['SIF'] = (
-                SAG['SIF']
-                .astype(str)
-                .str.strip()
-                .str.replace(r'\.0$', '', regex=True)
-            )
-            
-            # Opcional: Eliminar la columna temporal si ya no la necesitas
-            SAG = SAG.drop(columns=['SIF_num'])
-        else:
-            return False, "Los archivos SIF no tienen la columna 'SIF'."
+
+        # El índice ya guarda un SIF (el mayor) por Codigo_Barra
+        SAG = SAG[SAG["Codigo_Barra"].isin(picking_pos["Lote"])]
 
         # Merge Picking Posicion con SIF
-        picking_pos = picking_pos.merge(
+        picking_pos = cruzar(
+            opciones, "Posición x SIF", picking_pos,
             SAG[["Codigo_Barra", "SIF"]],
             how="left",
             left_on="Lote",
@@ -1118,6 +2747,7 @@ def procesar_sag(rutas):
             .dropna()
             .drop_duplicates()
         )
+        registrar_etapa(opciones, "SIF por cabecera", "deduplicar", picking_pos, sif_por_cabecera)
 
         metricas = (
             picking_pos.groupby(["ID Cabecera", "SIF"])
@@ -1131,14 +2761,17 @@ def procesar_sag(rutas):
                 "Peso": "Peso Total"
             })
         )
+        registrar_etapa(opciones, "Métricas por cabecera y SIF", "agrupación", picking_pos, metricas)
 
-        picking_cab = picking_cab.merge(
+        picking_cab = cruzar(
+            opciones, "Cabecera x SIF", picking_cab,
             sif_por_cabecera,
             on="ID Cabecera",
             how="left"
         )
 
-        picking_cab = picking_cab.merge(
+        picking_cab = cruzar(
+            opciones, "Cabecera x Métricas", picking_cab,
             metricas,
             on=["ID Cabecera", "SIF"],
             how="left"
@@ -1147,7 +2780,8 @@ def procesar_sag(rutas):
         picking_cab["ID Contenedor"] = picking_cab["ID Contenedor"].astype(str).str.strip()
         remate["Contenedor"] = remate["Contenedor"].astype(str).str.strip()
 
-        remate = remate.merge(
+        remate = cruzar(
+            opciones, "Remate x Cabecera", remate,
             picking_cab[[
                 "ID Contenedor",
                 "SIF",
@@ -1206,6 +2840,8 @@ def procesar_sag(rutas):
         wb.save(final_output)
         final_output.seek(0)
 
+        registrar_tablas(opciones, {"RemateSIF": remate})
+
         return True, "Archivo generado correctamente", [("RemateSIF.xlsx", final_output)]
 
     except Exception as e:
@@ -1214,107 +2850,273 @@ def procesar_sag(rutas):
         traceback.print_exc()
         return False, str(e), []
 
+# ==========================================
+#      CMPC: NORMALIZACIÓN COMÚN
+# ==========================================
+# Producto del Remate -> familia de entregables CMPC (modo nave completa).
+# Todo producto que empiece con "CELULOSA" se trata como Celulosa.
+FAMILIAS_CMPC = {
+    "MADERA SECA": "Madera",
+    "MADERA VERDE": "Madera",
+    "PAPEL KRAFT": "Papel",
+    "PLYWOOD": "Plywood",
+}
+
+def construir_contenedor_cmpc(sigla, numero, dv):
+    """
+    Arma SIGLA-NNNNNN-DV en forma vectorizada (el número puede venir como
+    float desde Excel: se descarta la parte decimal).
+    """
+    numero = numero.astype(str).str.split('.').str[0].str.strip().str.zfill(6)
+    return sigla.astype(str).str.strip() + "-" + numero + "-" + dv.astype(str).str.strip()
+
+def leer_tools_cmpc(ruta, remate, por_contenedor=False, por_sello=False):
+    """
+    Lee el Tools de CMPC conservando solo las filas cuyo número de
+    contenedor y/o sello aparece en el Remate (prefiltro; los cruces
+    exactos siguen en cada flujo).
+    """
+    columnas_remate = {str(c).strip(): c for c in remate.columns}
+    filtros = []
+    if por_contenedor and "nro_cnt" in columnas_remate:
+        filtros.append((("Cnt_Nro",), pd.unique(remate[columnas_remate["nro_cnt"]]), llave_numero))
+    if por_sello and "sello_linea" in columnas_remate:
+        filtros.append((("Sello_linea", "sello_linea", "SELLO_LINEA"), pd.unique(remate[columnas_remate["sello_linea"]]), llave_sello))
+    if not filtros:
+        return leer_referencia(ruta)
+
+    tools, filas_leidas = leer_referencia_filtrada(ruta, filtros)
+    logger.info("Tools CMPC: %d de %d filas tras prefiltro", len(tools), filas_leidas)
+    return tools
+
+def normalizar_cmpc(remate, tools):
+    """
+    Normaliza una sola vez el Remate y el Tools de CMPC: nombres de columna,
+    llaves de contenedor (CONTENEDORREM / CONTENEDORINF) y sellos limpios.
+    """
+    remate.columns = [str(c).strip() for c in remate.columns]
+    tools.columns = [str(c).strip() for c in tools.columns]
+
+    if {'sigla_cnt', 'nro_cnt', 'dv_cnt'}.issubset(remate.columns):
+        remate['sigla_cnt'] = remate['sigla_cnt'].astype(str).str.strip()
+        remate['nro_cnt'] = remate['nro_cnt'].astype(str).str.strip()
+        remate['dv_cnt'] = remate['dv_cnt'].astype(str).str.strip()
+        remate['CONTENEDORREM'] = construir_contenedor_cmpc(remate['sigla_cnt'], remate['nro_cnt'], remate['dv_cnt'])
+
+    if "sello_linea" in remate.columns:
+        remate["sello_linea_clean"] = (
+            remate["sello_linea"]
+            .astype(str)
+            .str.replace("-", "", regex=False)
+            .str.strip()
+        )
+
+    if {'Cnt_Sigla', 'Cnt_Nro', 'Cnt_DV'}.issubset(tools.columns):
+        tools['Cnt_Sigla'] = tools['Cnt_Sigla'].astype(str).str.strip()
+        tools['Cnt_Nro'] = tools['Cnt_Nro'].astype(str).str.strip()
+        tools['Cnt_DV'] = tools['Cnt_DV'].astype(str).str.strip()
+        tools['CONTENEDORINF'] = construir_contenedor_cmpc(tools['Cnt_Sigla'], tools['Cnt_Nro'], tools['Cnt_DV'])
+
+    col_sello_tools = next((c for c in tools.columns if c.lower() == 'sello_linea'), None)
+    if col_sello_tools:
+        tools["Sello_linea_clean"] = (
+            tools[col_sello_tools]
+            .astype(str)
+            .str.replace("-", "", regex=False)
+            .str.strip()
+        )
+
+    return remate, tools
+
 # ==========================================
 #      LÓGICA CMPC CELULOSA
 # ==========================================
-def procesar_cmpc_celulosa(rutas):
+def generar_cmpc_celulosa(remate, tools, opciones=None):
+    remate = remate[remate['producto'] != "PAPEL KRAFT"] if 'producto' in remate.columns else remate
+
+    sellos_validos = set(remate["sello_linea_clean"])
+    tools_filtrado = tools[tools["Sello_linea_clean"].isin(sellos_validos)]
+
+    df = cruzar(
+        opciones, "Tools x Remate Celulosa", tools_filtrado, remate,
+        left_on="Sello_linea_clean",
+        right_on="sello_linea_clean",
+        how="left",
+        suffixes=("_tools", "_remate")
+    )
+
+    consolidado = pd.DataFrame()
+    consolidado["Etiqueta"] = df["Expedicion"]
+    consolidado["Contenedor"] = df["Contenedor"]
+    consolidado["Sello"] = df["Sello_linea_clean"]
+    consolidado["Tara"] = pd.to_numeric(df["Tara"], errors="coerce")
+    consolidado["Tipo Cont."] = df["Tipo_Contenedor"]
+    consolidado["Dimension"] = df["medida"]
+    consolidado["Naviera"] = df["linea"]
+    consolidado["Reserva"] = df["reserva"]
+    consolidado["Dus"] = df["dus"]
+    consolidado["agencia"] = df["aga"]
+    consolidado["Bodega"] = ""
+    consolidado["ubicación"] = ""
+    consolidado["Directo"] = "N"
+    consolidado["Destino"] = df["Pto_Destino"].astype(str).str.split(",", n=1).str[0]
+    consolidado["Fardos"] = pd.to_numeric(df["Cantidad"], errors="coerce")
+    consolidado["Pedido"] = df["Contrato"].astype(str).str.split("-", n=1).str[0]
+    consolidado["fecha dus"] = (
+        pd.to_datetime(df["fecha_aceptacion"], format="%d/%m/%Y %H:%M", errors="coerce")
+        .dt.strftime("%d/%m/%Y")
+    )
+    consolidado["UNIT"] = consolidado["Fardos"] / 8
+    consolidado["PLANTA"] = (
+        df["producto"]
+        .astype(str)
+        .str.upper()
+        .str.replace("CELULOSA ", "", regex=False)
+        .str.strip()
+    )
+    consolidado["Peso neto"] = PESOS_CELULOSA_CMPC["neto_por_fardo"] * consolidado["Fardos"]
+    consolidado["Peso bruto"] = PESOS_CELULOSA_CMPC["bruto_por_fardo"] * consolidado["Fardos"]
+    consolidado["Peso Total"] = PESOS_CELULOSA_CMPC["carga_total"] + consolidado["Tara"]
+
+    factor_volumen = mapear_valores_unicos(consolidado["PLANTA"], factor_volumen_planta).astype(float)
+    consolidado["Volumen"] = consolidado["Fardos"] * factor_volumen
+
+    consolidado["Marca"] = consolidado["Etiqueta"].astype(str) + "/" + consolidado["PLANTA"].astype(str)
+
+    output = escribir_tablas_excel({"Sheet1": consolidado})
+    registrar_tablas(opciones, {"CMPC_Celulosa_Consolidado": consolidado})
+
+    return [("CMPC_Celulosa_Consolidado.xlsx", output)]
+
+def procesar_cmpc_celulosa(rutas, opciones=None):
     st.info("Iniciando procesamiento CMPC Celulosa...")
     try:
-        remate = pd.read_excel(rutas['remate'])
-        tools = pd.read_excel(rutas['tools'])
+        remate = leer_tabla(rutas['remate'])
+        tools = leer_tools_cmpc(rutas['tools'], remate, por_sello=True)
 
-        if 'producto' in remate.columns:
-            remate = remate[remate['producto'] != "PAPEL KRAFT"]
-        
-        if "sello_linea" in remate.columns:
-            remate["sello_linea_clean"] = (
-                remate["sello_linea"]
-                .astype(str)
-                .str.replace("-", "", regex=False)
-                .str.strip()
-            )
-        else:
+        if "sello_linea" not in remate.columns:
              return False, "Columna 'sello_linea' no encontrada en Remate.", []
-
-        if "Sello_linea" in tools.columns:
-            tools["Sello_linea_clean"] = (
-                tools["Sello_linea"]
-                .astype(str)
-                .str.replace("-", "", regex=False)
-                .str.strip()
-            )
-        else:
+        if "Sello_linea" not in tools.columns:
             return False, "Columna 'Sello_linea' no encontrada en Tools.", []
 
-        sellos_validos = set(remate["sello_linea_clean"])
-        tools_filtrado = tools[tools["Sello_linea_clean"].isin(sellos_validos)].copy()
+        remate, tools = normalizar_cmpc(remate, tools)
 
-        df = tools_filtrado.merge(
-            remate,
-            left_on="Sello_linea_clean",
-            right_on="sello_linea_clean",
-            how="left",
-            suffixes=("_tools", "_remate")
-        )
+        return True, "Archivo generado", generar_cmpc_celulosa(remate, tools, opciones)
+
+    except Exception as e:
+        st.error(f"Error en procesamiento: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False, str(e), []
+
+# ==========================================
+#      LÓGICA CMPC MADERA (FINAL - NOTA POR CONTENEDOR)
+# ==========================================
+def generar_cmpc_madera(remate, tools, opciones=None):
+    archivos_output = []
+
+    productos_madera = [p for p, familia in FAMILIAS_CMPC.items() if familia == "Madera"]
+    remate_madera = remate[remate["producto"].isin(productos_madera)]
+
+    if remate_madera.empty:
+        return archivos_output
+
+    # Un solo cruce de Tools contra el Remate de todas las clases de madera;
+    # luego se separa por producto sin volver a recorrer Tools
+    # El consolidado usa solo datos a nivel de contenedor: con una fila de
+    # Remate por contenedor y producto, cada fila de Tools se repite a lo más
+    # una vez por producto, y el groupby por producto las vuelve a separar
+    remate_por_cnt = remate_madera.drop_duplicates(subset=["CONTENEDORREM", "producto"])
+    tools_filtrado = tools[tools['CONTENEDORINF'].isin(remate_por_cnt['CONTENEDORREM'])]
+    df_madera = unir_por_contenedor(opciones, "Tools x Remate Madera", tools_filtrado, remate_por_cnt)
+    consolidados = dict(tuple(df_madera.groupby("producto", sort=False)))
+
+    for producto, remate_clase in remate_madera.groupby("producto"):
+        clase = producto.title().replace(" ", "_")
+
+        try:
+            remate_clase['Desc_Carga_Calc'] = remate_clase['cant_piezas'].astype(str) + " PIECES, CHILEAN RADIATA PINE"
+            
+            contenedores_unicos = remate_clase['CONTENEDORREM'].unique()
+            mapa_nota = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos)}
+
+            df_remate_extra = pd.DataFrame({
+                "Nota": remate_clase['CONTENEDORREM'].map(mapa_nota),
+                "Venta": remate_clase["pedido"],
+                "Reserva": remate_clase["reserva"],
+                "Contenedor": remate_clase["CONTENEDORREM"],
+                "Sello Naviera (Carrier Seal)": remate_clase["sello_linea"],
+                "Descripción de la Carga": remate_clase["Desc_Carga_Calc"],
+                "N° de Pqts.": remate_clase["cant_paquetes"],
+                "Tara del Contenedor": remate_clase["tara"],
+                "Volumen Bruto de la Carga": remate_clase["volumen"],
+                "Peso Bruto de la Carga (documental)": remate_clase["neto"],
+                "Volumen Bruto del Contenedor": remate_clase["volumen"], 
+                "Comentarios del Contenedor": remate_clase["pto_final"]
+            }, copy=False)
+            
+            output_remate = BytesIO()
+            df_remate_extra.to_excel(output_remate, index=False, engine='openpyxl')
+            output_remate.seek(0)
+            archivos_output.append((f"Remate_CMPC_{clase}.xlsx", output_remate))
+            registrar_tablas(opciones, {f"Remate_CMPC_{clase}": df_remate_extra})
+            
+        except Exception as e:
+            avisar(opciones, "warning", f"Error generando Remate Extra {producto.title()}: {e}")
+
+        # CONSOLIDADO POR CLASE
+        df = consolidados.get(producto)
+        
+        if df is not None and not df.empty:
+            df = df.copy(deep=False)
+            df[['contrato', 'item']] = df['Orden_Pedido'].astype(str).str.split('-', n=1, expand=True)
+            df['fecha_dus'] = pd.to_datetime(df['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
+
+            df_consolidado = pd.DataFrame({
+                "Npaquete": df["Nro_Paquete"],
+                "Contenedor": df.index,
+                "Sello": df["sello_linea"],
+                "Tara": df["tara"],
+                "Dimension": df["medida"],
+                "Tipo Cont.": df["tipo"],
+                "Directo": "N",
+                "Destino": df["pto_final"],
+                "Paquetes": "1",
+                "contrato": df["contrato"],
+                "item": df["item"],
+                "Naviera": df["linea"],
+                "Bodega": "",
+                "ubicación": "",
+                "Reserva": df["reserva"],
+                "Dus": df["dus"],
+                "fecha dus": df["fecha_dus"],
+                "agencia": df["aga"],
+            }, copy=False)
+
+            output_cons = escribir_tablas_excel({"Sheet1": df_consolidado})
+            archivos_output.append((f"CMPC_{clase}_Consolidado.xlsx", output_cons))
+            registrar_tablas(opciones, {f"CMPC_{clase}_Consolidado": df_consolidado})
+
+    return archivos_output
+
+def procesar_cmpc_madera(rutas, opciones=None):
+    st.info("Iniciando procesamiento CMPC Madera...")
+    try:
+        remate = leer_tabla(rutas['remate'])
+        tools = leer_tools_cmpc(rutas['informe'], remate, por_contenedor=True)
+
+        cols_tools_necesarias = ['Cnt_Sigla', 'Cnt_Nro', 'Cnt_DV']
+        for col in cols_tools_necesarias:
+            if col not in tools.columns:
+                return False, f"El archivo Informe (Tools) no tiene la columna '{col}'", []
 
-        consolidado = pd.DataFrame()
-        consolidado["Etiqueta"] = df["Expedicion"]
-        consolidado["Contenedor"] = df["Contenedor"]
-        consolidado["Sello"] = df["Sello_linea_clean"]
-        consolidado["Tara"] = pd.to_numeric(df["Tara"], errors="coerce")
-        consolidado["Tipo Cont."] = df["Tipo_Contenedor"]
-        consolidado["Dimension"] = df["medida"]
-        consolidado["Naviera"] = df["linea"]
-        consolidado["Reserva"] = df["reserva"]
-        consolidado["Dus"] = df["dus"]
-        consolidado["agencia"] = df["aga"]
-        consolidado["Bodega"] = ""
-        consolidado["ubicación"] = ""
-        consolidado["Directo"] = "N"
-        consolidado["Destino"] = df["Pto_Destino"].astype(str).str.split(",", n=1).str[0]
-        consolidado["Fardos"] = pd.to_numeric(df["Cantidad"], errors="coerce")
-        consolidado["Pedido"] = df["Contrato"].astype(str).str.split("-", n=1).str[0]
-        consolidado["fecha dus"] = (
-            pd.to_datetime(df["fecha_aceptacion"], format="%d/%m/%Y %H:%M", errors="coerce")
-            .dt.strftime("%d/%m/%Y")
-        )
-        consolidado["UNIT"] = consolidado["Fardos"] / 8
-        consolidado["PLANTA"] = (
-            df["producto"]
-            .astype(str)
-            .str.upper()
-            .str.replace("CELULOSA ", "", regex=False)
-            .str.strip()
-        )
-        consolidado["Peso neto"] = 0.25175 * consolidado["Fardos"]
-        consolidado["Peso bruto"] = 0.25413 * consolidado["Fardos"]
-        consolidado["Peso Total"] = 24396 + consolidado["Tara"]
-
-        def calcular_volumen(planta, fardos):
-            if pd.isna(fardos):
-                return np.nan
-            planta = str(planta).upper().strip()
-
-            if "STA" in planta or "FÉ" in planta:
-                return fardos * 0.254
-            elif "LAJA" in planta:
-                return fardos * 0.2502
-            elif "PACIFICO" in planta:
-                return fardos * 0.2618
-            return np.nan
-
-        consolidado["Volumen"] = [
-            calcular_volumen(p, f)
-            for p, f in zip(consolidado["PLANTA"], consolidado["Fardos"])
-        ]
+        remate, tools = normalizar_cmpc(remate, tools)
+        archivos_output = generar_cmpc_madera(remate, tools, opciones)
 
-        consolidado["Marca"] = consolidado["Etiqueta"].astype(str) + "/" + consolidado["PLANTA"].astype(str)
+        if not archivos_output:
+            return True, "Proceso finalizado, pero no se generaron archivos.", []
 
-        output = BytesIO()
-        consolidado.to_excel(output, index=False, engine='openpyxl')
-        output.seek(0)
-        
-        return True, "Archivo generado", [("CMPC_Celulosa_Consolidado.xlsx", output)]
+        return True, "Archivos generados exitosamente", archivos_output
 
     except Exception as e:
         st.error(f"Error en procesamiento: {str(e)}")
@@ -1323,205 +3125,118 @@ def procesar_cmpc_celulosa(rutas):
         return False, str(e), []
 
 # ==========================================
-#      LÓGICA CMPC MADERA (FINAL - NOTA POR CONTENEDOR)
+#      LÓGICA CMPC PAPEL (FINAL - NOTA POR CONTENEDOR)
 # ==========================================
-def procesar_cmpc_madera(rutas):
-    st.info("Iniciando procesamiento CMPC Madera...")
-    try:
-        remate = pd.read_excel(rutas['remate'])
-        tools = pd.read_excel(rutas['informe'])
+def generar_cmpc_papel(remate, tools, opciones=None):
+    archivos_output = []
 
-        remate['sigla_cnt'] = remate['sigla_cnt'].astype(str).str.strip()
-        remate['nro_cnt'] = remate['nro_cnt'].astype(str).str.strip()
-        remate['dv_cnt'] = remate['dv_cnt'].astype(str).str.strip()
-
-        def construir_contenedor_rem(row):
-            sigla = str(row['sigla_cnt']).strip()
-            val_num = str(row['nro_cnt'])
-            if '.' in val_num:
-                numero = val_num.split('.')[0].strip()
-            else:
-                numero = val_num.strip()
-            dv = str(row['dv_cnt']).strip()
-            numero = numero.zfill(6)
-            contenedor = f"{sigla}-{numero}-{dv}"
-            return contenedor
-
-        remate['CONTENEDORREM'] = remate.apply(construir_contenedor_rem, axis=1)
-
-        if "Sello_linea" in tools.columns:
-            tools["Sello_linea_clean"] = (
-                tools["Sello_linea"]
-                .astype(str)
-                .str.replace("-", "", regex=False)
-                .str.strip()
-            )
+    col_tara_rem = next((c for c in remate.columns if c.lower() == 'tara'), 'tara')
+    col_pto_rem = next((c for c in remate.columns if c.lower() in ['pto_descarga', 'pto_final', 'puerto_destino']), 'pto_descarga')
 
-        cols_tools_necesarias = ['Cnt_Sigla', 'Cnt_Nro', 'Cnt_DV']
-        for col in cols_tools_necesarias:
-            if col not in tools.columns:
-                return False, f"El archivo Informe (Tools) no tiene la columna '{col}'", []
+    if "Sello_linea_clean" not in tools.columns:
+        tools = tools.assign(Sello_linea_clean="")
 
-        tools['Cnt_Sigla'] = tools['Cnt_Sigla'].astype(str).str.strip()
-        tools['Cnt_Nro'] = tools['Cnt_Nro'].astype(str).str.strip()
-        tools['Cnt_DV'] = tools['Cnt_DV'].astype(str).str.strip()
+    col_peso_tools = next((c for c in tools.columns if c.lower() == 'peso_lote'), None)
+    if col_peso_tools:
+        tools = tools.copy(deep=False)
+        tools[col_peso_tools] = tools[col_peso_tools].astype(str).str.replace(',', '.', regex=False)
+        tools[col_peso_tools] = pd.to_numeric(tools[col_peso_tools], errors='coerce').fillna(0)
+    else:
+        tools = tools.assign(Peso_lote=0)
+        col_peso_tools = 'Peso_lote'
 
-        def construir_contenedor_tools(row):
-            sigla = str(row['Cnt_Sigla']).strip()
-            val_num = str(row['Cnt_Nro'])
-            if '.' in val_num:
-                numero = val_num.split('.')[0].strip()
-            else:
-                numero = val_num.strip()
-            dv = str(row['Cnt_DV']).strip()
-            numero = numero.zfill(6)
-            contenedor = f"{sigla}-{numero}-{dv}"
-            return contenedor
+    # 2. GENERAR ARCHIVO NUEVO "REMATE_CMPC_PAPEL"
+    try:
+        grupo_tools = tools.groupby(['Orden_Pedido', 'CONTENEDORINF']).agg({
+            'Reserva': 'first',
+            'Sello_linea_clean': 'first',
+            'Nro_Paquete': 'count',
+            col_peso_tools: 'sum'
+        }).reset_index()
+
+        remate_subset = remate[['CONTENEDORREM', col_tara_rem, col_pto_rem]].drop_duplicates('CONTENEDORREM')
+        
+        df_nuevo = grupo_tools.merge(
+            remate_subset,
+            left_on='CONTENEDORINF',
+            right_on='CONTENEDORREM',
+            how='left'
+        )
 
-        tools['CONTENEDORINF'] = tools.apply(construir_contenedor_tools, axis=1)
+        contenedores_unicos = df_nuevo['CONTENEDORINF'].unique()
+        mapa_id_contenedor = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos)}
+        
+        df_exportar = pd.DataFrame()
+        df_exportar['Nota'] = df_nuevo['CONTENEDORINF'].map(mapa_id_contenedor)
+        df_exportar['Número Venta'] = df_nuevo['Orden_Pedido']
+        df_exportar['Reserva'] = df_nuevo['Reserva']
+        df_exportar['Contenedor'] = df_nuevo['CONTENEDORINF']
+        df_exportar['Sello Naviera (Carrier Seal)'] = df_nuevo['Sello_linea_clean']
+        df_exportar['Descripción de la Carga'] = "PAPEL KRAFT"
+        df_exportar['N° de Pqts.'] = df_nuevo['Nro_Paquete']
+        df_exportar['Tara del Contenedor'] = df_nuevo[col_tara_rem]
+        df_exportar['Peso Bruto de la Carga (documental)'] = df_nuevo[col_peso_tools]
+        df_exportar['Comentarios del Contenedor'] = df_nuevo[col_pto_rem]
+
+        output_remate = BytesIO()
+        df_exportar.to_excel(output_remate, index=False, engine='openpyxl')
+        output_remate.seek(0)
+        archivos_output.append(("Remate_CMPC_Papel.xlsx", output_remate))
+        registrar_tablas(opciones, {"Remate_CMPC_Papel": df_exportar})
 
-        mensajes_exito = []
-        archivos_output = []
+    except Exception as e:
+        avisar(opciones, "warning", f"Error generando Remate Nuevo: {e}")
 
-        # SUB-PROCESO 1: MADERA SECA
-        remate_seca = remate[remate["producto"] == "MADERA SECA"].copy()
+    # 3. GENERAR ARCHIVO ANTIGUO "CONSOLIDADO"
+    try:
+        remate_papel = remate[remate["producto"] == "PAPEL KRAFT"].drop_duplicates(subset=["CONTENEDORREM"])
+        tools_filt = tools[tools['CONTENEDORINF'].isin(remate_papel['CONTENEDORREM'])]
         
-        if not remate_seca.empty:
-            try:
-                remate_seca['Desc_Carga_Calc'] = remate_seca['cant_piezas'].astype(str) + " PIECES, CHILEAN RADIATA PINE"
-                
-                contenedores_unicos_s = remate_seca['CONTENEDORREM'].unique()
-                mapa_nota_s = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos_s)}
-
-                df_remate_extra_seca = pd.DataFrame({
-                    "Nota": remate_seca['CONTENEDORREM'].map(mapa_nota_s),
-                    "Venta": remate_seca["pedido"],
-                    "Reserva": remate_seca["reserva"],
-                    "Contenedor": remate_seca["CONTENEDORREM"],
-                    "Sello Naviera (Carrier Seal)": remate_seca["sello_linea"],
-                    "Descripción de la Carga": remate_seca["Desc_Carga_Calc"],
-                    "N° de Pqts.": remate_seca["cant_paquetes"],
-                    "Tara del Contenedor": remate_seca["tara"],
-                    "Volumen Bruto de la Carga": remate_seca["volumen"],
-                    "Peso Bruto de la Carga (documental)": remate_seca["neto"],
-                    "Volumen Bruto del Contenedor": remate_seca["volumen"], 
-                    "Comentarios del Contenedor": remate_seca["pto_final"]
-                })
-                
-                output_seca_remate = BytesIO()
-                df_remate_extra_seca.to_excel(output_seca_remate, index=False, engine='openpyxl')
-                output_seca_remate.seek(0)
-                archivos_output.append(("Remate_CMPC_Madera_Seca.xlsx", output_seca_remate))
-                
-            except Exception as e:
-                st.warning(f"Error generando Remate Extra Seca: {e}")
+        df_cons = unir_por_contenedor(opciones, "Tools x Remate Papel", tools_filt, remate_papel)
 
-            # CONSOLIDADO SECA
-            tools_filtrado = tools[tools['CONTENEDORINF'].isin(remate_seca['CONTENEDORREM'])]
-            remate_matched = remate_seca.set_index("CONTENEDORREM")
-            tools_matched = tools_filtrado.set_index("CONTENEDORINF")
-            
-            df = tools_matched.join(remate_matched, how="left", rsuffix="_rem")
+        if not df_cons.empty:
+            df_cons['fecha_dus'] = pd.to_datetime(df_cons['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
             
-            if not df.empty:
-                df[['contrato', 'item']] = df['Orden_Pedido'].astype(str).str.split('-', n=1, expand=True)
-                df['fecha_dus'] = pd.to_datetime(df['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
-
-                df_consolidado = pd.DataFrame({
-                    "Npaquete": df["Nro_Paquete"],
-                    "Contenedor": df.index,
-                    "Sello": df["sello_linea"],
-                    "Tara": df["tara"],
-                    "Dimension": df["medida"],
-                    "Tipo Cont.": df["tipo"],
-                    "Directo": "N",
-                    "Destino": df["pto_final"],
-                    "Paquetes": "1",
-                    "contrato": df["contrato"],
-                    "item": df["item"],
-                    "Naviera": df["linea"],
-                    "Bodega": "",
-                    "ubicación": "",
-                    "Reserva": df["reserva"],
-                    "Dus": df["dus"],
-                    "fecha dus": df["fecha_dus"],
-                    "agencia": df["aga"],
-                })
-
-                output_seca_cons = BytesIO()
-                df_consolidado.to_excel(output_seca_cons, index=False, engine='openpyxl')
-                output_seca_cons.seek(0)
-                archivos_output.append(("CMPC_Madera_Seca_Consolidado.xlsx", output_seca_cons))
-
-        # SUB-PROCESO 2: MADERA VERDE
-        remate_verde = remate[remate["producto"] == "MADERA VERDE"].copy()
-        
-        if not remate_verde.empty:
-            try:
-                remate_verde['Desc_Carga_Calc'] = remate_verde['cant_piezas'].astype(str) + " PIECES, CHILEAN RADIATA PINE"
-                
-                contenedores_unicos_v = remate_verde['CONTENEDORREM'].unique()
-                mapa_nota_v = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos_v)}
-
-                df_remate_extra_verde = pd.DataFrame({
-                    "Nota": remate_verde['CONTENEDORREM'].map(mapa_nota_v),
-                    "Venta": remate_verde["pedido"],
-                    "Reserva": remate_verde["reserva"],
-                    "Contenedor": remate_verde["CONTENEDORREM"],
-                    "Sello Naviera (Carrier Seal)": remate_verde["sello_linea"],
-                    "Descripción de la Carga": remate_verde["Desc_Carga_Calc"],
-                    "N° de Pqts.": remate_verde["cant_paquetes"],
-                    "Tara del Contenedor": remate_verde["tara"],
-                    "Volumen Bruto de la Carga": remate_verde["volumen"],
-                    "Peso Bruto de la Carga (documental)": remate_verde["neto"],
-                    "Volumen Bruto del Contenedor": remate_verde["volumen"],
-                    "Comentarios del Contenedor": remate_verde["pto_final"]
-                })
-                
-                output_verde_remate = BytesIO()
-                df_remate_extra_verde.to_excel(output_verde_remate, index=False, engine='openpyxl')
-                output_verde_remate.seek(0)
-                archivos_output.append(("Remate_CMPC_Madera_Verde.xlsx", output_verde_remate))
-                
-            except Exception as e:
-                st.warning(f"Error generando Remate Extra Verde: {e}")
+            df_consolidado_final = pd.DataFrame({
+                "Etiqueta": df_cons["Nro_Paquete"], 
+                "Contenedor": df_cons.index, 
+                "Sello": df_cons["sello_linea"],
+                "Tara": df_cons[col_tara_rem], 
+                "Dimension": df_cons["medida"], 
+                "Tipo Cont.": df_cons["tipo"], 
+                "Directo": "N",
+                "Destino": df_cons["pto_final"], 
+                "Fardos": "1", 
+                "contrato": df_cons["Orden_Pedido"], 
+                "item": "10",
+                "Naviera": df_cons["linea"], 
+                "Bodega": "", 
+                "ubicación": "", 
+                "Reserva": df_cons["reserva"], 
+                "Dus": df_cons["dus"], 
+                "fecha dus": df_cons["fecha_dus"], 
+                "agencia": df_cons["aga"]
+            }, copy=False)
 
-            # CONSOLIDADO VERDE
-            tools_filtrado_v = tools[tools['CONTENEDORINF'].isin(remate_verde['CONTENEDORREM'])]
-            remate_matched_v = remate_verde.set_index("CONTENEDORREM")
-            tools_matched_v = tools_filtrado_v.set_index("CONTENEDORINF")
-            
-            df_v = tools_matched_v.join(remate_matched_v, how="left", rsuffix="_rem")
-            
-            if not df_v.empty:
-                df_v[['contrato', 'item']] = df_v['Orden_Pedido'].astype(str).str.split('-', n=1, expand=True)
-                df_v['fecha_dus'] = pd.to_datetime(df_v['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
-
-                df_consolidado_v = pd.DataFrame({
-                    "Npaquete": df_v["Nro_Paquete"],
-                    "Contenedor": df_v.index,
-                    "Sello": df_v["sello_linea"],
-                    "Tara": df_v["tara"],
-                    "Dimension": df_v["medida"],
-                    "Tipo Cont.": df_v["tipo"],
-                    "Directo": "N",
-                    "Destino": df_v["pto_final"],
-                    "Paquetes": "1",
-                    "contrato": df_v["contrato"],
-                    "item": df_v["item"],
-                    "Naviera": df_v["linea"],
-                    "Bodega": "",
-                    "ubicación": "",
-                    "Reserva": df_v["reserva"],
-                    "Dus": df_v["dus"],
-                    "fecha dus": df_v["fecha_dus"],
-                    "agencia": df_v["aga"],
-                })
-
-                output_verde_cons = BytesIO()
-                df_consolidado_v.to_excel(output_verde_cons, index=False, engine='openpyxl')
-                output_verde_cons.seek(0)
-                archivos_output.append(("CMPC_Madera_Verde_Consolidado.xlsx", output_verde_cons))
+            output_consolidado = escribir_tablas_excel({"Sheet1": df_consolidado_final})
+            archivos_output.append(("CMPC_Papel_Consolidado.xlsx", output_consolidado))
+            registrar_tablas(opciones, {"CMPC_Papel_Consolidado": df_consolidado_final})
+
+    except Exception as e:
+        avisar(opciones, "warning", f"Error generando Consolidado: {e}")
+
+    return archivos_output
+
+def procesar_cmpc_papel(rutas, opciones=None):
+    st.info("Iniciando procesamiento CMPC Papel...")
+    try:
+        remate = leer_tabla(rutas['remate'])
+        # Papel sin prefiltro: el Remate_CMPC_Papel incluye todas las filas de Tools
+        tools = leer_referencia(rutas['tools'])
+
+        # 1. NORMALIZACIÓN DE COLUMNAS Y CONTENEDORES
+        remate, tools = normalizar_cmpc(remate, tools)
+        archivos_output = generar_cmpc_papel(remate, tools, opciones)
 
         if not archivos_output:
             return True, "Proceso finalizado, pero no se generaron archivos.", []
@@ -1535,148 +3250,98 @@ def procesar_cmpc_madera(rutas):
         return False, str(e), []
 
 # ==========================================
-#      LÓGICA CMPC PAPEL (FINAL - NOTA POR CONTENEDOR)
+#      LÓGICA CMPC PLYWOOD (FINAL - NOTA POR CONTENEDOR)
 # ==========================================
-def procesar_cmpc_papel(rutas):
-    st.info("Iniciando procesamiento CMPC Papel...")
-    try:
-        remate = pd.read_excel(rutas['remate'])
-        tools = pd.read_excel(rutas['tools'])
+def generar_cmpc_plywood(remate, tools, opciones=None):
+    archivos_output = []
 
-        archivos_output = []
+    remate_ply = remate[remate["producto"] == "PLYWOOD"]
+    
+    if remate_ply.empty: 
+        return archivos_output
 
-        # 1. NORMALIZACIÓN DE COLUMNAS Y CONTENEDORES
-        remate.columns = [c.strip() for c in remate.columns]
+    # GENERAR REMATE EXTRA
+    try:
+        remate_ply['Desc_Carga_Calc'] = remate_ply['cant_piezas'].astype(str) + " PIECES, PLYWOOD"
         
-        col_tara_rem = next((c for c in remate.columns if c.lower() == 'tara'), 'tara')
-        col_pto_rem = next((c for c in remate.columns if c.lower() in ['pto_descarga', 'pto_final', 'puerto_destino']), 'pto_descarga')
+        contenedores_unicos = remate_ply['CONTENEDORREM'].unique()
+        mapa_nota = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos)}
         
-        remate['sigla_cnt'] = remate['sigla_cnt'].astype(str).str.strip()
-        remate['nro_cnt'] = remate['nro_cnt'].astype(str).str.strip()
-        remate['dv_cnt'] = remate['dv_cnt'].astype(str).str.strip()
-
-        def construir_contenedor_rem(row):
-            sigla = str(row['sigla_cnt']).strip()
-            val_num = str(row['nro_cnt']).split('.')[0].strip()
-            dv = str(row['dv_cnt']).strip()
-            return f"{sigla}-{val_num.zfill(6)}-{dv}"
-
-        remate['CONTENEDORREM'] = remate.apply(construir_contenedor_rem, axis=1)
-
-        tools.columns = [c.strip() for c in tools.columns]
+        df_remate_extra = pd.DataFrame({
+            "Nota": remate_ply['CONTENEDORREM'].map(mapa_nota),
+            "Venta": remate_ply["pedido"],
+            "Reserva": remate_ply["reserva"],
+            "Contenedor": remate_ply["CONTENEDORREM"],
+            "Sello Naviera (Carrier Seal)": remate_ply["sello_linea"],
+            "Descripción de la Carga": remate_ply['Desc_Carga_Calc'],
+            "N° de Pqts.": remate_ply["cant_paquetes"],
+            "Tara del Contenedor": remate_ply["tara"],
+            "Volumen Bruto de la Carga": remate_ply["volumen"],
+            "Peso Bruto de la Carga (documental)": remate_ply["neto"],
+            "Volumen Bruto del Contenedor": remate_ply["volumen"],
+            "Comentarios del Contenedor": remate_ply["pto_final"]
+        }, copy=False)
         
-        tools['Cnt_Sigla'] = tools['Cnt_Sigla'].astype(str).str.strip()
-        tools['Cnt_Nro'] = tools['Cnt_Nro'].astype(str).str.strip()
-        tools['Cnt_DV'] = tools['Cnt_DV'].astype(str).str.strip()
+        output_remate = BytesIO()
+        df_remate_extra.to_excel(output_remate, index=False, engine='openpyxl')
+        output_remate.seek(0)
+        archivos_output.append(("Remate_CMPC_Plywood.xlsx", output_remate))
+        registrar_tablas(opciones, {"Remate_CMPC_Plywood": df_remate_extra})
         
-        col_sello_tools = next((c for c in tools.columns if c.lower() == 'sello_linea'), 'Sello_linea')
-        if col_sello_tools in tools.columns:
-            tools["Sello_linea_clean"] = tools[col_sello_tools].astype(str).str.replace("-", "", regex=False).str.strip()
-        else:
-            tools["Sello_linea_clean"] = ""
-
-        col_peso_tools = next((c for c in tools.columns if c.lower() == 'peso_lote'), None)
-        if col_peso_tools:
-            tools[col_peso_tools] = tools[col_peso_tools].astype(str).str.replace(',', '.', regex=False)
-            tools[col_peso_tools] = pd.to_numeric(tools[col_peso_tools], errors='coerce').fillna(0)
-        else:
-            tools['Peso_lote'] = 0
-            col_peso_tools = 'Peso_lote'
-
-        def construir_contenedor_tools(row):
-            sigla = str(row['Cnt_Sigla']).strip()
-            val_num = str(row['Cnt_Nro']).split('.')[0].strip()
-            dv = str(row['Cnt_DV']).strip()
-            return f"{sigla}-{val_num.zfill(6)}-{dv}"
-
-        tools['CONTENEDORINF'] = tools.apply(construir_contenedor_tools, axis=1)
-
-        # 2. GENERAR ARCHIVO NUEVO "REMATE_CMPC_PAPEL"
-        try:
-            grupo_tools = tools.groupby(['Orden_Pedido', 'CONTENEDORINF']).agg({
-                'Reserva': 'first',
-                'Sello_linea_clean': 'first',
-                'Nro_Paquete': 'count',
-                col_peso_tools: 'sum'
-            }).reset_index()
-
-            remate_subset = remate[['CONTENEDORREM', col_tara_rem, col_pto_rem]].drop_duplicates('CONTENEDORREM')
-            
-            df_nuevo = grupo_tools.merge(
-                remate_subset,
-                left_on='CONTENEDORINF',
-                right_on='CONTENEDORREM',
-                how='left'
-            )
-
-            contenedores_unicos = df_nuevo['CONTENEDORINF'].unique()
-            mapa_id_contenedor = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos)}
-            
-            df_exportar = pd.DataFrame()
-            df_exportar['Nota'] = df_nuevo['CONTENEDORINF'].map(mapa_id_contenedor)
-            df_exportar['Número Venta'] = df_nuevo['Orden_Pedido']
-            df_exportar['Reserva'] = df_nuevo['Reserva']
-            df_exportar['Contenedor'] = df_nuevo['CONTENEDORINF']
-            df_exportar['Sello Naviera (Carrier Seal)'] = df_nuevo['Sello_linea_clean']
-            df_exportar['Descripción de la Carga'] = "PAPEL KRAFT"
-            df_exportar['N° de Pqts.'] = df_nuevo['Nro_Paquete']
-            df_exportar['Tara del Contenedor'] = df_nuevo[col_tara_rem]
-            df_exportar['Peso Bruto de la Carga (documental)'] = df_nuevo[col_peso_tools]
-            df_exportar['Comentarios del Contenedor'] = df_nuevo[col_pto_rem]
-
-            output_remate = BytesIO()
-            df_exportar.to_excel(output_remate, index=False, engine='openpyxl')
-            output_remate.seek(0)
-            archivos_output.append(("Remate_CMPC_Papel.xlsx", output_remate))
+    except Exception as e:
+        avisar(opciones, "warning", f"Error generando Remate Extra Plywood: {e}")
 
-        except Exception as e:
-            st.warning(f"Error generando Remate Nuevo: {e}")
+    # LÓGICA ORIGINAL: CONSOLIDADO
+    remate_ply_cnt = remate_ply.drop_duplicates(subset=["CONTENEDORREM"])
+    tools_filt = tools[tools['CONTENEDORINF'].isin(remate_ply_cnt['CONTENEDORREM'])]
+    
+    df = unir_por_contenedor(opciones, "Tools x Remate Plywood", tools_filt, remate_ply_cnt)
+    
+    if not df.empty:
+        df['fecha_dus'] = pd.to_datetime(df['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
+        
+        df_consolidado = pd.DataFrame({
+            "Npaquete": df["Nro_Paquete"], 
+            "Contenedor": df.index, 
+            "Sello": df["sello_linea"],
+            "Tara": df["tara"], 
+            "Dimension": df["medida"], 
+            "Tipo Cont.": df["tipo"], 
+            "Directo": "N",
+            "Destino": df["pto_final"], 
+            "Fardos": "1", 
+            "contrato": df["Orden_Pedido"], 
+            "item": "10",
+            "Naviera": df["linea"], 
+            "Bodega": "", 
+            "ubicación": "", 
+            "Reserva": df["reserva"], 
+            "Dus": df["dus"], 
+            "fecha dus": df["fecha_dus"], 
+            "agencia": df["aga"]
+        }, copy=False)
+
+        output_consolidado = escribir_tablas_excel({"Sheet1": df_consolidado})
+        archivos_output.append(("CMPC_Plywood_Consolidado.xlsx", output_consolidado))
+        registrar_tablas(opciones, {"CMPC_Plywood_Consolidado": df_consolidado})
+
+    return archivos_output
+
+def procesar_cmpc_plywood(rutas, opciones=None):
+    st.info("Iniciando procesamiento CMPC Plywood...")
+    try:
+        remate = leer_tabla(rutas['remate'])
+        tools = leer_tools_cmpc(rutas['tools'], remate, por_contenedor=True)
 
-        # 3. GENERAR ARCHIVO ANTIGUO "CONSOLIDADO"
-        try:
-            remate_papel = remate[remate["producto"] == "PAPEL KRAFT"].copy()
-            tools_filt = tools[tools['CONTENEDORINF'].isin(remate_papel['CONTENEDORREM'])].copy()
-            
-            df_cons = tools_filt.set_index("CONTENEDORINF").join(
-                remate_papel.set_index("CONTENEDORREM"), 
-                how="left", 
-                rsuffix="_rem"
-            )
+        remate, tools = normalizar_cmpc(remate, tools)
 
-            if not df_cons.empty:
-                df_cons['fecha_dus'] = pd.to_datetime(df_cons['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
-                
-                df_consolidado_final = pd.DataFrame({
-                    "Etiqueta": df_cons["Nro_Paquete"], 
-                    "Contenedor": df_cons.index, 
-                    "Sello": df_cons["sello_linea"],
-                    "Tara": df_cons[col_tara_rem], 
-                    "Dimension": df_cons["medida"], 
-                    "Tipo Cont.": df_cons["tipo"], 
-                    "Directo": "N",
-                    "Destino": df_cons["pto_final"], 
-                    "Fardos": "1", 
-                    "contrato": df_cons["Orden_Pedido"], 
-                    "item": "10",
-                    "Naviera": df_cons["linea"], 
-                    "Bodega": "", 
-                    "ubicación": "", 
-                    "Reserva": df_cons["reserva"], 
-                    "Dus": df_cons["dus"], 
-                    "fecha dus": df_cons["fecha_dus"], 
-                    "agencia": df_cons["aga"]
-                })
-
-                output_consolidado = BytesIO()
-                df_consolidado_final.to_excel(output_consolidado, index=False, engine='openpyxl')
-                output_consolidado.seek(0)
-                archivos_output.append(("CMPC_Papel_Consolidado.xlsx", output_consolidado))
+        if (remate["producto"] == "PLYWOOD").sum() == 0:
+            return True, "No se encontraron registros con producto 'PLYWOOD' en el archivo Remate.", []
 
-        except Exception as e:
-            st.warning(f"Error generando Consolidado: {e}")
+        archivos_output = generar_cmpc_plywood(remate, tools, opciones)
 
         if not archivos_output:
-            return True, "Proceso finalizado, pero no se generaron archivos.", []
+            return True, "Proceso finalizado sin generar archivos.", []
 
         return True, "Archivos generados exitosamente", archivos_output
 
@@ -1687,121 +3352,85 @@ def procesar_cmpc_papel(rutas):
         return False, str(e), []
 
 # ==========================================
-#      LÓGICA CMPC PLYWOOD (FINAL - NOTA POR CONTENEDOR)
+#      CMPC NAVE COMPLETA (TODOS LOS PRODUCTOS)
 # ==========================================
-def procesar_cmpc_plywood(rutas):
-    st.info("Iniciando procesamiento CMPC Plywood...")
+GENERADORES_CMPC = {
+    "Celulosa": generar_cmpc_celulosa,
+    "Madera": generar_cmpc_madera,
+    "Papel": generar_cmpc_papel,
+    "Plywood": generar_cmpc_plywood,
+}
+
+def familia_cmpc(producto):
+    if not isinstance(producto, str):
+        return None
+    if producto in FAMILIAS_CMPC:
+        return FAMILIAS_CMPC[producto]
+    if producto.upper().strip().startswith("CELULOSA"):
+        return "Celulosa"
+    return None
+
+def ejecutar_en_hilos(tareas):
+    """
+    Ejecuta [(funcion, args), ...] en hilos y devuelve los resultados en el
+    mismo orden. Los hilos heredan el contexto de Streamlit para que sus
+    st.info lleguen a la sesión cuando el flujo corre en ella; las
+    advertencias van por avisar() y llegan también desde el trabajador.
+    """
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    ctx = get_script_run_ctx()
+
+    def inicializar():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(tareas)), initializer=inicializar) as pool:
+        futuros = [pool.submit(funcion, *args) for funcion, args in tareas]
+        return [f.result() for f in futuros]
+
+def procesar_cmpc_completo(rutas, opciones=None):
+    """
+    Nave completa: lee Remate y Tools una sola vez, arma las llaves de
+    contenedor una vez, separa el Remate por familia de producto con un solo
+    groupby y genera los entregables de cada familia en paralelo.
+    """
+    st.info("Iniciando procesamiento CMPC Nave Completa...")
     try:
-        remate = pd.read_excel(rutas['remate'])
-        tools = pd.read_excel(rutas['tools'])
+        remate = leer_tabla(rutas['remate'])
+        tools = leer_tools_cmpc(rutas['tools'], remate, por_contenedor=True, por_sello=True)
 
-        remate['sigla_cnt'] = remate['sigla_cnt'].astype(str).str.strip()
-        remate['nro_cnt'] = remate['nro_cnt'].astype(str).str.strip()
-        remate['dv_cnt'] = remate['dv_cnt'].astype(str).str.strip()
-        
-        tools['Cnt_Sigla'] = tools['Cnt_Sigla'].astype(str).str.strip()
-        tools['Cnt_Nro'] = tools['Cnt_Nro'].astype(str).str.strip()
-        tools['Cnt_DV'] = tools['Cnt_DV'].astype(str).str.strip()
-        
-        if "Sello_linea" in tools.columns:
-            tools["Sello_linea_clean"] = tools["Sello_linea"].astype(str).str.replace("-", "", regex=False).str.strip()
-
-        def construir_contenedor(row):
-            sigla = str(row['sigla_cnt']).strip()
-            val_num = str(row['nro_cnt'])
-            if '.' in val_num: numero = val_num.split('.')[0].strip()
-            else: numero = val_num.strip()
-            dv = str(row['dv_cnt']).strip()
-            numero = numero.zfill(6)
-            contenedor = f"{sigla}-{numero}-{dv}"
-            return contenedor
-
-        def construir_contenedor2(row):
-            sigla = str(row['Cnt_Sigla']).strip()
-            val_num = str(row['Cnt_Nro'])
-            if '.' in val_num: numero = val_num.split('.')[0].strip()
-            else: numero = val_num.strip()
-            dv = str(row['Cnt_DV']).strip()
-            numero = numero.zfill(6)
-            contenedor = f"{sigla}-{numero}-{dv}"
-            return contenedor
-
-        remate['CONTENEDORREM'] = remate.apply(construir_contenedor, axis=1)
-        tools['CONTENEDORINF'] = tools.apply(construir_contenedor2, axis=1)
-
-        archivos_output = []
-
-        remate_ply = remate[remate["producto"] == "PLYWOOD"].copy()
-        
-        if remate_ply.empty: 
-            return True, "No se encontraron registros con producto 'PLYWOOD' en el archivo Remate.", []
+        remate, tools = normalizar_cmpc(remate, tools)
 
-        # GENERAR REMATE EXTRA
-        try:
-            remate_ply['Desc_Carga_Calc'] = remate_ply['cant_piezas'].astype(str) + " PIECES, PLYWOOD"
-            
-            contenedores_unicos = remate_ply['CONTENEDORREM'].unique()
-            mapa_nota = {cnt: i+1 for i, cnt in enumerate(contenedores_unicos)}
-            
-            df_remate_extra = pd.DataFrame({
-                "Nota": remate_ply['CONTENEDORREM'].map(mapa_nota),
-                "Venta": remate_ply["pedido"],
-                "Reserva": remate_ply["reserva"],
-                "Contenedor": remate_ply["CONTENEDORREM"],
-                "Sello Naviera (Carrier Seal)": remate_ply["sello_linea"],
-                "Descripción de la Carga": remate_ply['Desc_Carga_Calc'],
-                "N° de Pqts.": remate_ply["cant_paquetes"],
-                "Tara del Contenedor": remate_ply["tara"],
-                "Volumen Bruto de la Carga": remate_ply["volumen"],
-                "Peso Bruto de la Carga (documental)": remate_ply["neto"],
-                "Volumen Bruto del Contenedor": remate_ply["volumen"],
-                "Comentarios del Contenedor": remate_ply["pto_final"]
-            })
-            
-            output_remate = BytesIO()
-            df_remate_extra.to_excel(output_remate, index=False, engine='openpyxl')
-            output_remate.seek(0)
-            archivos_output.append(("Remate_CMPC_Plywood.xlsx", output_remate))
-            
-        except Exception as e:
-            st.warning(f"Error generando Remate Extra Plywood: {e}")
+        # Clasificación evaluada una vez por producto distinto
+        productos = remate["producto"].dropna().unique()
+        mapa_familias = {p: familia_cmpc(p) for p in productos}
+        familias = remate["producto"].map(mapa_familias)
 
-        # LÓGICA ORIGINAL: CONSOLIDADO
-        tools_filt = tools[tools['CONTENEDORINF'].isin(remate_ply['CONTENEDORREM'])]
-        
-        df = tools_filt.set_index("CONTENEDORINF").join(remate_ply.set_index("CONTENEDORREM"), how="left", rsuffix="_rem")
-        
-        if not df.empty:
-            df['fecha_dus'] = pd.to_datetime(df['fecha_aceptacion'], errors='coerce').dt.strftime('%d/%m/%Y')
-            
-            df_consolidado = pd.DataFrame({
-                "Npaquete": df["Nro_Paquete"], 
-                "Contenedor": df.index, 
-                "Sello": df["sello_linea"],
-                "Tara": df["tara"], 
-                "Dimension": df["medida"], 
-                "Tipo Cont.": df["tipo"], 
-                "Directo": "N",
-                "Destino": df["pto_final"], 
-                "Fardos": "1", 
-                "contrato": df["Orden_Pedido"], 
-                "item": "10",
-                "Naviera": df["linea"], 
-                "Bodega": "", 
-                "ubicación": "", 
-                "Reserva": df["reserva"], 
-                "Dus": df["dus"], 
-                "fecha dus": df["fecha_dus"], 
-                "agencia": df["aga"]
-            })
+        sin_familia = sorted(str(p) for p, f in mapa_familias.items() if f is None)
+        if sin_familia:
+            avisar(opciones, "warning", f"Productos sin flujo CMPC asociado (se omiten): {', '.join(sin_familia)}")
+
+        tareas = []
+        for familia, remate_familia in remate.groupby(familias, sort=False):
+            if familia == "Celulosa":
+                tools_familia = tools[tools["Sello_linea_clean"].isin(remate_familia["sello_linea_clean"])]
+            else:
+                tools_familia = tools[tools["CONTENEDORINF"].isin(remate_familia["CONTENEDORREM"])]
+            tareas.append((familia, remate_familia, tools_familia))
 
-            output_consolidado = BytesIO()
-            df_consolidado.to_excel(output_consolidado, index=False, engine='openpyxl')
-            output_consolidado.seek(0)
-            archivos_output.append(("CMPC_Plywood_Consolidado.xlsx", output_consolidado))
+        orden = list(GENERADORES_CMPC)
+        tareas.sort(key=lambda t: orden.index(t[0]))
+        st.info(f"Familias detectadas: {', '.join(t[0] for t in tareas) or 'ninguna'}")
+
+        resultados = ejecutar_en_hilos([
+            (GENERADORES_CMPC[familia], (remate_familia, tools_familia, opciones))
+            for familia, remate_familia, tools_familia in tareas
+        ])
+
+        archivos_output = [archivo for archivos in resultados for archivo in archivos]
 
         if not archivos_output:
-            return True, "Proceso finalizado sin generar archivos.", []
+            return True, "Proceso finalizado, pero no se generaron archivos.", []
 
         return True, "Archivos generados exitosamente", archivos_output
 
@@ -1818,7 +3447,7 @@ CONFIG_ARCHIVOS = {
     "Madera": [
         {"id": "programa", "nombre": "Programa", "opcional": False},
         {"id": "saldos",   "nombre": "Saldos",   "opcional": True},
-        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True},
+        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True, "tipos": ['xlsx', 'xls']},
         {"id": "despacho", "nombre": "Despacho", "opcional": False},
         {"id": "detalle",  "nombre": "Detalle",  "opcional": False},
         {"id": "informe",  "nombre": "Informe",  "opcional": False},
@@ -1828,18 +3457,18 @@ CONFIG_ARCHIVOS = {
         {"id": "programa", "nombre": "Programa", "opcional": False},
         {"id": "saldos",   "nombre": "Saldos",   "opcional": True},
         {"id": "tools",    "nombre": "Tools",    "opcional": False},
-        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True},
+        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True, "tipos": ['xlsx', 'xls']},
     ],
     "Celulosa DP": [
         {"id": "programa", "nombre": "Programa", "opcional": False},
         {"id": "saldos",   "nombre": "Saldos",   "opcional": True},
         {"id": "informe",  "nombre": "Informe",  "opcional": False},
-        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True},
+        {"id": "historico","nombre": "Remates Ant.", "opcional": True, "multiple": True, "tipos": ['xlsx', 'xls']},
     ],
     "SAG": [
         {"id": "remate", "nombre": "Remate", "opcional": False},
-        {"id": "picking", "nombre": "Picking", "opcional": False},
-        {"id": "sag",   "nombre": "SIF",   "opcional": False, "multiple": True}
+        {"id": "picking", "nombre": "Picking", "opcional": False, "tipos": ['xlsx', 'xls']},
+        {"id": "sag",   "nombre": "SIF",   "opcional": False, "multiple": True, "tipos": ['xlsx', 'xls']}
     ],
     "CMPC Celulosa": [
         {"id": "remate", "nombre": "Remate", "opcional": False},
@@ -1856,9 +3485,544 @@ CONFIG_ARCHIVOS = {
     "CMPC Plywood": [
         {"id": "remate", "nombre": "Remate", "opcional": False},
         {"id": "tools",  "nombre": "Tools",  "opcional": False},
-    ]        
+    ],
+    "CMPC Nave Completa": [
+        {"id": "remate", "nombre": "Remate", "opcional": False},
+        {"id": "tools",  "nombre": "Tools",  "opcional": False},
+    ]
+}
+
+# ==========================================
+#      VALIDACIÓN PREVIA (SOLO ENCABEZADOS)
+# ==========================================
+# Columnas obligatorias por flujo y por archivo. La llave de hoja None indica
+# la primera hoja del libro; una tupla acepta cualquiera de sus alternativas
+# (nombre original del export o nombre ya mapeado estilo DBF).
+ESQUEMAS_ENTRADA = {
+    "Madera": {
+        "programa": {None: ["Entrega", "Nave", "PRODINFO", "RESERVA", "DESTINO"]},
+        "saldos":   {None: ["Entrega", "Box Saldo"]},
+        "despacho": {None: [("cor_ano", "COR_ANO,N,16,0"), ("cor_mov", "COR_MOV,N,16,0"),
+                            ("sigla", "SIGLA,C,4"), ("numero", "NUMERO,N,16,0"), ("dv", "DV,C,1"),
+                            ("contrato", "CONTRATO,C,50"), ("sello", "SELLO,C,15"), ("peso", "PESO,N,16,0")]},
+        "detalle":  {None: [("sello_linea", "SELLO_LINE,C,20"), ("sello_inspector", "SELLO_INSP,C,20"),
+                            ("dus", "DUS,C,255"), ("restriccion_peso", "RESTRICCIO,N,16,0"),
+                            ("fecha_consolidacion", "FECHA_CONS,D")]},
+        "informe":  {None: [("sigla_cnt", "SIGLA_CNT,C,4"), ("nro_cnt", "NRO_CNT,N,16,0"), ("dv_cnt", "DV_CNT,C,1"),
+                            ("tara_cnt", "TARA_CNT,N,16,0"), ("material", "MATERIAL,C,50"),
+                            ("codigo_barra", "CODIGO_BAR,C,50"), ("orden_pedido", "ORDEN_PEDI,C,12"),
+                            ("peso", "PESO,N,17,4"), ("contrato", "CONTRATO,C,50")]},
+        "zoopp":    {None: [("loteof", "loteof,C,10"), ("vollote", "vollote,C,15"), ("posped", "posped,N,6,0"),
+                            ("desmat", "desmat,C,40"), "clase_merc"]},
+    },
+    "Celulosa BKP EKP UKP": {
+        "programa": {None: ["Entrega", "Nave", "PRODINFO", "RESERVA", "DESTINO", "NAV"]},
+        "saldos":   {None: ["Entrega", "Box Saldo"]},
+        "tools":    {None: ["Contrato", "Contenedor", "Expedicion", "Tara", "Cantidad", "Sello_linea",
+                            "Reserva", "Orden_Embarque", "Max_Gross"]},
+    },
+    "Celulosa DP": {
+        "programa": {None: ["Entrega", "Nave", "PRODINFO", "RESERVA", "DESTINO", "NAV"]},
+        "saldos":   {None: ["Entrega", "Box Saldo"]},
+        "informe":  {None: ["contrato", "sigla_cnt", "nro_cnt", "dv_cnt", "tara_cnt", "marca", "sello",
+                            "orden_embarque", "reserva", "maxgross"]},
+    },
+    "SAG": {
+        "remate":  {None: ["Contenedor"]},
+        "picking": {"Posicion": ["ID Cabecera", "Lote", "Peso"],
+                    "Cabecera": ["ID Cabecera", "ID Contenedor"]},
+        "sag":     {"detalle": ["Codigo_Barra", "SIF"]},
+    },
+    "CMPC Celulosa": {
+        "remate": {None: ["producto", "sello_linea", "medida", "linea", "reserva", "dus", "aga"]},
+        "tools":  {None: ["Sello_linea", "Expedicion", "Contenedor", "Tara", "Tipo_Contenedor", "Pto_Destino",
+                          "Cantidad", "Contrato", "fecha_aceptacion"]},
+    },
+    "CMPC Madera": {
+        "remate":  {None: ["sigla_cnt", "nro_cnt", "dv_cnt", "producto", "cant_piezas", "pedido", "reserva",
+                           "sello_linea", "cant_paquetes", "tara", "volumen", "neto", "pto_final"]},
+        "informe": {None: ["Cnt_Sigla", "Cnt_Nro", "Cnt_DV", "Nro_Paquete", "Orden_Pedido", "fecha_aceptacion"]},
+    },
+    "CMPC Papel": {
+        "remate": {None: ["sigla_cnt", "nro_cnt", "dv_cnt", "producto"]},
+        # Sin 'Reserva': si falta, solo se omite el Remate nuevo con una advertencia
+        "tools":  {None: ["Cnt_Sigla", "Cnt_Nro", "Cnt_DV", "Orden_Pedido", "Nro_Paquete"]},
+    },
+    "CMPC Plywood": {
+        "remate": {None: ["sigla_cnt", "nro_cnt", "dv_cnt", "producto", "cant_piezas", "pedido", "reserva",
+                          "sello_linea", "cant_paquetes", "tara", "volumen", "neto", "pto_final"]},
+        "tools":  {None: ["Cnt_Sigla", "Cnt_Nro", "Cnt_DV", "Nro_Paquete", "Orden_Pedido", "fecha_aceptacion"]},
+    },
+    "CMPC Nave Completa": {
+        "remate": {None: ["sigla_cnt", "nro_cnt", "dv_cnt", "producto", "sello_linea"]},
+        "tools":  {None: ["Cnt_Sigla", "Cnt_Nro", "Cnt_DV", "Sello_linea", "Nro_Paquete", "Orden_Pedido"]},
+    },
+}
+
+def leer_encabezados(ruta):
+    """
+    Lee solo la fila de títulos de cada hoja (y los nombres de hoja) sin
+    parsear el contenido. Devuelve {nombre_hoja: [columnas]}, en el orden
+    del libro; para DBF, CSV y Parquet la única hoja se llama None.
+    """
+    extension = os.path.splitext(ruta)[1].lower()
+
+    if extension == '.dbf':
+        table = DBF(ruta, encoding='latin-1', char_decode_errors='ignore', load=False)
+        # dbfread entrega los nombres de campo en mayúsculas; los esquemas DBF van en minúsculas
+        return {None: [str(c).strip().lower() for c in table.field_names]}
+
+    if extension == '.csv':
+        encoding, separador = detectar_formato_csv(ruta)
+        with open(ruta, newline='', encoding=encoding) as f:
+            fila = next(csv.reader(f, delimiter=separador), [])
+        return {None: [c.strip().lstrip('\ufeff') for c in fila if c.strip()]}
+
+    if extension == '.parquet':
+        if pa_parquet is not None:
+            return {None: [str(c).strip() for c in pa_parquet.read_schema(ruta).names]}
+        return {None: [str(c).strip() for c in pd.read_parquet(ruta).columns]}
+
+    if extension == '.xls':
+        import xlrd
+        libro = xlrd.open_workbook(ruta, on_demand=True)
+        try:
+            hojas = {}
+            for nombre in libro.sheet_names():
+                hoja = libro.sheet_by_name(nombre)
+                fila = hoja.row_values(0) if hoja.nrows else []
+                hojas[nombre] = [str(c).strip() for c in fila if c not in (None, "")]
+                libro.unload_sheet(nombre)
+            return hojas
+        finally:
+            libro.release_resources()
+
+    wb = load_workbook(ruta, read_only=True, keep_links=False)
+    try:
+        hojas = {}
+        for ws in wb.worksheets:
+            fila = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            hojas[ws.title] = [str(c).strip() for c in fila if c is not None]
+        return hojas
+    finally:
+        wb.close()
+
+def columnas_faltantes(esquema, encabezados):
+    """
+    Compara un esquema {hoja: [columnas]} contra los encabezados leídos.
+    Devuelve una lista de textos con lo que falta (vacía si cumple).
+    """
+    faltantes = []
+    for hoja, requeridas in esquema.items():
+        if hoja is None:
+            columnas = next(iter(encabezados.values()), [])
+        elif hoja in encabezados:
+            columnas = encabezados[hoja]
+        else:
+            faltantes.append(f"hoja '{hoja}'")
+            continue
+
+        presentes = set(columnas)
+        for requerida in requeridas:
+            alternativas = requerida if isinstance(requerida, tuple) else (requerida,)
+            if not any(alt in presentes for alt in alternativas):
+                donde = f" (hoja '{hoja}')" if hoja else ""
+                faltantes.append(f"columna '{alternativas[0]}'{donde}")
+    return faltantes
+
+def validar_preflight(tipo_material, rutas):
+    """
+    Valida los encabezados de todos los archivos cargados contra el esquema
+    del flujo antes de cualquier lectura completa. Detecta además archivos
+    cargados en el casillero equivocado. Devuelve una lista de errores.
+    """
+    esquemas = ESQUEMAS_ENTRADA.get(tipo_material, {})
+    nombres = {item["id"]: item["nombre"] for item in CONFIG_ARCHIVOS.get(tipo_material, [])}
+
+    encabezados = {}
+    errores = []
+    for slot in esquemas:
+        valor = rutas.get(slot)
+        if valor is None or (isinstance(valor, (str, list)) and not valor):
+            continue
+        # Tablas en memoria (flujo encadenado): se validan sus columnas directamente
+        if isinstance(valor, pd.DataFrame) or (pa is not None and isinstance(valor, pa.Table)):
+            encabezados[slot] = [("(en memoria)", {None: [str(c) for c in _nombres_columnas(valor)]})]
+            continue
+        if isinstance(valor, dict):
+            encabezados[slot] = [("(en memoria)", {h: [str(c) for c in _nombres_columnas(df)] for h, df in valor.items()})]
+            continue
+        lista = [valor] if isinstance(valor, str) else list(valor)
+        encabezados[slot] = []
+        for ruta in lista:
+            try:
+                encabezados[slot].append((ruta, leer_encabezados(ruta)))
+            except Exception as e:
+                errores.append(f"{nombres.get(slot, slot)}: no se pudo leer {os.path.basename(ruta)} ({e})")
+
+    for slot, archivos in encabezados.items():
+        for ruta, cab in archivos:
+            faltantes = columnas_faltantes(esquemas[slot], cab)
+            if not faltantes:
+                continue
+
+            mensaje = (f"{nombres.get(slot, slot)} ({os.path.basename(ruta)}): falta "
+                       + ", ".join(faltantes))
+            candidatos = [
+                nombres.get(otro, otro) for otro, esquema in esquemas.items()
+                if otro != slot and not columnas_faltantes(esquema, cab)
+            ]
+            if candidatos:
+                mensaje += f". El archivo parece corresponder a: {', '.join(candidatos)}"
+            errores.append(mensaje)
+
+    return errores
+
+# ==========================================
+#   EJECUCIÓN EN PROCESO TRABAJADOR
+# ==========================================
+# Cada trabajo corre en un proceso hijo que se recicla tras N trabajos o si
+# su memoria pico supera el límite; así la memoria fragmentada de pandas y
+# openpyxl vuelve al sistema y el proceso de Streamlit no crece con el turno
+PROCESOS = {
+    "Madera": procesar_madera,
+    "Celulosa BKP EKP UKP": procesar_celulosa_cb,
+    "Celulosa DP": procesar_celulosa_sb,
+    "SAG": procesar_sag,
+    "CMPC Celulosa": procesar_cmpc_celulosa,
+    "CMPC Madera": procesar_cmpc_madera,
+    "CMPC Papel": procesar_cmpc_papel,
+    "CMPC Plywood": procesar_cmpc_plywood,
+    "CMPC Nave Completa": procesar_cmpc_completo,
 }
 
+USAR_TRABAJADOR = os.environ.get("AGENTECFS_TRABAJADOR", "1") != "0"
+TRABAJOS_POR_PROCESO = int(os.environ.get("AGENTECFS_TRABAJOS_POR_PROCESO", "5"))
+LIMITE_RSS_TRABAJADOR_MB = float(os.environ.get("AGENTECFS_LIMITE_RSS_MB", "1024"))
+# Un trabajo que no termina en este plazo se aborta y su proceso se mata
+TIEMPO_MAX_TRABAJO_S = float(os.environ.get("AGENTECFS_TIEMPO_MAX_TRABAJO_S", "1800"))
+DIR_TRABAJOS = os.path.join(DIR_DATOS, "trabajos")
+
+def trabajador_disponible():
+    """Requiere el forkserver (ver contexto_procesos); no aplica a Windows ni al ejecutable."""
+    return USAR_TRABAJADOR and contexto_procesos() is not None
+
+def _rss_pico_mb():
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB en Linux
+
+def _trabajo_en_proceso(funcion, rutas, opciones, dir_trabajo):
+    """
+    Corre dentro del trabajador: deja los entregables y las opciones
+    resultantes (traza, tablas) en `dir_trabajo` y devuelve solo rutas.
+    El nivel 1 de la caché de tablas se vacía al terminar.
+    """
+    try:
+        exito, mensaje, archivos = funcion(rutas, opciones)
+        salidas = []
+        for nombre, contenido in archivos:
+            ruta = os.path.join(dir_trabajo, os.path.basename(nombre))
+            with open(ruta, 'wb') as f:
+                f.write(contenido.getvalue() if hasattr(contenido, "getvalue") else contenido)
+            salidas.append((nombre, ruta))
+        # Las tablas vuelven como Arrow IPC, que la UI mapea en memoria sin copiarlas
+        opciones["tablas"] = {
+            nombre: tablas_a_archivos(tabla, os.path.join(dir_trabajo, f"tabla_{i}"))
+            for i, (nombre, tabla) in enumerate(opciones.get("tablas", {}).items())
+        }
+        ruta_opciones = os.path.join(dir_trabajo, "opciones.pkl")
+        pd.to_pickle(opciones, ruta_opciones)
+        return exito, mensaje, salidas, ruta_opciones, _rss_pico_mb()
+    finally:
+        vaciar_cache_memoria()
+
+@st.cache_resource
+def _trabajadores_libres():
+    """Trabajadores ociosos [pool, trabajos_hechos], compartidos entre sesiones."""
+    return {"libres": [], "candado": threading.Lock()}
+
+def _tomar_trabajador():
+    estado = _trabajadores_libres()
+    with estado["candado"]:
+        if estado["libres"]:
+            return estado["libres"].pop()
+    # Desde el forkserver: un fork directo del servidor de Streamlit (multihilo)
+    # puede heredar candados tomados, p. ej. el de _cache_tablas()
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=contexto_procesos())
+    return [pool, 0]
+
+def _descartar_trabajador(trabajador):
+    """Mata el proceso del trabajador (colgado o caído) y libera su pool sin esperarlo."""
+    pool = trabajador[0]
+    for proceso in list((pool._processes or {}).values()):
+        proceso.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _devolver_trabajador(trabajador, rss_mb):
+    trabajador[1] += 1
+    if trabajador[1] >= TRABAJOS_POR_PROCESO or rss_mb > LIMITE_RSS_TRABAJADOR_MB:
+        logger.info("Reciclando trabajador (%d trabajos, %.0f MB)", trabajador[1], rss_mb)
+        trabajador[0].shutdown(wait=False)
+        return
+    estado = _trabajadores_libres()
+    with estado["candado"]:
+        estado["libres"].append(trabajador)
+
+def ejecutar_trabajo(funcion, rutas, opciones):
+    """
+    Ejecuta un flujo `procesar_*` en un trabajador reciclable (o en el
+    mismo proceso si no hay forkserver). Las tablas en memoria de `rutas`
+    viajan como Arrow IPC, los entregables vuelven por archivo y `opciones`
+    se actualiza con lo que el flujo dejó en ella. Un trabajo que excede
+    TIEMPO_MAX_TRABAJO_S se aborta matando su proceso.
+    """
+    if not trabajador_disponible():
+        return funcion(rutas, opciones)
+
+    os.makedirs(DIR_TRABAJOS, exist_ok=True)
+    dir_trabajo = tempfile.mkdtemp(dir=DIR_TRABAJOS)
+    trabajador = _tomar_trabajador()
+    try:
+        rutas = {
+            slot: tablas_a_archivos(valor, os.path.join(dir_trabajo, f"entrada_{slot}"))
+            for slot, valor in rutas.items()
+        }
+        futuro = trabajador[0].submit(_trabajo_en_proceso, funcion, rutas, opciones, dir_trabajo)
+        try:
+            exito, mensaje, salidas, ruta_opciones, rss_mb = futuro.result(timeout=TIEMPO_MAX_TRABAJO_S)
+        except BrokenProcessPool:
+            _descartar_trabajador(trabajador)
+            return False, "El proceso de trabajo terminó inesperadamente (¿memoria insuficiente?).", []
+        except TiempoAgotado:
+            _descartar_trabajador(trabajador)
+            return False, f"El proceso de trabajo superó el tiempo máximo ({TIEMPO_MAX_TRABAJO_S:.0f} s) y se detuvo.", []
+        _devolver_trabajador(trabajador, rss_mb)
+
+        opciones.update(pd.read_pickle(ruta_opciones))
+        if opciones.get("tablas"):
+            opciones["tablas"] = {nombre: archivos_a_tablas(t) for nombre, t in opciones["tablas"].items()}
+        archivos = []
+        for nombre, ruta in salidas:
+            with open(ruta, 'rb') as f:
+                archivos.append((nombre, BytesIO(f.read())))
+        return exito, mensaje, archivos
+    finally:
+        shutil.rmtree(dir_trabajo, ignore_errors=True)
+
+# ==========================================
+#   MEMORIZACIÓN DE EJECUCIONES
+# ==========================================
+# Mismo flujo, mismas entradas (por contenido) y misma versión del motor dan
+# los mismos entregables: se devuelven sin recalcular. La fecha del
+# encabezado no entra en la clave: se guarda una marca y se pone al entregar.
+USAR_MEMORIA_EJECUCIONES = os.environ.get("AGENTECFS_MEMORIZAR", "1") != "0"
+CACHE_EJECUCIONES_MB = float(os.environ.get("AGENTECFS_CACHE_EJECUCIONES_MB", "1024"))
+DIR_EJECUCIONES = os.path.join(DIR_DATOS, "ejecuciones")
+MARCA_FECHA = "{{FECHA_REPORTE}}"
+
+def fecha_reporte(opciones):
+    """Fecha del encabezado: la de opciones["fecha_reporte"] o la de hoy."""
+    return (opciones or {}).get("fecha_reporte") or datetime.datetime.now().strftime("%d/%m/%Y")
+
+def version_motor(motor):
+    """Versión del código de la app más la de la librería del motor elegido."""
+    try:
+        codigo = huella_archivo(os.path.abspath(__file__))[:12]
+    except (NameError, OSError):
+        codigo = "sin-version"
+    librerias = {"pandas": pd, "duckdb": duckdb, "polars": pl}
+    return f"{codigo}/{motor}-{getattr(librerias.get(motor), '__version__', None)}/pandas-{pd.__version__}"
+
+def _huella_entrada(valor):
+    if isinstance(valor, str):
+        return huella_archivo(valor)
+    if isinstance(valor, (list, tuple)):
+        return [_huella_entrada(v) for v in valor]
+    if isinstance(valor, dict):
+        return {str(k): _huella_entrada(v) for k, v in valor.items()}
+    if pa is not None and isinstance(valor, pa.Table):
+        valor = valor.to_pandas()
+    if isinstance(valor, pd.DataFrame):
+        h = hashlib.sha1(pd.util.hash_pandas_object(valor, index=False).values.tobytes())
+        h.update(json.dumps([[str(c), str(t)] for c, t in valor.dtypes.items()]).encode())
+        return h.hexdigest()
+    return None if valor is None else str(valor)
+
+def clave_ejecucion(tipo_material, rutas, motor):
+    partes = [tipo_material, version_motor(motor), {slot: _huella_entrada(v) for slot, v in rutas.items()}]
+    if tipo_material == "SAG":
+        # SAG también depende de los SIF acumulados en el índice (que se pueden quitar)
+        partes.append(revision_indice_sif())
+    return hashlib.sha1(json.dumps(partes, sort_keys=True).encode()).hexdigest()
+
+def renderizar_fecha(archivos, fecha):
+    """
+    Reemplaza MARCA_FECHA por `fecha` en los textos de cada .xlsx (hojas y
+    textos compartidos), sin volver a abrir el libro con openpyxl.
+    """
+    marca = MARCA_FECHA.encode()
+    salida = []
+    for nombre, contenido in archivos:
+        datos = contenido.getvalue()
+        if nombre.endswith('.xlsx'):
+            with zipfile.ZipFile(BytesIO(datos)) as origen:
+                partes = {
+                    item.filename: origen.read(item.filename) for item in origen.infolist()
+                    if item.filename == 'xl/sharedStrings.xml' or item.filename.startswith('xl/worksheets/')
+                }
+                if any(marca in parte for parte in partes.values()):
+                    destino_bytes = BytesIO()
+                    with zipfile.ZipFile(destino_bytes, 'w', zipfile.ZIP_DEFLATED) as destino:
+                        for item in origen.infolist():
+                            if item.filename in partes:
+                                destino.writestr(item, partes[item.filename].replace(marca, fecha.encode()))
+                            else:
+                                destino.writestr(item, origen.read(item.filename))
+                    datos = destino_bytes.getvalue()
+        salida.append((nombre, BytesIO(datos)))
+    return salida
+
+def _relativas(valor, base):
+    if isinstance(valor, dict):
+        return {k: _relativas(v, base) for k, v in valor.items()}
+    return os.path.relpath(valor, base) if isinstance(valor, str) else valor
+
+def _absolutas(valor, base):
+    if isinstance(valor, dict):
+        return {k: _absolutas(v, base) for k, v in valor.items()}
+    return os.path.join(base, valor) if isinstance(valor, str) else valor
+
+def _guardar_ejecucion(clave, mensaje, archivos, opciones):
+    directorio = os.path.join(DIR_EJECUCIONES, clave)
+    temporal = f"{directorio}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(temporal, exist_ok=True)
+        guardados = []
+        for i, (nombre, contenido) in enumerate(archivos):
+            with open(os.path.join(temporal, f"archivo_{i}"), 'wb') as f:
+                f.write(contenido.getvalue())
+            guardados.append((nombre, f"archivo_{i}"))
+        tablas = {
+            nombre: _relativas(tablas_a_archivos(tabla, os.path.join(temporal, f"tabla_{i}")), temporal)
+            for i, (nombre, tabla) in enumerate((opciones.get("tablas") or {}).items())
+        }
+        pd.to_pickle(
+            {"mensaje": mensaje, "archivos": guardados, "tablas": tablas, "traza": opciones.get("traza"),
+             "avisos": opciones.get("avisos", [])},
+            os.path.join(temporal, "resultado.pkl"),
+        )
+        os.replace(temporal, directorio)
+    except OSError as e:
+        logger.warning("No se pudo memorizar la ejecución: %s", e)
+        shutil.rmtree(temporal, ignore_errors=True)
+        return
+    _podar_ejecuciones()
+
+def _cargar_ejecucion(clave, opciones):
+    directorio = os.path.join(DIR_EJECUCIONES, clave)
+    ruta = os.path.join(directorio, "resultado.pkl")
+    if not os.path.exists(ruta):
+        return None
+    try:
+        resultado = pd.read_pickle(ruta)
+        archivos = []
+        for nombre, archivo in resultado["archivos"]:
+            with open(os.path.join(directorio, archivo), 'rb') as f:
+                archivos.append((nombre, BytesIO(f.read())))
+        tablas = {n: archivos_a_tablas(_absolutas(t, directorio)) for n, t in resultado["tablas"].items()}
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Ejecución memorizada ilegible (%s): %s", clave, e)
+        return None
+    os.utime(directorio)  # marca de uso para el LRU
+    opciones["tablas"] = tablas
+    opciones["traza"] = resultado["traza"]
+    opciones["avisos"] = resultado.get("avisos", [])
+    return True, resultado["mensaje"], archivos
+
+def _podar_ejecuciones():
+    """Borra las ejecuciones usadas hace más tiempo hasta quedar bajo CACHE_EJECUCIONES_MB."""
+    entradas = []
+    for nombre in os.listdir(DIR_EJECUCIONES):
+        directorio = os.path.join(DIR_EJECUCIONES, nombre)
+        if nombre.endswith('.tmp') or not os.path.isdir(directorio):
+            continue
+        tamano = sum(os.path.getsize(os.path.join(directorio, f)) for f in os.listdir(directorio))
+        entradas.append((os.path.getmtime(directorio), tamano, directorio))
+    total = sum(tamano for _, tamano, _ in entradas)
+    for _, tamano, directorio in sorted(entradas):
+        if total <= CACHE_EJECUCIONES_MB * 1024 * 1024:
+            break
+        shutil.rmtree(directorio, ignore_errors=True)
+        total -= tamano
+
+def ejecutar_memorizado(tipo_material, rutas, opciones):
+    """
+    `ejecutar_trabajo` con memoria por contenido: si la misma ejecución ya
+    se hizo, devuelve sus entregables (con la fecha de hoy) sin recalcular.
+    Deja opciones["memorizado"] indicando si hubo acierto.
+    """
+    funcion = PROCESOS[tipo_material]
+    opciones["memorizado"] = False
+    if not USAR_MEMORIA_EJECUCIONES:
+        return ejecutar_trabajo(funcion, rutas, opciones)
+
+    fecha = fecha_reporte(opciones)
+    flujo = tipo_material + (f" por {opciones['particion']}" if opciones.get("particion") else "")
+    clave = clave_ejecucion(flujo, rutas, opciones.get("motor", "pandas"))
+    resultado = _cargar_ejecucion(clave, opciones)
+    if resultado is not None:
+        opciones["memorizado"] = True
+    else:
+        opciones["fecha_reporte"] = MARCA_FECHA
+        resultado = ejecutar_trabajo(funcion, rutas, opciones)
+        opciones["fecha_reporte"] = fecha
+        if resultado[0]:
+            os.makedirs(DIR_EJECUCIONES, exist_ok=True)
+            _guardar_ejecucion(clave, resultado[1], resultado[2], opciones)
+    exito, mensaje, archivos = resultado
+    return exito, mensaje, renderizar_fecha(archivos, fecha)
+
+# ==========================================
+#   PUNTOS DE CONTROL POR ETAPA
+# ==========================================
+USAR_PUNTOS_CONTROL = os.environ.get("AGENTECFS_PUNTOS_CONTROL", "1") != "0"
+
+def etapa_guardada(opciones, etapa, rutas, funcion):
+    """
+    Ejecuta `funcion()` -> (df, meta) o retoma su resultado guardado para
+    las mismas entradas (huella de `rutas`), motor y versión. Se guarda en
+    la caché de tablas, junto con la traza y los avisos de la etapa. Un df
+    None (fin anticipado) no se guarda.
+    """
+    if not USAR_PUNTOS_CONTROL:
+        return funcion()
+    opciones_etapa = opciones or {}
+    clave = clave_ejecucion(etapa, rutas, opciones_etapa.get("motor", "pandas"))
+    traza = opciones_etapa.get("traza")
+    avisos = opciones_etapa.setdefault("avisos", [])
+    calculada = []
+
+    def lector():
+        inicio = len(traza) if traza is not None else 0
+        inicio_avisos = len(avisos)
+        df, meta = funcion()
+        calculada.append(True)
+        meta = dict(meta, avisos=avisos[inicio_avisos:])
+        if traza is not None:
+            meta = dict(meta, traza=traza[inicio:])
+        return df, meta
+
+    df, meta = leer_en_cache(clave, lector)
+    if not calculada:
+        st.info(f"Retomando desde el punto de control guardado: {etapa}.")
+        if traza is not None:
+            traza.extend(meta.get("traza", []))
+        avisos.extend(meta.get("avisos", []))
+    meta.pop("traza", None)
+    meta.pop("avisos", None)
+    return df, meta
+
 def get_file_uploader_key(file_id, session_id):
     return f"{file_id}_{session_id}"
 
@@ -2034,6 +4198,37 @@ def mostrar_menu_materiales_cmpc():
             st.session_state.tipo_material = "CMPC Plywood"
             st.rerun()
 
+    if st.button("**Nave Completa (todos los productos)**", use_container_width=True):
+        st.session_state.tipo_material = "CMPC Nave Completa"
+        st.rerun()
+
+def _quitar_seleccion_sif():
+    # Callback: corre antes del rerun, cuando aún se puede vaciar la selección
+    st.session_state.sif_quitados = quitar_del_indice_sif(st.session_state.sif_a_quitar)
+    st.session_state.sif_a_quitar = []
+
+def mostrar_indice_sif():
+    """Lista los SIF acumulados en el índice y permite quitar uno cargado por error."""
+    partes = partes_indice_sif()
+    with st.expander(f"🗂️ Índice SIF acumulado ({len(partes)} archivos)"):
+        if not partes:
+            st.caption("Aún no se ha ingerido ningún archivo SIF.")
+            return
+        etiquetas = {
+            clave: f"{nombre} · {fecha or 'sin fecha'} · {filas} códigos"
+            for clave, nombre, fecha, filas in partes
+        }
+        seleccion = st.multiselect(
+            "Archivos a quitar del índice",
+            list(etiquetas),
+            format_func=etiquetas.get,
+            key="sif_a_quitar",
+        )
+        st.button("Quitar del índice", disabled=not seleccion, on_click=_quitar_seleccion_sif)
+        if st.session_state.get("sif_quitados"):
+            st.success(f"{st.session_state.pop('sif_quitados')} archivo(s) quitado(s); "
+                       "el índice se recalculó con los restantes.")
+
 def mostrar_panel_proceso():
     st.header(f"Panelt: {st.session_state.tipo_material}")
     
@@ -2054,14 +4249,25 @@ def mostrar_panel_proceso():
     
     # Crear formulario para subir archivos
     with st.form("upload_form"):
+        # SAG encadenado: reutiliza Remate SAG y Picking de la última corrida Madera
+        usar_madera = False
+        if st.session_state.tipo_material == "SAG" and st.session_state.get('tablas_madera'):
+            usar_madera = st.checkbox(
+                "Usar Remate SAG y Picking de la última corrida Madera (sin volver a cargarlos)",
+                value=True,
+                key="sag_encadenado"
+            )
+
         for item in lista_archivos:
+            if usar_madera and item["id"] in ("remate", "picking"):
+                continue
             es_multiple = item.get("multiple", False)
             required = "" if item["opcional"] else "🔴"
             
             if es_multiple:
                 uploaded_files = st.file_uploader(
                     f"{required} {item['nombre']} {'(Múltiple)' if es_multiple else ''}",
-                    type=['xlsx', 'xls', 'dbf'],
+                    type=item.get("tipos", EXTENSIONES_ENTRADA),
                     accept_multiple_files=True,
                     key=get_file_uploader_key(item["id"], st.session_state.session_id)
                 )
@@ -2077,7 +4283,7 @@ def mostrar_panel_proceso():
             else:
                 uploaded_file = st.file_uploader(
                     f"{required} {item['nombre']}",
-                    type=['xlsx', 'xls', 'dbf'],
+                    type=item.get("tipos", EXTENSIONES_ENTRADA),
                     key=get_file_uploader_key(item["id"], st.session_state.session_id)
                 )
                 if uploaded_file:
@@ -2087,11 +4293,42 @@ def mostrar_panel_proceso():
                         st.session_state.archivos_cargados[item["id"]] = tmp_file.name
                     st.success(f"Archivo cargado: {uploaded_file.name}")
         
+        if len(motores_disponibles()) > 1:
+            st.selectbox(
+                "Motor de ejecución",
+                motores_disponibles(),
+                key="motor",
+                help="Los cruces se ejecutan en el motor elegido; con Polars también el consolidado CMPC y las agrupaciones de Celulosa. Permite comparar tiempos con los mismos archivos."
+            )
+
+        if st.session_state.tipo_material == "Madera":
+            st.checkbox(
+                "Recalcular solo entregas nuevas o modificadas",
+                key="incremental",
+                help="Reutiliza el cruce de las entregas cuyas filas de Programa, Despacho, Detalle e Informe no cambiaron desde la última corrida de la misma nave."
+            )
+            st.selectbox(
+                "Separar entregables por",
+                ["No separar"] + list(PARTICIONES_MADERA),
+                key="particion_madera",
+                help="Para programas con varias naves o reservas: procesa cada una en paralelo y genera un juego de archivos por cada una."
+            )
+
+        st.multiselect(
+            "Formatos adicionales (además de Excel)",
+            list(FORMATOS_EXPORTACION),
+            key="formatos_extra",
+            help="Escribe cada tabla (Cabecera, Posicion, Remate, consolidados) como archivo plano para cargas a SAP."
+        )
+
         submit_button = st.form_submit_button("🚀 Ejecutar Proceso")
     
     if submit_button:
         ejecutar_proceso()
 
+    if st.session_state.tipo_material == "SAG":
+        mostrar_indice_sif()
+
     # --- AQUÍ ESTÁ LA MAGIA ---
     # Mostramos los botones FUERA del formulario y basados en session_state
     if st.session_state.get('archivos_generados'):
@@ -2104,29 +4341,40 @@ def mostrar_panel_proceso():
                     label=f"Descargar {nombre}",
                     data=archivo_bytes,
                     file_name=nombre,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    mime=mime_archivo(nombre),
                     key=f"btn_descarga_{nombre}" # Es clave darle un ID único a cada botón
                 )
 
 import time # Asegúrate de tener 'import time' al inicio de tu app.py si no lo tienes
 
 def ejecutar_proceso():
+    tipo_material = st.session_state.tipo_material
+    rutas = dict(st.session_state.archivos_cargados)
+
+    # SAG encadenado: las tablas de Madera reemplazan los archivos Remate y Picking
+    tablas_madera = st.session_state.get('tablas_madera')
+    if tipo_material == "SAG" and tablas_madera and st.session_state.get('sag_encadenado'):
+        rutas['remate'] = tablas_madera["RemateMaderaSAG"]
+        rutas['picking'] = tablas_madera["Picking"]
+
     # Validar archivos obligatorios
-    lista_archivos = CONFIG_ARCHIVOS.get(st.session_state.tipo_material, [])
+    lista_archivos = CONFIG_ARCHIVOS.get(tipo_material, [])
     faltantes = []
     
     for item in lista_archivos:
-        if not item["opcional"] and item["id"] not in st.session_state.archivos_cargados:
+        if not item["opcional"] and item["id"] not in rutas:
             faltantes.append(item["nombre"])
     
     if faltantes:
         st.error(f"Faltan archivos obligatorios:\n- " + "\n- ".join(faltantes))
         return
-    
-    # Seleccionar lógica según tipo de material
-    tipo_material = st.session_state.tipo_material
-    rutas = st.session_state.archivos_cargados
-    
+
+    # Validación previa: solo encabezados, antes de cualquier lectura completa
+    errores_preflight = validar_preflight(tipo_material, rutas)
+    if errores_preflight:
+        st.error("Los archivos no cumplen el formato esperado:\n- " + "\n- ".join(errores_preflight))
+        return
+
     # ==========================================
     # PANTALLA DE CARGA ESTÉTICA
     # ==========================================
@@ -2137,26 +4385,29 @@ def ejecutar_proceso():
         st.write("⚙️ Cruzando información y aplicando lógica de negocio...")
         
         # Aquí corre tu código pesado
-        if tipo_material == "Madera":
-            exito, mensaje, archivos = procesar_madera(rutas)
-        elif tipo_material == "Celulosa BKP EKP UKP":
-            exito, mensaje, archivos = procesar_celulosa_cb(rutas)
-        elif tipo_material == "Celulosa DP":
-            exito, mensaje, archivos = procesar_celulosa_sb(rutas)
-        elif tipo_material == "SAG":
-            exito, mensaje, archivos = procesar_sag(rutas)
-        elif tipo_material == "CMPC Celulosa":
-            exito, mensaje, archivos = procesar_cmpc_celulosa(rutas)
-        elif tipo_material == "CMPC Madera":
-            exito, mensaje, archivos = procesar_cmpc_madera(rutas)
-        elif tipo_material == "CMPC Papel":
-            exito, mensaje, archivos = procesar_cmpc_papel(rutas)
-        elif tipo_material == "CMPC Plywood":
-            exito, mensaje, archivos = procesar_cmpc_plywood(rutas)
-        else:
+        opciones = {
+            "traza": [],
+            "formatos": st.session_state.get("formatos_extra", []),
+            "motor": st.session_state.get("motor", "pandas"),
+            "incremental": st.session_state.get("incremental", False),
+            "avisos": [],
+        }
+        if tipo_material == "Madera" and st.session_state.get("particion_madera", "No separar") != "No separar":
+            opciones["particion"] = st.session_state.particion_madera
+        inicio_proceso = time.perf_counter()
+        if tipo_material not in PROCESOS:
             exito, mensaje, archivos = False, "Lógica no implementada", []
+        else:
+            exito, mensaje, archivos = ejecutar_memorizado(tipo_material, rutas, opciones)
+        if exito and tipo_material == "Madera":
+            # Solo una corrida de una nave se puede encadenar directo con SAG
+            tablas = opciones.get("tablas") or {}
+            st.session_state.tablas_madera = tablas if "RemateMaderaSAG" in tablas else None
         
+        duracion = time.perf_counter() - inicio_proceso
         st.write("📝 Generando reportes de salida...")
+        if exito and opciones["formatos"]:
+            archivos = archivos + exportar_tablas(opciones.get("tablas"), opciones["formatos"])
         
         # Actualizamos el estado de la cajita dependiendo del resultado
         if exito:
@@ -2164,17 +4415,27 @@ def ejecutar_proceso():
         else:
             status.update(label="Ocurrió un error en el proceso", state="error", expanded=True)
 
+    # Advertencias y errores no fatales del flujo (también de corridas en el
+    # trabajador o memorizadas, donde no llegan a la sesión mientras corren)
+    for nivel, texto in opciones.get("avisos", []):
+        getattr(st, nivel)(texto)
+
     # Mostrar resultados y animaciones
     if exito:
         st.toast('¡Archivos generados con éxito!', icon='🎉') # Notificación flotante
         # st.balloons() # Descomenta esto si quieres globos volando por la pantalla (a veces es mucho, pero es divertido)
         
         st.success(mensaje)
+        modo = " · bajo consumo" if opciones.get("bajo_consumo") else ""
+        modo += " · resultado reutilizado" if opciones.get("memorizado") else ""
+        st.caption(f"Motor: {opciones['motor']}{modo} · {duracion:.2f} s")
         st.session_state.archivos_generados = archivos
     else:
         st.session_state.archivos_generados = None
         st.error(f"Error: {mensaje}")
 
+    mostrar_embudo(opciones.get("traza"))
+
 if __name__ == "__main__":
 
     main()